@@ -32,6 +32,9 @@ setup(name='VisualPIC',
                         'visualization/assets/vtk_visualizer/opacities/*.h5']
           },
       install_requires=read_requirements(),
+      entry_points={
+          'console_scripts': ['visualpic=visualpic.cli:main']
+          },
       platforms='any',
       classifiers=(
           "Development Status :: 3 - Alpha",
@@ -0,0 +1,134 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the adaptive selection of the time steps analyzed in the beam
+evolution.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import numpy as np
+import pytest
+
+from visualpic.analysis.beam_evolution import (
+    analyze_beam_evolution, _sample_time_steps_adaptively)
+from test_concurrent_reads import write_osiris_data, TIME_STEPS
+
+
+TIME_STEPS_FINE = np.arange(0, 1001, 10)
+
+
+class Analysis():
+
+    """
+    Stores the parameters of each analyzed time step, given by a function of
+    the time step, and records the analyzed time steps.
+    """
+
+    def __init__(self, params_function):
+        self.params_function = params_function
+        self.params = {}
+        self.analyzed = []
+
+    def analyze_time_steps(self, steps):
+        for time_step in steps:
+            assert time_step not in self.params
+            self.params[time_step] = self.params_function(time_step)
+            self.analyzed.append(time_step)
+        return len(steps)
+
+    def get_data(self, steps):
+        return {var: np.array([self.params[ts][var] for ts in steps])
+                for var in self.params[steps[0]]}
+
+
+def sample(params_function, tolerance=0.01, tracked_vars=('ene_avg',),
+           n_initial_steps=5, max_steps=None, max_time=None):
+    analysis = Analysis(params_function)
+    time_steps = _sample_time_steps_adaptively(
+        TIME_STEPS_FINE, analysis.analyze_time_steps, analysis, tolerance,
+        tracked_vars, n_initial_steps, max_steps, max_time)
+    return time_steps, analysis.analyzed
+
+
+def test_constant_params_are_not_refined():
+    time_steps, analyzed = sample(lambda ts: {'ene_avg': 1.})
+    np.testing.assert_array_equal(time_steps, [0, 250, 500, 750, 1000])
+    assert sorted(analyzed) == list(time_steps)
+
+
+def test_jump_is_bisected():
+    # The refinement converges to the two time steps around the jump,
+    # leaving the constant regions coarsely sampled.
+    time_steps, analyzed = sample(
+        lambda ts: {'ene_avg': 1. if ts < 503 else 2., 'q': 1.})
+    assert sorted(analyzed) == list(time_steps)
+    assert np.all(np.diff(time_steps) > 0)
+    assert 500 in time_steps and 510 in time_steps
+    # Only the interval with the jump is bisected, from 250 down to 10.
+    assert len(time_steps) <= 10
+    gaps = np.diff(time_steps)
+    assert list(gaps[time_steps[:-1] == 500]) == [10]
+    assert np.max(gaps) == 250
+
+
+def test_only_tracked_vars_are_refined():
+    time_steps, _ = sample(
+        lambda ts: {'ene_avg': 1., 'q': 1. if ts < 503 else 2.})
+    assert len(time_steps) == 5
+    time_steps, _ = sample(
+        lambda ts: {'ene_avg': 1., 'q': 1. if ts < 503 else 2.},
+        tracked_vars=('ene_avg', 'q', 'not_a_var'))
+    assert 500 in time_steps and 510 in time_steps
+
+
+def test_nan_params():
+    # A change to NaN (e.g., when the beam is lost) is refined.
+    time_steps, _ = sample(
+        lambda ts: {'ene_avg': 1. if ts < 303 else np.nan})
+    assert 300 in time_steps and 310 in time_steps
+
+
+@pytest.mark.parametrize('max_steps', [3, 5, 12, 30])
+def test_max_steps(max_steps):
+    # Parameters which vary everywhere, mostly in the second half.
+    def params(ts):
+        return {'ene_avg': 1. + ts / 1000 + 10 * (ts > 500) * ts / 1000}
+
+    time_steps, analyzed = sample(params, max_steps=max_steps)
+    assert len(analyzed) == max_steps
+    assert sorted(analyzed) == list(time_steps)
+    if max_steps > 5:
+        # The intervals with the largest change are refined first.
+        assert (np.sum(time_steps > 500) >
+                np.sum((time_steps > 0) & (time_steps < 500)))
+
+
+def test_max_time():
+    time_steps, _ = sample(lambda ts: {'ene_avg': np.sin(ts / 50)},
+                           max_time=0.)
+    np.testing.assert_array_equal(time_steps, [0, 250, 500, 750, 1000])
+
+
+@pytest.fixture(scope='module')
+def sim_folder(tmp_path_factory):
+    return write_osiris_data(str(tmp_path_factory.mktemp('sim')))
+
+
+@pytest.mark.parametrize('max_steps', [None, 2])
+def test_adaptive_analysis(sim_folder, max_steps):
+    kwargs = dict(plasma_density=1e23, adaptive=True, adaptive_tol=0.,
+                  n_initial_steps=2, max_steps=max_steps)
+    result = analyze_beam_evolution(sim_folder, 'osiris', 'beam', **kwargs)
+    expected = analyze_beam_evolution(sim_folder, 'osiris', 'beam',
+                                      plasma_density=1e23)
+    if max_steps is None:
+        time_steps = TIME_STEPS
+    else:
+        time_steps = [TIME_STEPS[0], TIME_STEPS[-1]]
+    np.testing.assert_array_equal(result['timestep'], time_steps)
+    idx = np.isin(TIME_STEPS, time_steps)
+    np.testing.assert_array_equal(result['ene_avg'],
+                                  expected['ene_avg'][idx])
@@ -0,0 +1,108 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the asynchronous access to the simulation data.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from visualpic import DataContainer
+from visualpic.data_handling import async_data_access
+from visualpic.data_handling.async_data_access import (
+    AsyncDataAccessor, get_default_accessor)
+from test_concurrent_reads import write_osiris_data, TIME_STEPS
+
+
+@pytest.fixture(scope='module')
+def sim_folder(tmp_path_factory):
+    return write_osiris_data(str(tmp_path_factory.mktemp('sim')))
+
+
+def load_container(sim_folder):
+    dc = DataContainer('osiris', sim_folder, plasma_density=1e23)
+    dc.load_data()
+    return dc
+
+
+def count_reads(monkeypatch, obj):
+    """Count the calls to the `get_data` method of an object."""
+    get_data = obj.get_data
+    n_reads = []
+
+    def counted_get_data(*args, **kwargs):
+        n_reads.append(1)
+        return get_data(*args, **kwargs)
+
+    monkeypatch.setattr(obj, 'get_data', counted_get_data)
+    return n_reads
+
+
+def test_results_shared_between_containers(sim_folder, monkeypatch):
+    # Containers loading the same data share the results of the accessor.
+    field_1 = load_container(sim_folder).get_field('Ez')
+    field_2 = load_container(sim_folder).get_field('Ez')
+    species_1 = load_container(sim_folder).get_species('beam')
+    species_2 = load_container(sim_folder).get_species('beam')
+    n_field_reads = count_reads(monkeypatch, field_1)
+    n_species_reads = count_reads(monkeypatch, species_1)
+    accessor = AsyncDataAccessor()
+
+    async def read_all():
+        return await asyncio.gather(
+            accessor.get_field_data(field_1, TIME_STEPS[1]),
+            accessor.get_field_data(field_2, TIME_STEPS[1]),
+            accessor.get_field_data(field_2, TIME_STEPS[2]),
+            accessor.get_species_data(species_1, TIME_STEPS[1], ['x']),
+            accessor.get_species_data(species_2, TIME_STEPS[1], ['x']))
+
+    try:
+        results = asyncio.run(read_all())
+    finally:
+        accessor.shutdown()
+    assert len(n_field_reads) == 1
+    assert len(n_species_reads) == 1
+    assert results[0][0] is results[1][0]
+    np.testing.assert_array_equal(results[2][0],
+                                  field_2.get_data(TIME_STEPS[2])[0])
+    assert results[3]['x'][0] is results[4]['x'][0]
+
+
+def test_objects_without_data_source(sim_folder):
+    # Objects not loaded by a DataContainer are identified by themselves.
+    species = load_container(sim_folder).get_species('beam')
+    field_1 = species.get_density_field(resolution=(4, 4, 8))
+    field_2 = species.get_density_field(resolution=(4, 4, 16))
+    assert field_1.data_source is None
+    accessor = AsyncDataAccessor()
+
+    async def read_all():
+        return await asyncio.gather(
+            accessor.get_field_data(field_1, TIME_STEPS[1]),
+            accessor.get_field_data(field_2, TIME_STEPS[1]))
+
+    try:
+        results = asyncio.run(read_all())
+    finally:
+        accessor.shutdown()
+    assert results[0][0].shape != results[1][0].shape
+
+
+def test_default_accessor_shut_down_at_exit(monkeypatch):
+    registered = []
+    monkeypatch.setattr(async_data_access.atexit, 'register',
+                        registered.append)
+    monkeypatch.setattr(async_data_access, '_default_accessor', None)
+    accessor = get_default_accessor()
+    assert get_default_accessor() is accessor
+    assert registered == [async_data_access._shutdown_default_accessor]
+    registered[0]()
+    assert accessor._executor._shutdown
+    assert get_default_accessor() is not accessor
+    get_default_accessor().shutdown()
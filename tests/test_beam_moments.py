@@ -0,0 +1,156 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the (chunked) computation of the beam parameters.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import numpy as np
+import pytest
+from aptools.data_analysis.beam_diagnostics import general_analysis
+
+from visualpic.analysis.beam_moments import (
+    WeightedMomentAccumulator, BeamMoments, get_slice_limits)
+from visualpic.analysis.beam_evolution import (
+    _analyze_beam_timestep, _analyze_beam_timestep_in_chunks)
+
+
+N_PARTICLES = 1000
+N_SLICES = 10
+NO_FILTER = [None] * 7
+
+
+class BeamData():
+
+    """Particle species serving a fixed set of particles."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def get_data(self, time_step, components_list, data_units=None,
+                 particle_range=slice(None)):
+        return {comp: (self.data[comp][particle_range], {})
+                for comp in components_list}
+
+    def iterate_data_chunks(self, time_step, components_list, chunk_size,
+                            data_units=None):
+        n_part = len(self.data['z'])
+        for start in range(0, n_part, chunk_size):
+            yield self.get_data(time_step, components_list,
+                                particle_range=slice(start, start+chunk_size))
+
+
+def make_beam(mixed_charge=False, seed=0):
+    """
+    Generate a random beam. One of the particles is located exactly at the
+    edge between two slices.
+    """
+    rng = np.random.default_rng(seed)
+    data = {
+        'x': rng.normal(1e-7, 1e-6, N_PARTICLES),
+        'y': rng.normal(-2e-7, 2e-6, N_PARTICLES),
+        'z': rng.normal(0., 3e-6, N_PARTICLES),
+        'px': rng.normal(0.1, 2., N_PARTICLES),
+        'py': rng.normal(-0.1, 1., N_PARTICLES),
+        'pz': rng.normal(500., 10., N_PARTICLES),
+    }
+    data['px'] += 1e5 * data['x']
+    if mixed_charge:
+        data['q'] = rng.uniform(-0.5, 1., N_PARTICLES) * 1e-15
+    else:
+        data['q'] = -rng.uniform(0.5, 1., N_PARTICLES) * 1e-15
+    slice_lims = get_slice_limits(np.min(data['z']), np.max(data['z']),
+                                  N_SLICES)
+    data['z'][1] = slice_lims[4]
+    return data
+
+
+def assert_params_equal(params, expected, rtol=1e-6):
+    assert params.keys() == expected.keys()
+    for key, value in expected.items():
+        np.testing.assert_allclose(params[key], value, rtol=rtol,
+                                   err_msg=key)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 256, N_PARTICLES])
+@pytest.mark.parametrize('mixed_charge', [False, True])
+@pytest.mark.parametrize('filters', [
+    (NO_FILTER, NO_FILTER, NO_FILTER),
+    ([-2e-6, None, None, None, None, None, None],
+     [None, None, None, None, None, 510., None], NO_FILTER),
+    (NO_FILTER, NO_FILTER, [2., None, 1.5, None, None, 2., None]),
+])
+def test_chunked_analysis_matches_full(chunk_size, mixed_charge, filters):
+    beam = BeamData(make_beam(mixed_charge))
+    filter_min, filter_max, filter_sigma = filters
+    expected = _analyze_beam_timestep(
+        0, beam, N_SLICES, None, filter_min, filter_max, filter_sigma)
+    params = _analyze_beam_timestep_in_chunks(
+        0, beam, N_SLICES, None, filter_min, filter_max, filter_sigma,
+        chunk_size)
+    assert_params_equal(params, expected)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 256, N_PARTICLES])
+@pytest.mark.parametrize('mixed_charge', [False, True])
+def test_beam_moments_match_aptools(chunk_size, mixed_charge):
+    data = make_beam(mixed_charge)
+    comps = ['x', 'y', 'z', 'px', 'py', 'pz', 'q']
+    expected = general_analysis(*[data[comp] for comp in comps],
+                                n_slices=N_SLICES)
+    z = data['z']
+    beam_moments = BeamMoments(
+        get_slice_limits(np.min(z), np.max(z), N_SLICES))
+    for start in range(0, N_PARTICLES, chunk_size):
+        beam_moments.add(
+            *[data[comp][start:start+chunk_size] for comp in comps])
+    params = beam_moments.get_beam_params()
+    # Parameters not computed by APtools.
+    for key in ['slice_z', 'slice_current', 'slice_emitt_nx',
+                'slice_emitt_ny', 'slice_rel_ene_sp']:
+        del params[key]
+    assert_params_equal(params, expected, rtol=1e-5)
+
+
+def test_slice_edges():
+    # As in APtools, the particles in slice i fulfill
+    # slice_lims[i] < z <= slice_lims[i+1], so that the particle at the
+    # lower edge of the first slice is not part of any slice.
+    slice_lims = np.linspace(0., 1., 5)
+    z = np.array([0., 0.1, 0.25, 0.25, 0.5, 0.6, 1.])
+    n = len(z)
+    beam_moments = BeamMoments(slice_lims)
+    ones = np.ones(n)
+    beam_moments.add(np.zeros(n), np.zeros(n), z, ones, ones, 100 * ones,
+                     ones)
+    np.testing.assert_array_equal(beam_moments._slice_acc.count,
+                                  [3, 1, 1, 1])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 256])
+def test_accumulator_matches_numpy(chunk_size):
+    data = make_beam(mixed_charge=True)
+    w = data['q']
+    groups = np.arange(N_PARTICLES) % 3
+    acc = WeightedMomentAccumulator(['x', 'px'], n_groups=3)
+    acc_abs = WeightedMomentAccumulator(['x', 'px'], n_groups=3)
+    for start in range(0, N_PARTICLES, chunk_size):
+        sl = slice(start, start + chunk_size)
+        chunk = {var: data[var][sl] for var in ['x', 'px']}
+        acc.add(chunk, w[sl], groups[sl])
+        acc_abs.add(chunk, np.abs(w[sl]), groups[sl])
+    for g in range(3):
+        in_g = groups == g
+        x, px, w_g = data['x'][in_g], data['px'][in_g], w[in_g]
+        np.testing.assert_allclose(acc.get_mean('x')[g],
+                                   np.average(x, weights=w_g))
+        x_c = x - np.average(x, weights=w_g)
+        px_c = px - np.average(px, weights=w_g)
+        np.testing.assert_allclose(acc.get_covariance('x', 'px')[g],
+                                   np.average(x_c * px_c, weights=w_g))
+        np.testing.assert_allclose(
+            acc_abs.get_covariance('x', 'px', ddof=1)[g],
+            np.cov(x, px, aweights=np.abs(w_g))[0, 1])
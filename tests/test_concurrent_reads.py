@@ -0,0 +1,210 @@
+"""
+This file is part of VisualPIC.
+
+Tests checking that the field and particle data can be read concurrently
+from several threads.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from h5py import File as H5F
+
+from visualpic import DataContainer
+
+
+N_THREADS = 8
+N_REPEATS = 4
+TIME_STEPS = [0, 10, 20]
+N_PARTICLES = 2000
+
+
+def write_osiris_data(folder):
+    """
+    Write a small Osiris simulation with two fields and a species. Returns
+    the path to its 'MS' folder.
+    """
+    rng = np.random.default_rng(0)
+    ms = os.path.join(folder, 'MS')
+    for time_step in TIME_STEPS:
+        for name in ['e1', 'e3']:
+            field_folder = os.path.join(ms, 'FLD', name)
+            os.makedirs(field_folder, exist_ok=True)
+            file_path = os.path.join(
+                field_folder, '{}-{:06d}.h5'.format(name, time_step))
+            with H5F(file_path, 'w') as f:
+                _write_osiris_header(f, time_step, 'm_ec\\omega_pe^{-1}')
+                for axis in ['AXIS1', 'AXIS2', 'AXIS3']:
+                    ds = f.create_dataset('AXIS/' + axis, data=np.zeros(2))
+                    ds.attrs['UNITS'] = np.array([b'c/\\omega_p'])
+                f.create_dataset(name, data=rng.normal(size=(6, 8, 10)))
+        raw_folder = os.path.join(ms, 'RAW', 'beam')
+        os.makedirs(raw_folder, exist_ok=True)
+        file_path = os.path.join(
+            raw_folder, 'RAW-beam-{:06d}.h5'.format(time_step))
+        quants = ['x1', 'x2', 'x3', 'p1', 'p2', 'p3', 'q']
+        units = ['c/\\omega_p'] * 3 + ['m_ec'] * 3 + ['e']
+        with H5F(file_path, 'w') as f:
+            _write_osiris_header(f, time_step)
+            f.attrs['QUANTS'] = np.array([q.encode() for q in quants])
+            f.attrs['UNITS'] = np.array([u.encode() for u in units])
+            for quant in quants:
+                f.create_dataset(quant, data=rng.normal(size=N_PARTICLES))
+    return ms
+
+
+def _write_osiris_header(f, time_step, units=None):
+    f.attrs['TIME'] = [time_step * 0.1]
+    f.attrs['TIME UNITS'] = np.array([b'1/\\omega_p'])
+    if units is not None:
+        f.attrs['UNITS'] = np.array([units.encode()])
+    sim = f.create_group('SIMULATION')
+    sim.attrs['XMIN'] = np.array([0., -5., -5.])
+    sim.attrs['XMAX'] = np.array([10., 5., 5.])
+    sim.attrs['NX'] = np.array([10, 6, 8])
+
+
+def write_openpmd_data(folder):
+    """Write a small openPMD simulation with a field and a species."""
+    rng = np.random.default_rng(0)
+    os.makedirs(folder, exist_ok=True)
+    for time_step in TIME_STEPS:
+        file_path = os.path.join(folder, 'data{:08d}.h5'.format(time_step))
+        with H5F(file_path, 'w') as f:
+            f.attrs['openPMD'] = np.bytes_('1.1.0')
+            f.attrs['openPMDextension'] = np.uint32(0)
+            f.attrs['basePath'] = np.bytes_('/data/%T/')
+            f.attrs['meshesPath'] = np.bytes_('meshes/')
+            f.attrs['particlesPath'] = np.bytes_('particles/')
+            f.attrs['iterationEncoding'] = np.bytes_('fileBased')
+            f.attrs['iterationFormat'] = np.bytes_('data%T.h5')
+            it = f.create_group('data/{}'.format(time_step))
+            it.attrs['time'] = time_step * 1e-15
+            it.attrs['dt'] = 1e-15
+            it.attrs['timeUnitSI'] = 1.
+            mesh = it.create_group('meshes/E')
+            mesh.attrs['geometry'] = np.bytes_('cartesian')
+            mesh.attrs['axisLabels'] = np.array([b'x', b'y', b'z'])
+            mesh.attrs['gridSpacing'] = np.array([1e-6, 1e-6, 1e-6])
+            mesh.attrs['gridGlobalOffset'] = np.array([-3e-6, -4e-6, 0.])
+            mesh.attrs['gridUnitSI'] = 1.
+            mesh.attrs['dataOrder'] = np.bytes_('C')
+            mesh.attrs['unitDimension'] = np.array([1., 1, -3, -1, 0, 0, 0])
+            mesh.attrs['timeOffset'] = 0.
+            for comp in 'xyz':
+                ds = mesh.create_dataset(
+                    comp, data=rng.normal(size=(6, 8, 10)))
+                ds.attrs['unitSI'] = 1.
+                ds.attrs['position'] = np.array([0.5, 0.5, 0.5])
+            species = it.create_group('particles/elec')
+            for record, unit_si, dims in [
+                    ('position', 1e-6, [1., 0, 0, 0, 0, 0, 0]),
+                    ('momentum', 1e-22, [1., 1, -1, 0, 0, 0, 0])]:
+                group = species.create_group(record)
+                _write_record_attrs(group, dims)
+                for comp in 'xyz':
+                    ds = group.create_dataset(
+                        comp, data=rng.normal(size=N_PARTICLES))
+                    ds.attrs['unitSI'] = unit_si
+            group = species.create_group('positionOffset')
+            _write_record_attrs(group, [1., 0, 0, 0, 0, 0, 0])
+            for comp in 'xyz':
+                _write_constant_record(group.create_group(comp), 0.)
+            for record, value, dims in [
+                    ('charge', -1.6e-19, [0., 0, 1, 1, 0, 0, 0]),
+                    ('mass', 9.1e-31, [0., 1, 0, 0, 0, 0, 0])]:
+                group = species.create_group(record)
+                _write_record_attrs(group, dims)
+                _write_constant_record(group, value)
+            ds = species.create_dataset(
+                'weighting', data=rng.uniform(1, 2, N_PARTICLES))
+            _write_record_attrs(ds, np.zeros(7))
+            ds.attrs['unitSI'] = 1.
+    return folder
+
+
+def _write_record_attrs(record, unit_dimension):
+    record.attrs['unitDimension'] = np.array(unit_dimension)
+    record.attrs['timeOffset'] = 0.
+
+
+def _write_constant_record(group, value):
+    group.attrs['value'] = value
+    group.attrs['shape'] = np.array([N_PARTICLES], dtype=np.uint64)
+    group.attrs['unitSI'] = 1.
+
+
+@pytest.fixture(scope='module')
+def osiris_container(tmp_path_factory):
+    folder = write_osiris_data(str(tmp_path_factory.mktemp('osiris')))
+    dc = DataContainer('osiris', folder, plasma_density=1e23)
+    dc.load_data()
+    return dc
+
+
+@pytest.fixture(scope='module')
+def openpmd_container(tmp_path_factory):
+    folder = write_openpmd_data(str(tmp_path_factory.mktemp('openpmd')))
+    dc = DataContainer('openpmd', folder)
+    dc.load_data()
+    return dc
+
+
+def _read_all(dc, field_names, species_name):
+    """Returns the functions reading all fields and species components."""
+    reads = []
+    for name in field_names:
+        field = dc.get_field(name)
+        for time_step in TIME_STEPS:
+            reads.append(
+                lambda f=field, ts=time_step: f.get_data(ts)[0])
+    species = dc.get_species(species_name)
+    components = ['x', 'y', 'z', 'px', 'py', 'pz', 'q']
+    for time_step in TIME_STEPS:
+        for comp in components:
+            reads.append(
+                lambda ts=time_step, c=comp: species.get_data(ts, [c])[c][0])
+    return reads
+
+
+def _check_concurrent_reads(reads):
+    """Compare concurrent reads with serial ones."""
+    expected = [np.array(read()) for read in reads]
+    # Switch between threads often to make interleaved reads more likely.
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(N_THREADS) as executor:
+            futures = [executor.submit(read) for _ in range(N_REPEATS)
+                       for read in reads]
+            results = [future.result() for future in futures]
+    finally:
+        sys.setswitchinterval(switch_interval)
+    for i, result in enumerate(results):
+        np.testing.assert_array_equal(result, expected[i % len(reads)])
+
+
+def test_concurrent_reads_per_file_locks(osiris_container):
+    field = osiris_container.get_field('Ez')
+    species = osiris_container.get_species('beam')
+    assert field.field_reader.reader_locks.per_file
+    assert species.data_reader.reader_locks.per_file
+    _check_concurrent_reads(
+        _read_all(osiris_container, ['Ez', 'Ey'], 'beam'))
+
+
+def test_concurrent_reads_shared_lock(openpmd_container):
+    field = openpmd_container.get_field('Ez')
+    species = openpmd_container.get_species('elec')
+    # The openPMD field and particle readers share a single lock.
+    assert field.field_reader.reader_locks is species.data_reader.reader_locks
+    assert not field.field_reader.reader_locks.per_file
+    _check_concurrent_reads(
+        _read_all(openpmd_container, ['Ez', 'Ex', 'Ey'], 'elec'))
@@ -0,0 +1,119 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the conversion of simulation data into analysis-optimized data
+stores.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import os
+
+import numpy as np
+import pytest
+
+from visualpic import DataContainer
+from visualpic.data_handling.data_conversion import convert_simulation
+from visualpic.data_reading.folder_scanners import VisualPICFolderScanner
+from test_concurrent_reads import write_osiris_data, TIME_STEPS
+
+
+CHUNK_SIZE = 128
+
+
+@pytest.fixture(scope='module')
+def converted_sim(tmp_path_factory):
+    """Returns the source and converted data containers."""
+    folder = str(tmp_path_factory.mktemp('conversion'))
+    source_folder = write_osiris_data(os.path.join(folder, 'source'))
+    output_folder = os.path.join(folder, 'converted')
+    convert_simulation('osiris', source_folder, output_folder,
+                       plasma_density=1e23, particle_chunk_size=CHUNK_SIZE,
+                       n_proc=1)
+    source = DataContainer('osiris', source_folder, plasma_density=1e23)
+    source.load_data()
+    converted = DataContainer('visualpic', output_folder)
+    converted.load_data()
+    return source, converted, output_folder
+
+
+def test_store_is_found_by_scanner(converted_sim):
+    source, converted, output_folder = converted_sim
+    scanner = VisualPICFolderScanner()
+    fields = scanner.get_list_of_fields(output_folder)
+    species = scanner.get_list_of_species(output_folder)
+    assert (sorted(field.field_name for field in fields) ==
+            sorted(field.field_name for field in source.folder_fields))
+    assert [sp.species_name for sp in species] == ['beam']
+    assert (sorted(converted.get_list_of_fields()) ==
+            sorted(source.get_list_of_fields()))
+    assert converted.get_list_of_species() == ['beam']
+
+
+@pytest.mark.parametrize('field_name', ['Ez', 'Ey'])
+def test_fields_match_source(converted_sim, field_name):
+    source, converted, _ = converted_sim
+    for time_step in TIME_STEPS:
+        expected, expected_md = source.get_field(field_name).get_data(
+            time_step, field_units='SI', axes_units='SI', time_units='SI')
+        data, md = converted.get_field(field_name).get_data(time_step)
+        np.testing.assert_array_equal(data, expected)
+        assert md['field']['units'] == expected_md['field']['units']
+        assert md['field']['axis_labels'] == expected_md['field'][
+            'axis_labels']
+        for label in md['field']['axis_labels']:
+            np.testing.assert_array_equal(md['axis'][label]['array'],
+                                          expected_md['axis'][label]['array'])
+        assert md['time']['value'] == expected_md['time']['value']
+
+
+def test_particles_match_source(converted_sim):
+    source, converted, _ = converted_sim
+    components = ['x', 'y', 'z', 'px', 'py', 'pz', 'q']
+    for time_step in TIME_STEPS:
+        expected = source.get_species('beam').get_data(
+            time_step, components, data_units=['SI'] * len(components))
+        data = converted.get_species('beam').get_data(time_step, components)
+        # The particles in the store are sorted by 'z'.
+        order = np.argsort(expected['z'][0], kind='stable')
+        for comp in components:
+            np.testing.assert_array_equal(data[comp][0],
+                                          expected[comp][0][order])
+            assert data[comp][1]['units'] == expected[comp][1]['units']
+
+
+@pytest.mark.parametrize('component', ['z', 'x'])
+def test_find_particle_range(converted_sim, component):
+    _, converted, _ = converted_sim
+    species = converted.get_species('beam')
+    time_step = TIME_STEPS[1]
+    values = species.get_data(time_step, [component])[component][0]
+    n_part = len(values)
+    v_min, v_max = np.quantile(values, [0.4, 0.45])
+    particle_range = species.find_particle_range(
+        time_step, component, [v_min, v_max])
+    # The range is aligned with the chunks and contains all particles with
+    # values within [v_min, v_max].
+    assert particle_range.start % CHUNK_SIZE == 0
+    assert (particle_range.stop % CHUNK_SIZE == 0 or
+            particle_range.stop == n_part)
+    in_range = np.nonzero((values >= v_min) & (values <= v_max))[0]
+    assert in_range.min() >= particle_range.start
+    assert in_range.max() < particle_range.stop
+    if component == 'z':
+        # The particles are sorted by 'z', so the range is narrow.
+        assert particle_range.stop - particle_range.start <= 3 * CHUNK_SIZE
+    # Only the chunks overlapping [v_min, v_max] are included.
+    last_chunk = (particle_range.stop - 1) // CHUNK_SIZE * CHUNK_SIZE
+    for start in [particle_range.start, last_chunk]:
+        chunk = values[start:start+CHUNK_SIZE]
+        assert chunk.max() >= v_min and chunk.min() <= v_max
+    data = species.get_data(time_step, [component],
+                            particle_range=particle_range)
+    np.testing.assert_array_equal(data[component][0],
+                                  values[particle_range])
+    empty_range = species.find_particle_range(
+        time_step, component, [values.max() + 1, values.max() + 2])
+    assert empty_range.stop - empty_range.start == 0
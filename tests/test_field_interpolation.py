@@ -0,0 +1,129 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the interpolation of field data at arbitrary points.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import numpy as np
+import pytest
+
+from visualpic.data_handling.field_interpolation import (
+    get_point_coordinates, get_bounding_index_region, interpolate_field)
+
+
+def linear_field(axes, coefs):
+    """Field which depends linearly on each coordinate."""
+    grids = np.meshgrid(*axes, indexing='ij')
+    return coefs[0] + sum(c * g for c, g in zip(coefs[1:], grids))
+
+
+def linear_values(coords, coefs):
+    return coefs[0] + sum(c * x for c, x in zip(coefs[1:], coords))
+
+
+@pytest.mark.parametrize('n_dims', [1, 2, 3])
+def test_linear_field_is_exact(n_dims):
+    rng = np.random.default_rng(0)
+    axes = [np.linspace(-1., 2., 7), np.linspace(0., 5., 11),
+            np.linspace(-3e-6, -1e-6, 4)][:n_dims]
+    coefs = [0.5, 2., -1., 3e6][:n_dims + 1]
+    fld = linear_field(axes, coefs)
+    coords = [rng.uniform(axis[0], axis[-1], 500) for axis in axes]
+    # Points at the grid nodes, including the first and last ones.
+    for coord, axis in zip(coords, axes):
+        coord[:len(axis)] = axis
+        coord[-1] = axis[-1]
+    values = interpolate_field(fld, axes, coords)
+    np.testing.assert_allclose(values, linear_values(coords, coefs),
+                               rtol=1e-12, atol=1e-12)
+
+
+def test_points_outside_grid():
+    axes = [np.linspace(0., 1., 5), np.linspace(0., 2., 9)]
+    fld = linear_field(axes, [1., 1., 1.])
+    coords = [np.array([0.5, -0.1, 0.5, 1.1, 1.]),
+              np.array([1., 1., 2.01, 1., 2.])]
+    values = interpolate_field(fld, axes, coords)
+    np.testing.assert_allclose(values, [2.5, np.nan, np.nan, np.nan, 4.])
+    values = interpolate_field(fld, axes, coords, fill_value=0.)
+    np.testing.assert_allclose(values, [2.5, 0., 0., 0., 4.])
+
+
+def test_axis_with_single_point():
+    axes = [np.array([0.]), np.linspace(0., 1., 5)]
+    fld = linear_field(axes, [1., 0., 2.])
+    coords = [np.zeros(3), np.array([0., 0.3, 1.])]
+    np.testing.assert_allclose(interpolate_field(fld, axes, coords),
+                               [1., 1.6, 3.])
+
+
+@pytest.mark.parametrize('as_dict', [True, False])
+def test_cylindrical_coordinates(as_dict):
+    rng = np.random.default_rng(1)
+    r_axis = np.linspace(0., 4e-5, 21)
+    z_axis = np.linspace(-1e-5, 3e-5, 41)
+    axes = [r_axis, z_axis]
+    coefs = [1., -2e4, 5e4]
+    fld = linear_field(axes, coefs)
+    n = 300
+    x = rng.uniform(-2.8e-5, 2.8e-5, n)
+    y = rng.uniform(-2.8e-5, 2.8e-5, n)
+    z = rng.uniform(z_axis[0], z_axis[-1], n)
+    # Points on the axis and on the last node in r.
+    x[:2] = [0., r_axis[-1]]
+    y[:2] = [0., 0.]
+    if as_dict:
+        points = {'x': x, 'y': y, 'z': z}
+    else:
+        points = np.stack([x, y, z], axis=-1)
+    coords = get_point_coordinates(points, ['r', 'z'], 'cylindrical')
+    np.testing.assert_array_equal(coords[0], np.hypot(x, y))
+    np.testing.assert_array_equal(coords[1], z)
+    values = interpolate_field(fld, axes, coords)
+    np.testing.assert_allclose(values,
+                               linear_values([np.hypot(x, y), z], coefs),
+                               rtol=1e-12)
+
+
+def test_point_coordinates():
+    x, y = np.array([1., 2.]), np.array([3., 4.])
+    coords = get_point_coordinates({'y': y, 'x': x}, ['x', 'y'],
+                                   'cartesian')
+    np.testing.assert_array_equal(coords, [x, y])
+    coords = get_point_coordinates(np.stack([x, y], axis=-1), ['x', 'y'],
+                                   'cartesian')
+    np.testing.assert_array_equal(coords, [x, y])
+    coords = get_point_coordinates(x, ['z'], 'cartesian')
+    np.testing.assert_array_equal(coords, [x])
+    with pytest.raises(ValueError):
+        get_point_coordinates({'x': x}, ['x', 'y'], 'cartesian')
+    with pytest.raises(ValueError):
+        get_point_coordinates(np.ones((2, 3)), ['x', 'y'], 'cartesian')
+
+
+def test_bounding_index_region():
+    rng = np.random.default_rng(2)
+    axes = [np.linspace(0., 1., 11), np.linspace(-1., 1., 21)]
+    fld = rng.normal(size=(11, 21))
+    coords = [rng.uniform(0.23, 0.41, 50), rng.uniform(-0.5, 0.05, 50)]
+    # Point outside of the grid, which does not enlarge the region.
+    coords[0][0] = 2.
+    index_region = get_bounding_index_region(axes, coords)
+    assert index_region == [(2, 6), (5, 12)]
+    # Interpolating on the region gives the same result as on the full grid.
+    sub_axes = [axis[start:stop]
+                for axis, (start, stop) in zip(axes, index_region)]
+    sub_fld = fld[tuple(slice(start, stop) for start, stop in index_region)]
+    np.testing.assert_allclose(interpolate_field(sub_fld, sub_axes, coords),
+                               interpolate_field(fld, axes, coords))
+    # Points at a grid node keep two nodes for interpolating.
+    index_region = get_bounding_index_region(
+        axes, [np.array([1.]), np.array([0.])])
+    assert index_region == [(9, 11), (10, 12)]
+    index_region = get_bounding_index_region(
+        axes, [np.array([2.]), np.array([0.])])
+    assert index_region is None
@@ -0,0 +1,141 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the low-level reading of HDF5 field datasets.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import os
+
+import numpy as np
+import pytest
+from h5py import File as H5F
+
+from visualpic import DataContainer
+from visualpic.data_reading import field_readers
+from visualpic.data_reading.field_readers import (
+    _read_h5_dataset, _get_contiguous_offset)
+from test_concurrent_reads import write_osiris_data, TIME_STEPS
+
+
+SELECTIONS = [
+    Ellipsis,
+    (slice(2, 9),),
+    (slice(1, 5), slice(3, 11), slice(0, 7)),
+    (3, slice(None), slice(2, 13)),
+    (slice(0, 10, 3), 4),
+]
+
+
+@pytest.fixture
+def contiguous_dataset(tmp_path):
+    rng = np.random.default_rng(0)
+    file_path = os.path.join(str(tmp_path), 'data.h5')
+    with H5F(file_path, 'w') as f:
+        f.create_dataset('fld', data=rng.normal(size=(10, 12, 14)))
+    with H5F(file_path, 'r') as f:
+        yield f['fld']
+
+
+@pytest.mark.parametrize('selection', SELECTIONS)
+def test_memmap_matches_dataset(contiguous_dataset, selection):
+    assert _get_contiguous_offset(contiguous_dataset) is not None
+    data = _read_h5_dataset(contiguous_dataset, selection, use_memmap=True,
+                            n_threads=1)
+    np.testing.assert_array_equal(data, contiguous_dataset[selection])
+
+
+def test_memmap_is_copy_on_write(contiguous_dataset):
+    expected = contiguous_dataset[()]
+    data = _read_h5_dataset(contiguous_dataset, use_memmap=True,
+                            n_threads=1)
+    assert data.flags.writeable
+    data *= 2
+    np.testing.assert_array_equal(contiguous_dataset[()], expected)
+    data = _read_h5_dataset(contiguous_dataset, use_memmap=True,
+                            n_threads=1)
+    np.testing.assert_array_equal(data, expected)
+
+
+def test_osiris_field_data_is_writable(tmp_path):
+    folder = write_osiris_data(str(tmp_path))
+    dc = DataContainer('osiris', folder, plasma_density=1e23)
+    dc.load_data()
+    field = dc.get_field('Ez')
+    time_step = TIME_STEPS[1]
+    data, _ = field.get_data(time_step)
+    expected = data.copy()
+    data *= 2
+    np.testing.assert_array_equal(field.get_data(time_step)[0], expected)
+    region = field.get_data(time_step, index_region=[(1, 4), (2, 7), (0, 5)])
+    np.testing.assert_array_equal(region[0], expected[1:4, 2:7, 0:5])
+
+
+@pytest.fixture
+def chunked_file(tmp_path):
+    """
+    File with chunked datasets using different filters and data types. The
+    chunks do not divide the shape of the datasets (i.e., there are partial
+    edge chunks), and some chunks of the 'partial' dataset are not written.
+    """
+    rng = np.random.default_rng(0)
+    shape = (13, 17, 11)
+    chunks = (4, 5, 3)
+    file_path = os.path.join(str(tmp_path), 'chunked.h5')
+    with H5F(file_path, 'w') as f:
+        for name, dtype, kwargs in [
+                ('gzip_shuffle', 'f8', {'compression': 'gzip',
+                                        'shuffle': True}),
+                ('gzip', 'f4', {'compression': 'gzip'}),
+                ('shuffle', '>i2', {'shuffle': True}),
+                ('none', 'f8', {})]:
+            data = (rng.normal(size=shape) * 100).astype(dtype)
+            f.create_dataset(name, data=data, chunks=chunks, **kwargs)
+        ds = f.create_dataset('partial', shape=shape, dtype='f8',
+                              chunks=chunks, compression='gzip', shuffle=True,
+                              fillvalue=-1.)
+        ds[2:7, 3:9, :] = rng.normal(size=(5, 6, 11))
+    with H5F(file_path, 'r') as f:
+        yield f
+
+
+@pytest.mark.parametrize('selection', [
+    Ellipsis,
+    (slice(2, 9),),
+    (slice(1, 5), slice(3, 11), slice(0, 7)),
+    (3, slice(None), slice(2, 13)),
+    (slice(-3, None), slice(None, -2), -1),
+    (slice(3, 4), slice(4, 6), slice(2, 3)),
+])
+@pytest.mark.parametrize(
+    'name', ['gzip_shuffle', 'gzip', 'shuffle', 'none', 'partial'])
+def test_read_chunks_matches_dataset(chunked_file, monkeypatch, name,
+                                     selection):
+    monkeypatch.setattr(field_readers, '_MIN_PARALLEL_READ_SIZE', 1)
+    dataset = chunked_file[name]
+    expected = dataset[selection]
+    data = field_readers._read_h5_chunks(dataset, selection, 4)
+    assert data.dtype == expected.dtype
+    np.testing.assert_array_equal(data, expected)
+
+
+@pytest.mark.parametrize('selection', [
+    (slice(0, 10, 3), 4),
+    (slice(5, 5),),
+    ([1, 3],),
+])
+def test_read_chunks_unsupported_selections(chunked_file, monkeypatch,
+                                            selection):
+    monkeypatch.setattr(field_readers, '_MIN_PARALLEL_READ_SIZE', 1)
+    dataset = chunked_file['gzip_shuffle']
+    assert field_readers._read_h5_chunks(dataset, selection, 4) is None
+    np.testing.assert_array_equal(
+        _read_h5_dataset(dataset, selection, n_threads=4), dataset[selection])
+
+
+def test_read_chunks_skips_small_selections(chunked_file):
+    assert field_readers._read_h5_chunks(
+        chunked_file['gzip_shuffle'], Ellipsis, 4) is None
@@ -0,0 +1,110 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the deposition of particle data on a grid.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import numpy as np
+import pytest
+
+from visualpic.data_handling.particle_deposition import deposit_on_grid
+
+
+GRID_LIMS = [(0., 1.), (-2., 2.), (1e-6, 5e-6)]
+GRID_SHAPE = (11, 9, 5)
+
+
+def random_particles(n_dims, n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    coords = [rng.uniform(g_min, g_max, n)
+              for g_min, g_max in GRID_LIMS[:n_dims]]
+    w = rng.uniform(-1., 2., n)
+    return coords, w
+
+
+@pytest.mark.parametrize('method', ['ngp', 'cic'])
+@pytest.mark.parametrize('n_dims', [1, 2, 3])
+def test_charge_is_conserved(method, n_dims):
+    coords, w = random_particles(n_dims)
+    # Particles at the first and last nodes of the grid.
+    for coord, (g_min, g_max) in zip(coords, GRID_LIMS):
+        coord[:2] = [g_min, g_max]
+    grid = deposit_on_grid(coords, w, GRID_LIMS[:n_dims],
+                           GRID_SHAPE[:n_dims], method=method)
+    assert grid.shape == GRID_SHAPE[:n_dims]
+    np.testing.assert_allclose(grid.sum(), w.sum(), rtol=1e-12)
+
+
+@pytest.mark.parametrize('method', ['ngp', 'cic'])
+def test_particles_outside_are_ignored(method):
+    coords, w = random_particles(2)
+    inside = np.ones(len(w), dtype=bool)
+    for i, coord in enumerate(coords):
+        coord[i::5] += 5.
+        inside[i::5] = False
+    grid = deposit_on_grid(coords, w, GRID_LIMS[:2], GRID_SHAPE[:2],
+                           method=method)
+    expected = deposit_on_grid([coord[inside] for coord in coords],
+                               w[inside], GRID_LIMS[:2], GRID_SHAPE[:2],
+                               method=method)
+    np.testing.assert_allclose(grid, expected, rtol=1e-12, atol=1e-12)
+
+
+def test_particle_at_node():
+    # A particle at a grid node (i.e., at a cell centre) goes fully to it.
+    for method in ['ngp', 'cic']:
+        grid = deposit_on_grid([np.array([0.3]), np.array([1.])], np.ones(1),
+                               GRID_LIMS[:2], GRID_SHAPE[:2], method=method)
+        expected = np.zeros(GRID_SHAPE[:2])
+        expected[3, 6] = 1.
+        np.testing.assert_allclose(grid, expected, atol=1e-12)
+
+
+def test_particle_at_cell_edge():
+    # Particle at node 3 in x and halfway between nodes 4 and 5 in y.
+    coords = [np.array([0.3]), np.array([0.25])]
+    grid = deposit_on_grid(coords, np.ones(1), GRID_LIMS[:2],
+                           GRID_SHAPE[:2], method='cic')
+    expected = np.zeros(GRID_SHAPE[:2])
+    expected[3, 4:6] = 0.5
+    np.testing.assert_allclose(grid, expected, atol=1e-12)
+    # With NGP, particles at the edge go to the upper node.
+    grid = deposit_on_grid(coords, np.ones(1), GRID_LIMS[:2],
+                           GRID_SHAPE[:2], method='ngp')
+    expected = np.zeros(GRID_SHAPE[:2])
+    expected[3, 5] = 1.
+    np.testing.assert_array_equal(grid, expected)
+
+
+def test_ngp_matches_histogram():
+    coords, w = random_particles(3)
+    grid = deposit_on_grid(coords, w, GRID_LIMS, GRID_SHAPE, method='ngp')
+    edges = []
+    for (g_min, g_max), n in zip(GRID_LIMS, GRID_SHAPE):
+        dx = (g_max - g_min) / (n - 1)
+        edges.append(np.linspace(g_min - dx / 2, g_max + dx / 2, n + 1))
+    expected, _ = np.histogramdd(np.stack(coords, axis=-1), bins=edges,
+                                 weights=w)
+    np.testing.assert_allclose(grid, expected, rtol=1e-12, atol=1e-12)
+
+
+def test_cic_conserves_dipole_moment():
+    # The linear weighting also conserves the (weighted) mean position.
+    coords, w = random_particles(3)
+    grid = deposit_on_grid(coords, w, GRID_LIMS, GRID_SHAPE, method='cic')
+    nodes = np.meshgrid(*[np.linspace(g_min, g_max, n) for (g_min, g_max), n
+                          in zip(GRID_LIMS, GRID_SHAPE)], indexing='ij')
+    for coord, node_coord in zip(coords, nodes):
+        np.testing.assert_allclose(np.sum(grid * node_coord),
+                                   np.sum(w * coord), rtol=1e-10)
+
+
+def test_unknown_method():
+    coords, w = random_particles(1)
+    with pytest.raises(ValueError):
+        deposit_on_grid(coords, w, GRID_LIMS[:1], GRID_SHAPE[:1],
+                        method='tsc')
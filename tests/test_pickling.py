@@ -0,0 +1,65 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the pickling and copying of data containers, fields and species.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import copy
+import pickle
+
+import numpy as np
+import pytest
+
+from visualpic import DataContainer
+from test_concurrent_reads import (
+    write_osiris_data, write_openpmd_data, TIME_STEPS)
+
+
+@pytest.fixture(scope='module', params=['osiris', 'openpmd'])
+def data_container(request, tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp(request.param))
+    if request.param == 'osiris':
+        folder = write_osiris_data(folder)
+    else:
+        folder = write_openpmd_data(folder)
+    dc = DataContainer(request.param, folder, plasma_density=1e23)
+    dc.load_data()
+    return dc
+
+
+def get_species(data_container):
+    return data_container.get_species(data_container.get_list_of_species()[0])
+
+
+def test_pickled_objects_are_cached(data_container):
+    field = data_container.get_field('Ez')
+    species = get_species(data_container)
+    new_dc = pickle.loads(pickle.dumps(data_container))
+    assert new_dc is not data_container
+    # Unpickling again in the same process gives the cached objects.
+    assert pickle.loads(pickle.dumps(data_container)) is new_dc
+    assert pickle.loads(pickle.dumps(field)) is new_dc.get_field('Ez')
+    assert pickle.loads(pickle.dumps(species)) is get_species(new_dc)
+
+
+@pytest.mark.parametrize('copy_function', [copy.copy, copy.deepcopy])
+def test_copies_are_independent(data_container, copy_function):
+    field = data_container.get_field('Ez')
+    species = get_species(data_container)
+    time_step = TIME_STEPS[1]
+    for obj in [data_container, field, species]:
+        assert copy_function(obj) is not obj
+        assert copy_function(obj) is not copy_function(obj)
+    dc_copy = copy_function(data_container)
+    field_copy = dc_copy.get_field('Ez')
+    if copy_function is copy.deepcopy:
+        assert field_copy is not field
+    np.testing.assert_array_equal(field_copy.get_data(time_step)[0],
+                                  field.get_data(time_step)[0])
+    np.testing.assert_array_equal(
+        copy_function(species).get_data(time_step, ['x'])['x'][0],
+        species.get_data(time_step, ['x'])['x'][0])
@@ -0,0 +1,117 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the sharing of field data between processes.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import os
+import time
+import signal
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from visualpic.data_handling.shared_field_cache import SharedFieldCache
+
+
+KEY = ('file.h5', 'Ez')
+
+
+def read_data(n_reads, delay):
+    """Read function which counts the number of reads."""
+    with n_reads.get_lock():
+        n_reads.value += 1
+    time.sleep(delay)
+    return np.arange(1000.).reshape(10, 100), {'units': 'V/m'}
+
+
+def get_data(cache, n_reads, delay, results, barrier=None):
+    data, metadata = cache.get(KEY, lambda: read_data(n_reads, delay))
+    results.put((data.sum(), metadata))
+    if barrier is not None:
+        # Keep the data attached until all processes got it.
+        barrier.wait(timeout=30)
+    cache.release_all()
+
+
+@pytest.fixture
+def cache():
+    cache = SharedFieldCache()
+    yield cache
+    cache.shutdown()
+
+
+@pytest.fixture
+def ctx():
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip('Requires the fork start method.')
+    return multiprocessing.get_context('fork')
+
+
+def test_data_read_only_once(cache, ctx):
+    n_reads = ctx.Value('i', 0)
+    results = ctx.Queue()
+    barrier = ctx.Barrier(2)
+    procs = [ctx.Process(target=get_data,
+                         args=(cache, n_reads, 0.5, results, barrier))
+             for _ in range(2)]
+    for proc in procs:
+        proc.start()
+    values = [results.get(timeout=30) for _ in procs]
+    for proc in procs:
+        proc.join(timeout=30)
+        assert proc.exitcode == 0
+    assert n_reads.value == 1
+    assert values == [(np.arange(1000.).sum(), {'units': 'V/m'})] * 2
+
+
+def wait_for_reading(n_reads):
+    """Wait until the data is being read (i.e., outside of the registry)."""
+    for _ in range(1000):
+        if n_reads.value > 0:
+            return
+        time.sleep(0.005)
+    raise TimeoutError
+
+
+def test_data_of_killed_process_is_read(cache, ctx):
+    n_reads = ctx.Value('i', 0)
+    proc = ctx.Process(target=get_data,
+                       args=(cache, n_reads, 60, ctx.Queue()))
+    proc.start()
+    wait_for_reading(n_reads)
+    os.kill(proc.pid, signal.SIGKILL)
+    data, metadata = cache.get(KEY, lambda: read_data(n_reads, 0))
+    proc.join(timeout=30)
+    assert n_reads.value == 2
+    np.testing.assert_array_equal(data, np.arange(1000.).reshape(10, 100))
+    assert cache._registry[KEY]['state'] == 'ready'
+
+
+def test_load_timeout(ctx):
+    cache = SharedFieldCache(load_timeout=0.2)
+    try:
+        n_reads = ctx.Value('i', 0)
+        results = ctx.Queue()
+        proc = ctx.Process(target=get_data,
+                           args=(cache, n_reads, 2, results))
+        proc.start()
+        wait_for_reading(n_reads)
+        start_time = time.time()
+        data, _ = cache.get(KEY, lambda: read_data(n_reads, 0))
+        assert time.time() - start_time < 2
+        np.testing.assert_array_equal(data, np.arange(1000.).reshape(10, 100))
+        # The process reading the data for longer than the timeout uses the
+        # published data.
+        assert results.get(timeout=30)[0] == data.sum()
+        proc.join(timeout=30)
+        assert proc.exitcode == 0
+        assert n_reads.value == 2
+        assert cache._registry[KEY]['refcount'] == 1
+    finally:
+        cache.shutdown()
@@ -0,0 +1,125 @@
+"""
+This file is part of VisualPIC.
+
+Tests of the incremental storage of time-series results and the resuming
+of interrupted beam evolution analyses.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import os
+
+import numpy as np
+import pytest
+import h5py
+
+from visualpic.analysis import beam_evolution
+from visualpic.analysis.beam_evolution import analyze_beam_evolution
+from visualpic.analysis.time_series_file import TimeSeriesFile
+from test_concurrent_reads import write_osiris_data, TIME_STEPS
+
+
+PARAMS = {'n_slices': 10, 'filter': [None, 1.5]}
+
+
+@pytest.fixture(scope='module')
+def sim_folder(tmp_path_factory):
+    return write_osiris_data(str(tmp_path_factory.mktemp('sim')))
+
+
+def run_analysis(sim_folder, save_to, **kwargs):
+    return analyze_beam_evolution(
+        sim_folder, 'osiris', 'beam', plasma_density=1e23, save_to=save_to,
+        **kwargs)
+
+
+def patch_analysis(monkeypatch, interrupt_at=None):
+    """
+    Patch the analysis of the time steps, so that it records the analyzed
+    time steps and, optionally, it is interrupted at a given time step.
+    Returns the list of analyzed time steps.
+    """
+    analyze_timestep = beam_evolution._analyze_beam_timestep
+    analyzed = []
+
+    def analysis(time_step, *args, **kwargs):
+        if time_step == interrupt_at:
+            raise KeyboardInterrupt
+        analyzed.append(time_step)
+        return analyze_timestep(time_step, *args, **kwargs)
+
+    monkeypatch.setattr(beam_evolution, '_analyze_beam_timestep', analysis)
+    return analyzed
+
+
+def test_append_and_get_data(tmp_path):
+    file_path = os.path.join(str(tmp_path), 'results.h5')
+    with TimeSeriesFile(file_path, PARAMS) as output:
+        output.append(20, {'a': 2., 'b': [1., 2., 3.]})
+        output.append(0, {'a': 0.})
+        output.append(10, None)
+    with TimeSeriesFile(file_path, PARAMS) as output:
+        np.testing.assert_array_equal(output.get_stored_timesteps(),
+                                      [0, 10, 20])
+        data = output.get_data()
+        np.testing.assert_array_equal(data['a'], [0., np.nan, 2.])
+        np.testing.assert_array_equal(
+            data['b'], [[np.nan] * 3, [np.nan] * 3, [1., 2., 3.]])
+        data = output.get_data([20, 0])
+        np.testing.assert_array_equal(data['a'], [2., 0.])
+        with pytest.raises(ValueError):
+            output.get_data([5])
+
+
+def test_resume_interrupted_analysis(sim_folder, tmp_path, monkeypatch):
+    full_folder = str(tmp_path / 'full')
+    resumed_folder = str(tmp_path / 'resumed')
+    os.makedirs(full_folder)
+    os.makedirs(resumed_folder)
+    expected = run_analysis(sim_folder, full_folder)
+
+    # Interrupt the analysis at the last time step.
+    with monkeypatch.context() as m:
+        analyzed = patch_analysis(m, interrupt_at=TIME_STEPS[-1])
+        with pytest.raises(KeyboardInterrupt):
+            run_analysis(sim_folder, resumed_folder)
+    assert analyzed == TIME_STEPS[:-1]
+    file_path = os.path.join(resumed_folder, 'beam_params.h5')
+    with h5py.File(file_path, 'r') as f:
+        np.testing.assert_array_equal(f['timestep'][()], TIME_STEPS[:-1])
+
+    # Resume. Only the missing time step is analyzed.
+    analyzed = patch_analysis(monkeypatch)
+    result = run_analysis(sim_folder, resumed_folder)
+    assert analyzed == TIME_STEPS[-1:]
+    assert result.keys() == expected.keys()
+    for key, value in expected.items():
+        np.testing.assert_array_equal(result[key], value, err_msg=key)
+
+
+def test_changed_params_raise(sim_folder, tmp_path):
+    save_to = str(tmp_path)
+    run_analysis(sim_folder, save_to, t_step_range=[0, 10])
+    with pytest.raises(ValueError, match='different parameters'):
+        run_analysis(sim_folder, save_to, n_slices=5)
+    # The existing results are kept.
+    with h5py.File(os.path.join(save_to, 'beam_params.h5'), 'r') as f:
+        np.testing.assert_array_equal(f['timestep'][()], TIME_STEPS[:2])
+    # They are overwritten if not resuming.
+    result = run_analysis(sim_folder, save_to, n_slices=5, resume=False)
+    np.testing.assert_array_equal(result['timestep'], TIME_STEPS)
+
+
+def test_legacy_file_is_overwritten(sim_folder, tmp_path):
+    # Files written before the analysis parameters were stored.
+    file_path = os.path.join(str(tmp_path), 'beam_params.h5')
+    with h5py.File(file_path, 'w') as f:
+        f.create_dataset('timestep', data=[0., 10.])
+        f.create_dataset('ene_avg', data=[1., 2.])
+    with pytest.warns(UserWarning, match='cannot be resumed'):
+        result = run_analysis(sim_folder, str(tmp_path))
+    expected = run_analysis(sim_folder, None)
+    np.testing.assert_array_equal(result['timestep'], TIME_STEPS)
+    np.testing.assert_array_equal(result['ene_avg'], expected['ene_avg'])
@@ -0,0 +1,158 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the AnalysisExecutor class, which provides a persistent
+pool of worker processes for running time-series analyses.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import math
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+from tqdm import tqdm
+
+from visualpic.data_handling.shared_field_cache import (
+    SharedFieldCache, set_shared_field_cache)
+
+
+class AnalysisExecutor():
+
+    """
+    Class providing a reusable pool of worker processes for time-series
+    analyses, such as `analyze_beam_evolution`.
+
+    The worker processes are kept alive between analyses, so that the
+    import cost of the analysis modules is paid only once. Each worker also
+    keeps its own cache of DataContainers (and therefore of data readers and
+    metadata), which is reused by all tasks concerning the same simulation.
+
+    The time steps of each batch are assigned to the workers in chunks of
+    consecutive time steps, so that consecutive data dumps are analyzed by
+    the same worker.
+
+    Optionally, the workers can share the field data they read through a
+    SharedFieldCache, so that each field array is read and kept in memory
+    only once, even if it is needed by several workers at the same time.
+
+    The executor can be used as a context manager, in which case the workers
+    are shut down on exit.
+    """
+
+    def __init__(self, n_proc=None, shared_cache=False):
+        """
+        Initialize the executor.
+
+        Parameters
+        ----------
+
+        n_proc : int
+            (Optional) Number of worker processes. If not specified, the
+            number of CPUs is used.
+
+        shared_cache : bool or SharedFieldCache
+            Whether the workers should share the field data they read in
+            shared memory. An existing SharedFieldCache can also be given, in
+            which case it is not shut down together with the executor.
+
+        """
+        if n_proc is None:
+            n_proc = cpu_count()
+        self.n_proc = n_proc
+        self.shared_cache = shared_cache
+        self._own_cache = shared_cache is True
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def map(self, function, time_steps, chunksize=None, show_progress=True,
+            **tqdm_params):
+        """
+        Apply a function to all the given time steps using the worker pool.
+        Same as `imap`, but returning a list with all results.
+        """
+        return list(self.imap(function, time_steps, chunksize=chunksize,
+                              show_progress=show_progress, **tqdm_params))
+
+    def imap(self, function, time_steps, chunksize=None, show_progress=True,
+             **tqdm_params):
+        """
+        Apply a function to all the given time steps using the worker pool.
+
+        Parameters
+        ----------
+
+        function : callable
+            Picklable function to be executed. It should take the time step as
+            its only positional argument (use `functools.partial` to fix the
+            value of any other argument).
+
+        time_steps : array or list
+            Time steps to analyze.
+
+        chunksize : int
+            (Optional) Number of consecutive time steps assigned to a worker
+            at once. If not specified, the time steps are split so that each
+            worker gets about 4 chunks.
+
+        show_progress : bool
+            Whether to show a progress bar.
+
+        **tqdm_params
+            Additional parameters passed to the progress bar.
+
+        Returns
+        -------
+        An iterator yielding the result of each time step as soon as it is
+        available, in the same order as `time_steps`.
+        """
+        time_steps = list(time_steps)
+        if chunksize is None:
+            chunksize = max(1, math.ceil(len(time_steps) / (4 * self.n_proc)))
+        results_iter = self._get_executor().map(
+            function, time_steps, chunksize=chunksize)
+        if show_progress:
+            results_iter = tqdm(results_iter, total=len(time_steps),
+                                **tqdm_params)
+        return results_iter
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Submit a single task to the worker pool.
+
+        Returns
+        -------
+        A `concurrent.futures.Future` with the result of the task.
+        """
+        return self._get_executor().submit(function, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        """Shut down the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+        if self._own_cache and isinstance(self.shared_cache,
+                                          SharedFieldCache):
+            self.shared_cache.shutdown()
+            self.shared_cache = True
+
+    def _get_executor(self):
+        """Return the process pool, starting it if needed."""
+        if self._executor is None:
+            if self.shared_cache is True:
+                self.shared_cache = SharedFieldCache()
+            if self.shared_cache:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.n_proc,
+                    initializer=set_shared_field_cache,
+                    initargs=(self.shared_cache,))
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.n_proc)
+        return self._executor
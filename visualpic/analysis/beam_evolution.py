@@ -10,17 +10,22 @@ License: GNU GPL-3.0.
 
 
 import os
+import glob
+import time
 from functools import partial
-from multiprocessing import cpu_count
+from itertools import zip_longest
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
-import h5py
-import aptools.data_analysis.beam_diagnostics as bd
 import aptools.data_processing.beam_filtering as bf
 
 from visualpic.data_handling.data_container import DataContainer
+from visualpic.analysis.analysis_executor import AnalysisExecutor
+from visualpic.analysis.time_series_file import TimeSeriesFile
+from visualpic.analysis.beam_moments import (
+    WeightedMomentAccumulator, BeamMoments, get_slice_limits)
 from visualpic.helper_functions import print_progress_bar
 
 
@@ -30,64 +35,313 @@ def analyze_beam_evolution(
         filter_min=[None, None, None, None, None, None, None],
         filter_max=[None, None, None, None, None, None, None],
         filter_sigma=[None, None, None, None, None, None, None], save_to=None,
-        saved_file_name='beam_params.h5', parallel=False, n_proc=None):
+        saved_file_name='beam_params.h5', parallel=False, n_proc=None,
+        executor=None, resume=True, chunk_size=None, adaptive=False,
+        adaptive_tol=0.01,
+        adaptive_vars=('emitt_nx', 'emitt_ny', 'ene_avg', 'q'),
+        n_initial_steps=20, max_steps=None, max_time=None):
     # Load data.
     print('Scanning simulation folder... ', end='', flush=True)
     dc = DataContainer(sim_code, sim_path, plasma_density)
     dc.load_data()
     print('Done.')
     beam = dc.get_species(species_name)
-    time_steps = beam.timesteps
-    if t_step_range is not None:
-        time_steps = time_steps[np.where((time_steps >= t_step_range[0]) &
-                                         (time_steps <= t_step_range[1]))]
+    time_steps = _select_time_steps(beam.timesteps, t_step_range)
+
+    # Open output file. The results are written as soon as each time step is
+    # analyzed, and time steps already present in the file are skipped.
+    file_path = _get_output_file_path(save_to, saved_file_name)
+    analysis_params = _get_analysis_params(
+        sim_code, species_name, plasma_density, n_slices, slice_len,
+        filter_min, filter_max, filter_sigma)
+    output = TimeSeriesFile(file_path, analysis_params, resume=resume,
+                            data_units=_get_data_units)
 
     # Analyze beam.
+    part = _get_analysis_function(
+        beam, n_slices, slice_len, filter_min, filter_max, filter_sigma,
+        chunk_size)
     tqdm_params = {'ascii': True, 'desc': 'Analyzing beam evolution... '}
-    if parallel:
-        if n_proc is None:
-            n_proc = cpu_count()
-        part = partial(
-            _analyze_beam_timestep, beam=beam, n_slices=n_slices,
-            slice_len=slice_len, filter_min=filter_min, filter_max=filter_max,
-            filter_sigma=filter_sigma)
-        ts_params = process_map(part, time_steps, max_workers=n_proc,
-                                **tqdm_params)
-    else:
-        ts_params = []
-        for i, time_step in enumerate(tqdm(time_steps, **tqdm_params)):
-            ts_params.append(
-                _analyze_beam_timestep(time_step, beam, n_slices, slice_len,
-                                       filter_min, filter_max, filter_sigma))
-
-    # Group time steps parameters into arrays.
-    var_arrays_dict = {}
-    for var in _first_true(ts_params).keys():
-        var_array = np.zeros(len(ts_params))
-        for i, ts in enumerate(ts_params):
-            if ts is not None:
-                var_array[i] = ts[var]
+    own_executor = parallel and executor is None
+    if own_executor:
+        executor = AnalysisExecutor(n_proc)
+
+    def analyze_time_steps(steps):
+        """Analyze the given time steps, skipping those already stored."""
+        pending_steps = steps[
+            np.logical_not(np.isin(steps, output.get_stored_timesteps()))]
+        if executor is not None:
+            ts_params = executor.imap(part, pending_steps, **tqdm_params)
+        else:
+            ts_params = map(part, tqdm(pending_steps, **tqdm_params))
+        for time_step, params in zip(pending_steps, ts_params):
+            output.append(time_step, params)
+        return len(pending_steps)
+
+    with output:
+        try:
+            if adaptive:
+                time_steps = _sample_time_steps_adaptively(
+                    time_steps, analyze_time_steps, output, adaptive_tol,
+                    adaptive_vars, n_initial_steps, max_steps, max_time)
             else:
-                var_array[i] = np.nan
-        var_arrays_dict[var] = var_array
+                n_analyzed = analyze_time_steps(time_steps)
+                if n_analyzed < len(time_steps):
+                    print('Skipped {} already analyzed time steps.'.format(
+                        len(time_steps) - n_analyzed))
+        finally:
+            if own_executor:
+                executor.shutdown()
 
-    print('Done.')
+        # Group time steps parameters into arrays.
+        var_arrays_dict = output.get_data(time_steps)
+        var_arrays_dict['timestep'] = time_steps
 
-    # Save to file.
-    if save_to is not None:
-        print('Saving to file... ', end='')
-        if not saved_file_name.endswith('.h5'):
-            saved_file_name += '.h5'
-        file_path = os.path.join(save_to, saved_file_name)
-        with h5py.File(file_path, 'w') as f:
-            for var, arr in var_arrays_dict.items():
-                dset = f.create_dataset(var, data=arr)
-                dset.attrs['units'] = _get_data_units(var)
-        print('Done.')
+    print('Done.')
 
     return var_arrays_dict
 
 
+def analyze_beam_evolution_batch(
+        sim_paths, sim_code, species_name, plasma_density=None,
+        t_step_range=None, n_slices=10, slice_len=None,
+        filter_min=[None, None, None, None, None, None, None],
+        filter_max=[None, None, None, None, None, None, None],
+        filter_sigma=[None, None, None, None, None, None, None], save_to=None,
+        saved_file_name='beam_params.h5', n_proc=None, executor=None,
+        resume=True, chunk_size=None, n_scan_threads=8):
+    """
+    Analyze the beam evolution of several simulations (for example, of a
+    parameter scan) at once.
+
+    The simulation folders are scanned concurrently, and the analysis of all
+    (simulation, time step) pairs is scheduled on a single pool of worker
+    processes. The tasks of the different simulations are interleaved and
+    dynamically assigned to the workers, so that a slow simulation does not
+    stall the rest of the batch. The results of each simulation are written
+    as they complete to their own group of a single HDF5 file.
+
+    Parameters
+    ----------
+
+    sim_paths : str or list
+        List of paths to the simulation folders, or a glob pattern matching
+        them (e.g. 'scan/sim_*/MS').
+
+    n_scan_threads : int
+        Number of threads used for scanning the simulation folders.
+
+    Other parameters are the same as in `analyze_beam_evolution`.
+
+    Returns
+    -------
+    A dictionary containing, for each simulation, the dictionary with the
+    evolution of the beam parameters. The keys are the paths of the
+    simulations relative to their common parent folder, which are also the
+    names of the groups in the HDF5 file.
+    """
+    if isinstance(sim_paths, str):
+        sim_paths = sorted(glob.glob(sim_paths))
+    if len(sim_paths) == 0:
+        raise ValueError('No simulation folders found.')
+    sim_keys = _get_simulation_keys(sim_paths)
+
+    # Scan all simulations concurrently.
+    print('Scanning {} simulation folders... '.format(len(sim_paths)), end='',
+          flush=True)
+
+    def load_data(sim_path):
+        dc = DataContainer(sim_code, sim_path, plasma_density)
+        dc.load_data()
+        return dc
+
+    with ThreadPoolExecutor(n_scan_threads) as scan_pool:
+        data_containers = list(scan_pool.map(load_data, sim_paths))
+    print('Done.')
+
+    file_path = _get_output_file_path(save_to, saved_file_name)
+    analysis_params = _get_analysis_params(
+        sim_code, species_name, plasma_density, n_slices, slice_len,
+        filter_min, filter_max, filter_sigma)
+    own_executor = executor is None
+    if own_executor:
+        executor = AnalysisExecutor(n_proc)
+    with ExitStack() as stack:
+        if own_executor:
+            stack.callback(executor.shutdown)
+        outputs = {}
+        sim_time_steps = {}
+        sim_tasks = []
+        for sim_key, dc in zip(sim_keys, data_containers):
+            beam = dc.get_species(species_name)
+            time_steps = _select_time_steps(beam.timesteps, t_step_range)
+            output = stack.enter_context(TimeSeriesFile(
+                file_path, analysis_params, resume=resume,
+                data_units=_get_data_units, group=sim_key))
+            part = _get_analysis_function(
+                beam, n_slices, slice_len, filter_min, filter_max,
+                filter_sigma, chunk_size)
+            pending_steps = time_steps[np.logical_not(
+                np.isin(time_steps, output.get_stored_timesteps()))]
+            outputs[sim_key] = output
+            sim_time_steps[sim_key] = time_steps
+            sim_tasks.append([(sim_key, part, ts) for ts in pending_steps])
+
+        # Interleave the tasks of all simulations and analyze them.
+        tasks = [task for tasks_group in zip_longest(*sim_tasks)
+                 for task in tasks_group if task is not None]
+        futures = {}
+        for sim_key, part, time_step in tasks:
+            futures[executor.submit(part, time_step)] = (sim_key, time_step)
+        tqdm_params = {'ascii': True, 'desc': 'Analyzing beam evolution... '}
+        for future in tqdm(as_completed(futures), total=len(futures),
+                           **tqdm_params):
+            sim_key, time_step = futures[future]
+            outputs[sim_key].append(time_step, future.result())
+
+        # Group time steps parameters into arrays.
+        sim_params = {}
+        for sim_key, output in outputs.items():
+            time_steps = sim_time_steps[sim_key]
+            sim_params[sim_key] = output.get_data(time_steps)
+            sim_params[sim_key]['timestep'] = time_steps
+
+    print('Done.')
+
+    return sim_params
+
+
+def _select_time_steps(time_steps, t_step_range):
+    """Returns the time steps within the given range."""
+    if t_step_range is not None:
+        time_steps = time_steps[np.where((time_steps >= t_step_range[0]) &
+                                         (time_steps <= t_step_range[1]))]
+    return time_steps
+
+
+def _get_output_file_path(save_to, saved_file_name):
+    """Returns the path of the output file (None if not saving to file)."""
+    if save_to is None:
+        return None
+    if not saved_file_name.endswith('.h5'):
+        saved_file_name += '.h5'
+    return os.path.join(save_to, saved_file_name)
+
+
+def _get_analysis_params(sim_code, species_name, plasma_density, n_slices,
+                         slice_len, filter_min, filter_max, filter_sigma):
+    """
+    Returns a dictionary with the parameters which determine the result of
+    the analysis. Used to check whether stored results can be reused.
+    """
+    return {
+        'sim_code': sim_code, 'species_name': species_name,
+        'plasma_density': plasma_density, 'n_slices': n_slices,
+        'slice_len': slice_len, 'filter_min': filter_min,
+        'filter_max': filter_max, 'filter_sigma': filter_sigma}
+
+
+def _get_analysis_function(beam, n_slices, slice_len, filter_min, filter_max,
+                           filter_sigma, chunk_size):
+    """
+    Returns a picklable function which analyzes the beam at the time step
+    given as its only argument.
+    """
+    if chunk_size is None:
+        analysis_function = _analyze_beam_timestep
+    else:
+        analysis_function = partial(_analyze_beam_timestep_in_chunks,
+                                    chunk_size=chunk_size)
+    return partial(
+        analysis_function, beam=beam, n_slices=n_slices, slice_len=slice_len,
+        filter_min=filter_min, filter_max=filter_max,
+        filter_sigma=filter_sigma)
+
+
+def _get_simulation_keys(sim_paths):
+    """
+    Returns a unique name for each simulation, given by its path relative to
+    the common parent folder of all simulations.
+    """
+    sim_paths = [os.path.abspath(path) for path in sim_paths]
+    if len(sim_paths) == 1:
+        return [os.path.basename(sim_paths[0])]
+    common_path = os.path.commonpath(sim_paths)
+    return [os.path.relpath(path, common_path).replace(os.sep, '/')
+            for path in sim_paths]
+
+
+def _sample_time_steps_adaptively(
+        time_steps, analyze_time_steps, output, tolerance, tracked_vars,
+        n_initial_steps, max_steps, max_time):
+    """
+    Select and analyze a subset of the time steps adaptively.
+
+    A coarse, evenly spaced subset of `n_initial_steps` is analyzed first.
+    Then, every interval between analyzed time steps in which any of the
+    `tracked_vars` changes by more than a relative `tolerance` is bisected,
+    and the process is repeated until no more refinement is needed (or
+    possible). The analysis stops early if `max_steps` time steps have been
+    analyzed or `max_time` seconds have passed, in which case the intervals
+    with the largest change are refined first.
+
+    Returns
+    -------
+    A sorted array with the analyzed time steps.
+    """
+    start_time = time.time()
+    n_steps = len(time_steps)
+    if n_steps == 0:
+        return time_steps
+    if max_steps is not None:
+        n_initial_steps = min(n_initial_steps, max_steps)
+    idx = np.unique(np.round(np.linspace(
+        0, n_steps - 1, min(n_initial_steps, n_steps))).astype(int))
+    analyze_time_steps(time_steps[idx])
+    n_analyzed = len(idx)
+    while True:
+        if max_time is not None and time.time() - start_time > max_time:
+            break
+        if max_steps is not None and n_analyzed >= max_steps:
+            break
+        # Find intervals to refine, sorted by decreasing change.
+        params = output.get_data(time_steps[idx])
+        change = np.zeros(len(idx) - 1)
+        for var in tracked_vars:
+            if var in params:
+                change = np.maximum(change, _get_relative_change(params[var]))
+        can_refine = np.diff(idx) > 1
+        to_refine = np.where(can_refine & (change > tolerance))[0]
+        if len(to_refine) == 0:
+            break
+        to_refine = to_refine[np.argsort(change[to_refine])[::-1]]
+        if max_steps is not None:
+            to_refine = to_refine[:max_steps - n_analyzed]
+        new_idx = (idx[to_refine] + idx[to_refine + 1]) // 2
+        analyze_time_steps(time_steps[np.sort(new_idx)])
+        n_analyzed += len(new_idx)
+        idx = np.sort(np.concatenate((idx, new_idx)))
+    return time_steps[idx]
+
+
+def _get_relative_change(values):
+    """
+    Returns the relative change between consecutive values of an array. A
+    change from or to NaN is considered infinite, while NaN to NaN is
+    considered as no change.
+    """
+    v_a = values[:-1]
+    v_b = values[1:]
+    scale = np.maximum(np.abs(v_a), np.abs(v_b))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.where(scale > 0, np.abs(v_b - v_a) / scale, 0.)
+    nan_a = np.isnan(v_a)
+    nan_b = np.isnan(v_b)
+    change[nan_a != nan_b] = np.inf
+    change[nan_a & nan_b] = 0.
+    return change
+
+
 def _analyze_beam_timestep(time_step, beam, n_slices, slice_len, filter_min,
                            filter_max, filter_sigma):
     data = beam.get_data(time_step, ['x', 'y', 'z', 'px', 'py', 'pz', 'q'],
@@ -117,8 +371,104 @@ def _analyze_beam_timestep(time_step, beam, n_slices, slice_len, filter_min,
             return None
 
     # Analyze beam
-    return bd.general_analysis(x, y, z, px, py, pz, q, n_slices=n_slices,
-                               len_slice=slice_len)
+    slice_lims = get_slice_limits(np.min(z), np.max(z), n_slices, slice_len)
+    beam_moments = BeamMoments(slice_lims)
+    beam_moments.add(x, y, z, px, py, pz, q)
+    return beam_moments.get_beam_params()
+
+
+def _analyze_beam_timestep_in_chunks(
+        time_step, beam, n_slices, slice_len, filter_min, filter_max,
+        filter_sigma, chunk_size):
+    """
+    Analyze the beam by streaming its data in chunks of `chunk_size`
+    particles, so that the full species never needs to be in memory. The
+    result is equivalent to that of `_analyze_beam_timestep`.
+
+    The data is read twice: first only the longitudinal position (and any
+    filtered component) to determine the slice limits, and then all
+    components to accumulate the weighted moments of the full beam and of
+    each slice. If `filter_sigma` is used, an additional pass is needed to
+    determine the mean and rms width of the filtered components.
+    """
+    comps = ['x', 'y', 'z', 'px', 'py', 'pz', 'q']
+    filter_min = list(filter_min)
+    filter_max = list(filter_max)
+
+    # Convert sigma filters into range filters.
+    if any(el is not None for el in filter_sigma):
+        sigma_comps = [comp for comp, n_sigma in zip(comps, filter_sigma)
+                       if n_sigma is not None]
+        # As in `filter_beam_sigma`, the mean is weighted by the charge and
+        # the rms width by its absolute value.
+        acc_mean = WeightedMomentAccumulator(sigma_comps, covariances=[])
+        acc_std = WeightedMomentAccumulator(
+            sigma_comps, covariances=[(comp, comp) for comp in sigma_comps])
+        for data in _read_filtered_chunks(
+                beam, time_step, sigma_comps + ['q'], filter_min, filter_max,
+                chunk_size):
+            acc_mean.add(data, data['q'])
+            acc_std.add(data, np.abs(data['q']))
+        if np.sum(acc_std.count) <= 1:
+            return None
+        for i, n_sigma in enumerate(filter_sigma):
+            if n_sigma is not None:
+                comp_avg = acc_mean.get_mean(comps[i])[0]
+                comp_std = acc_std.get_std(comps[i])[0]
+                comp_min = comp_avg - n_sigma * comp_std
+                comp_max = comp_avg + n_sigma * comp_std
+                if filter_min[i] is not None:
+                    comp_min = max(comp_min, filter_min[i])
+                if filter_max[i] is not None:
+                    comp_max = min(comp_max, filter_max[i])
+                filter_min[i] = comp_min
+                filter_max[i] = comp_max
+
+    # Determine longitudinal extent of the beam and the slices.
+    z_min = np.inf
+    z_max = -np.inf
+    n_part = 0
+    for data in _read_filtered_chunks(beam, time_step, ['z'], filter_min,
+                                      filter_max, chunk_size):
+        if len(data['z']) > 0:
+            z_min = min(z_min, np.min(data['z']))
+            z_max = max(z_max, np.max(data['z']))
+            n_part += len(data['z'])
+    if n_part <= 1:
+        return None
+    slice_lims = get_slice_limits(z_min, z_max, n_slices, slice_len)
+
+    # Accumulate moments.
+    beam_moments = BeamMoments(slice_lims)
+    for data in _read_filtered_chunks(beam, time_step, comps, filter_min,
+                                      filter_max, chunk_size):
+        beam_moments.add(*[data[comp] for comp in comps])
+    return beam_moments.get_beam_params()
+
+
+def _read_filtered_chunks(beam, time_step, comps, filter_min, filter_max,
+                          chunk_size):
+    """
+    Iterate over the beam data in chunks, keeping only the particles within
+    the given ranges. The filters are given, as in `filter_beam`, for the
+    components ['x', 'y', 'z', 'px', 'py', 'pz', 'q'].
+    """
+    filter_comps = ['x', 'y', 'z', 'px', 'py', 'pz', 'q']
+    comps_to_read = list(comps)
+    for comp, f_min, f_max in zip(filter_comps, filter_min, filter_max):
+        if (f_min is not None or f_max is not None) and (
+                comp not in comps_to_read):
+            comps_to_read.append(comp)
+    for data in beam.iterate_data_chunks(time_step, comps_to_read,
+                                         chunk_size, data_units='SI'):
+        data = {comp: data[comp][0] for comp in comps_to_read}
+        keep = np.ones(len(data[comps_to_read[0]]), dtype=bool)
+        for comp, f_min, f_max in zip(filter_comps, filter_min, filter_max):
+            if f_min is not None:
+                keep &= data[comp] >= f_min
+            if f_max is not None:
+                keep &= data[comp] <= f_max
+        yield {comp: data[comp][keep] for comp in comps}
 
 
 def _get_data_units(var):
@@ -148,24 +498,15 @@ def _get_data_units(var):
         'rel_ene_sp': '',
         'rel_ene_sp_sl': '',
         'i_peak': 'A',
-        'q': 'C'
+        'q': 'C',
+        'slice_z': 'm',
+        'slice_current': 'A',
+        'slice_emitt_nx': 'm',
+        'slice_emitt_ny': 'm',
+        'slice_rel_ene_sp': ''
     }
     if var in units_dict:
         return units_dict[var]
     else:
         return ''
 
-
-def _first_true(iterable, default=False, pred=None):
-    """Returns the first true value in the iterable.
-
-    If no true value is found, returns *default*
-
-    If *pred* is not None, returns the first item
-    for which pred(item) is true.
-
-    From https://docs.python.org/3/library/itertools.html#itertools-recipes.
-
-    """
-    return next(filter(pred, iterable), default)
-
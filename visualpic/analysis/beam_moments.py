@@ -0,0 +1,357 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the WeightedMomentAccumulator class, which computes
+weighted means and covariances of particle data in a streaming fashion, and
+the BeamMoments class, which uses it to compute the (slice) parameters of a
+particle beam.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+from itertools import combinations_with_replacement
+
+import numpy as np
+import scipy.constants as ct
+import aptools.data_analysis.beam_diagnostics as bd
+
+
+class WeightedMomentAccumulator():
+
+    """
+    Class accumulating the weighted first and second moments (means and
+    covariances) of a set of variables from successive chunks of particles.
+
+    The moments of each chunk are computed with a two-pass algorithm and then
+    merged with the accumulated ones using the pairwise update of Chan et al.
+    (a generalization of Welford's algorithm). This avoids the catastrophic
+    cancellation of the naive sum-of-squares approach, so that the result
+    does not depend on how the data is split into chunks.
+
+    The particles can optionally be assigned to groups (for example,
+    longitudinal slices), in which case the moments of all groups are
+    accumulated at once.
+
+    The weights can be negative (e.g., the particle charge), in which case
+    the moments are defined as in `np.average(..., weights=w)`.
+    """
+
+    def __init__(self, variables, n_groups=1, covariances=None):
+        """
+        Initialize the accumulator.
+
+        Parameters
+        ----------
+
+        variables : list
+            List of strings with the names of the variables.
+
+        n_groups : int
+            Number of groups into which the particles are classified.
+
+        covariances : list
+            (Optional) List with the pairs of variables (tuples) whose
+            covariance is accumulated. If not specified, the covariances of
+            all pairs are accumulated.
+
+        """
+        self.variables = list(variables)
+        self.n_groups = n_groups
+        if covariances is None:
+            covariances = combinations_with_replacement(self.variables, 2)
+        self.count = np.zeros(n_groups, dtype=np.int64)
+        self.sum_w = np.zeros(n_groups)
+        self.sum_w2 = np.zeros(n_groups)
+        self._mean = {var: np.zeros(n_groups) for var in self.variables}
+        self._comoment = {tuple(pair): np.zeros(n_groups) for pair in
+                          covariances}
+
+    def add(self, data, w, groups=None):
+        """
+        Add a chunk of particles to the accumulated moments.
+
+        Parameters
+        ----------
+
+        data : dict
+            Dictionary containing an array with the values of each variable.
+
+        w : array
+            Statistical weights of the particles.
+
+        groups : array
+            (Optional) Array of integers with the group of each particle.
+            Particles with a group outside of [0, n_groups) are ignored. Not
+            needed if n_groups=1.
+
+        """
+        w = np.asarray(w, dtype=np.float64)
+        if groups is None:
+            groups = np.zeros(len(w), dtype=np.int64)
+        else:
+            in_range = (groups >= 0) & (groups < self.n_groups)
+            if not np.all(in_range):
+                groups = groups[in_range]
+                w = w[in_range]
+                data = {var: data[var][in_range] for var in self.variables}
+        n = self.n_groups
+        count_b = np.bincount(groups, minlength=n)
+        w_b = np.bincount(groups, weights=w, minlength=n)
+        w2_b = np.bincount(groups, weights=w**2, minlength=n)
+        mean_b = {}
+        diff_b = {}
+        for var in self.variables:
+            mean_b[var] = _divide(
+                np.bincount(groups, weights=w*data[var], minlength=n), w_b)
+            diff_b[var] = data[var] - mean_b[var][groups]
+        comoment_b = {}
+        for var_1, var_2 in self._comoment:
+            comoment_b[(var_1, var_2)] = np.bincount(
+                groups, weights=w*diff_b[var_1]*diff_b[var_2], minlength=n)
+
+        # Merge with the accumulated moments.
+        w_a = self.sum_w
+        w_tot = w_a + w_b
+        delta = {var: mean_b[var] - self._mean[var] for var in self.variables}
+        for var_1, var_2 in self._comoment:
+            self._comoment[(var_1, var_2)] += (
+                comoment_b[(var_1, var_2)] +
+                delta[var_1] * delta[var_2] * _divide(w_a * w_b, w_tot))
+        for var in self.variables:
+            self._mean[var] += delta[var] * _divide(w_b, w_tot)
+        self.count += count_b
+        self.sum_w = w_tot
+        self.sum_w2 += w2_b
+
+    def get_mean(self, var):
+        """
+        Returns the weighted mean of a variable in each group (NaN for empty
+        groups or those with zero total weight).
+        """
+        return np.where(self.sum_w != 0, self._mean[var], np.nan)
+
+    def get_covariance(self, var_1, var_2, ddof=0):
+        """
+        Returns the weighted covariance of two variables in each group.
+
+        Parameters
+        ----------
+
+        var_1, var_2 : str
+            Names of the variables.
+
+        ddof : int
+            If 0, the covariance is normalized by the sum of weights. If 1,
+            the unbiased estimate for frequency-independent weights is
+            returned, as in `np.cov(..., aweights=w)`.
+
+        """
+        if (var_1, var_2) in self._comoment:
+            comoment = self._comoment[(var_1, var_2)]
+        else:
+            comoment = self._comoment[(var_2, var_1)]
+        norm = self.sum_w - ddof * _divide(self.sum_w2, self.sum_w)
+        return np.divide(comoment, norm, out=np.full(self.n_groups, np.nan),
+                         where=norm != 0)
+
+    def get_std(self, var):
+        """Returns the weighted standard deviation of a variable."""
+        return np.sqrt(self.get_covariance(var, var))
+
+
+class BeamMoments():
+
+    """
+    Class computing the parameters of a particle beam, as well as the slice
+    parameters, from the accumulated moments of the particle distribution.
+
+    All slices are analyzed at once: each particle is assigned to its slice
+    with a single `np.searchsorted` call and the moments of all slices are
+    computed with `np.bincount`. The particles can be added at once or in
+    successive chunks.
+
+    The parameters follow the same definitions as `general_analysis` in
+    APtools. In particular, the mean values (and the Twiss parameters) are
+    weighted by the particle charge, while the rms widths and emittances are
+    weighted by its absolute value.
+    """
+
+    def __init__(self, slice_lims):
+        """
+        Initialize the beam moments.
+
+        Parameters
+        ----------
+
+        slice_lims : array
+            Array with the limits of the longitudinal slices. The particles
+            in slice i fulfill slice_lims[i] < z <= slice_lims[i+1]. They
+            should span the full longitudinal extent of the beam.
+
+        """
+        self.slice_lims = slice_lims
+        self.n_slices = len(slice_lims) - 1
+        variables = ['x', 'y', 'z', 'px', 'py', 'xp', 'yp', 'gamma']
+        emittance_pairs = [('x', 'px'), ('y', 'py')]
+        self._acc = WeightedMomentAccumulator(
+            variables, covariances=_get_covariance_pairs(
+                emittance_pairs + [('x', 'xp'), ('y', 'yp')]) +
+            [('z', 'z'), ('gamma', 'gamma')])
+        self._acc_q = WeightedMomentAccumulator(
+            variables, covariances=[('x', 'x'), ('x', 'xp'), ('y', 'y'),
+                                    ('y', 'yp')])
+        self._acc_unweighted = WeightedMomentAccumulator(
+            ['xp', 'yp'], covariances=[('xp', 'xp'), ('yp', 'yp')])
+        self._slice_acc = WeightedMomentAccumulator(
+            ['x', 'px', 'y', 'py', 'gamma'], n_groups=self.n_slices,
+            covariances=_get_covariance_pairs(emittance_pairs) +
+            [('gamma', 'gamma')])
+        self._slice_acc_q = WeightedMomentAccumulator(
+            ['gamma'], n_groups=self.n_slices, covariances=[])
+        self._charge_hist = np.zeros(self.n_slices)
+        self._q_tot = 0.
+
+    def add(self, x, y, z, px, py, pz, q):
+        """
+        Add particles to the beam moments. Positions should be in metres,
+        momenta in units of m_e*c and charge in Coulomb.
+        """
+        data = {'x': x, 'y': y, 'z': z, 'px': px, 'py': py}
+        data['gamma'] = np.sqrt(1 + px**2 + py**2 + pz**2)
+        data['xp'] = px / pz
+        data['yp'] = py / pz
+        w = np.abs(q)
+        self._acc.add(data, w)
+        self._acc_q.add(data, q)
+        self._acc_unweighted.add(data, np.ones_like(w))
+        slice_idx = np.searchsorted(self.slice_lims, z, side='left') - 1
+        self._slice_acc.add(data, w, groups=slice_idx)
+        self._slice_acc_q.add(data, q, groups=slice_idx)
+        self._charge_hist += np.histogram(
+            z, bins=self.n_slices,
+            range=(self.slice_lims[0], self.slice_lims[-1]), weights=q)[0]
+        self._q_tot += np.sum(q)
+
+    def get_beam_params(self):
+        """
+        Returns a dictionary with the beam parameters. Besides the parameters
+        of `general_analysis` in APtools, it also contains the position
+        ('slice_z'), current ('slice_current'), normalized emittance
+        ('slice_emitt_nx', 'slice_emitt_ny') and relative energy spread
+        ('slice_rel_ene_sp') of each slice.
+        """
+        acc = self._acc
+        acc_q = self._acc_q
+        ene = acc_q.get_mean('gamma')[0]
+        params = {}
+        params['x_avg'] = acc_q.get_mean('x')[0]
+        params['y_avg'] = acc_q.get_mean('y')[0]
+        params['z_avg'] = acc_q.get_mean('z')[0]
+        params['theta_x'] = acc_q.get_mean('px')[0] / ene
+        params['theta_y'] = acc_q.get_mean('py')[0] / ene
+        params['sigma_x'] = acc.get_std('x')[0]
+        params['sigma_y'] = acc.get_std('y')[0]
+        params['sigma_z'] = acc.get_std('z')[0]
+
+        # Current profile.
+        sl_len = self.slice_lims[1] - self.slice_lims[0]
+        current_prof = np.abs(self._charge_hist / (sl_len / ct.c))
+        slice_pos = self.slice_lims[1:] - abs(sl_len) / 2
+        i_peak = np.max(current_prof)
+        slices_in_fwhm = slice_pos[np.where(current_prof >= i_peak / 2)]
+        params['z_fwhm'] = np.max(slices_in_fwhm) - np.min(slices_in_fwhm)
+
+        params['sigma_px'] = self._acc_unweighted.get_std('xp')[0]
+        params['sigma_py'] = self._acc_unweighted.get_std('yp')[0]
+        for u in ['x', 'y']:
+            # Twiss parameters (from the trace-space emittance).
+            em_tr = _rms_emittance(acc, u, u + 'p')[0]
+            b_u = acc_q.get_covariance(u, u)[0] / em_tr
+            a_u = -acc_q.get_covariance(u, u + 'p')[0] / em_tr
+            params['alpha_' + u] = a_u
+            params['beta_' + u] = b_u
+            params['gamma_' + u] = (1 + a_u**2) / b_u
+        params['emitt_nx'] = _rms_emittance(acc, 'x', 'px')[0]
+        params['emitt_ny'] = _rms_emittance(acc, 'y', 'py')[0]
+
+        # Slice parameters.
+        slice_acc = self._slice_acc
+        slice_weights = self._slice_acc_q.sum_w
+        single_particle = slice_acc.count <= 1
+        slice_em = {}
+        for u in ['x', 'y']:
+            slice_em[u] = _rms_emittance(slice_acc, u, 'p' + u)
+            slice_em[u][single_particle] = 0
+            params['emitt_n{}_sl'.format(u)] = bd.calculate_slice_average(
+                slice_em[u], slice_weights)
+        slice_ene_sp = (slice_acc.get_std('gamma') /
+                        self._slice_acc_q.get_mean('gamma'))
+        slice_ene_sp[single_particle] = 0
+        params['ene_avg'] = ene
+        params['rel_ene_sp'] = acc.get_std('gamma')[0] / ene
+        params['rel_ene_sp_sl'] = bd.calculate_slice_average(
+            slice_ene_sp, slice_weights)
+        params['i_peak'] = i_peak
+        params['q'] = self._q_tot
+
+        # Slice profiles (NaN for empty slices).
+        empty = slice_acc.count == 0
+        params['slice_z'] = slice_pos
+        params['slice_current'] = current_prof
+        params['slice_emitt_nx'] = np.where(empty, np.nan, slice_em['x'])
+        params['slice_emitt_ny'] = np.where(empty, np.nan, slice_em['y'])
+        params['slice_rel_ene_sp'] = np.where(empty, np.nan, slice_ene_sp)
+        return params
+
+
+def get_slice_limits(z_min, z_max, n_slices=10, slice_len=None):
+    """
+    Returns the limits of the longitudinal slices of a beam, as in
+    `create_beam_slices` of APtools.
+
+    Parameters
+    ----------
+
+    z_min, z_max : float
+        Longitudinal extent of the beam.
+
+    n_slices : int
+        Number of slices. Not used if `slice_len` is given.
+
+    slice_len : float
+        (Optional) Length of the slices.
+
+    """
+    if slice_len is not None:
+        n_slices = int(np.round((z_max - z_min) / slice_len))
+    return np.linspace(z_min, z_max, n_slices + 1)
+
+
+def _get_covariance_pairs(pairs):
+    """
+    Returns the pairs of variables whose covariances are needed for the rms
+    emittance of the given pairs.
+    """
+    return [cov_pair for var_1, var_2 in pairs for cov_pair in
+            [(var_1, var_1), (var_1, var_2), (var_2, var_2)]]
+
+
+def _rms_emittance(acc, var_1, var_2):
+    """
+    Calculate the rms emittance of the given variables in each group of a
+    WeightedMomentAccumulator. The covariance matrix is computed as with
+    `np.cov(..., aweights=w)` and its determinant in single precision, as in
+    APtools.
+    """
+    cov = np.empty((acc.n_groups, 2, 2))
+    cov[:, 0, 0] = acc.get_covariance(var_1, var_1, ddof=1)
+    cov[:, 0, 1] = cov[:, 1, 0] = acc.get_covariance(var_1, var_2, ddof=1)
+    cov[:, 1, 1] = acc.get_covariance(var_2, var_2, ddof=1)
+    return np.sqrt(np.linalg.det(cov.astype(np.float32, copy=False)))
+
+
+def _divide(a, b):
+    """Element-wise division returning 0 where the divisor is 0."""
+    return np.divide(a, b, out=np.zeros(np.shape(a)), where=b != 0)
@@ -0,0 +1,353 @@
+"""
+This file is part of VisualPIC.
+
+The module contains methods for computing the evolution of particle
+histograms (such as phase spaces or energy spectra) within the simulation.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+from functools import partial
+
+import numpy as np
+from tqdm import tqdm
+
+from visualpic.analysis.analysis_executor import AnalysisExecutor
+
+
+class HistogramAccumulator():
+
+    """
+    Class accumulating a weighted N-dimensional histogram from successive
+    chunks of particles.
+
+    The bin index of each particle along each dimension is computed directly
+    (for uniform bins) or with `np.searchsorted` (for non-uniform bins), and
+    the flattened indices are accumulated with a single `np.bincount` call.
+    As in `np.histogramdd`, the last bin of each dimension includes its right
+    edge and particles outside of the histogram range are ignored.
+    """
+
+    def __init__(self, bins, ranges=None):
+        """
+        Initialize the histogram.
+
+        Parameters
+        ----------
+
+        bins : list
+            List with the bins of each dimension. Each element can be an
+            integer (number of uniform bins within the corresponding range)
+            or an array with the bin edges.
+
+        ranges : list
+            (Optional) List with the (min, max) range of each dimension.
+            Only needed for the dimensions in which `bins` is an integer.
+
+        """
+        if ranges is None:
+            ranges = [None] * len(bins)
+        self.bin_edges = []
+        self._uniform = []
+        for dim_bins, dim_range in zip(bins, ranges):
+            if np.ndim(dim_bins) == 0:
+                if dim_range is None:
+                    raise ValueError(
+                        'A range is needed for histogram dimensions '
+                        'given as a number of bins.')
+                edges = np.linspace(dim_range[0], dim_range[1], dim_bins + 1)
+                self._uniform.append(True)
+            else:
+                edges = np.asarray(dim_bins, dtype=float)
+                self._uniform.append(False)
+            if len(edges) < 2 or np.any(np.diff(edges) <= 0):
+                raise ValueError(
+                    'Histogram bin edges must be monotonically increasing.')
+            self.bin_edges.append(edges)
+        self.shape = tuple(len(edges) - 1 for edges in self.bin_edges)
+        self._hist = np.zeros(int(np.prod(self.shape)))
+
+    def add(self, data, w=None):
+        """
+        Add a chunk of particles to the histogram.
+
+        Parameters
+        ----------
+
+        data : list
+            List with an array of the particle values along each dimension.
+
+        w : array
+            (Optional) Statistical weights of the particles. If not given,
+            all particles have unit weight.
+
+        """
+        in_range = np.ones(len(data[0]), dtype=bool)
+        indices = []
+        for values, edges, uniform in zip(data, self.bin_edges,
+                                          self._uniform):
+            n_bins = len(edges) - 1
+            in_range &= (values >= edges[0]) & (values <= edges[-1])
+            if uniform:
+                norm = n_bins / (edges[-1] - edges[0])
+                idx = np.clip(((values - edges[0]) * norm).astype(np.int64),
+                              0, n_bins - 1)
+                # Correct for rounding errors, as in `np.histogram`.
+                idx -= values < edges[idx]
+                idx += (values >= edges[idx + 1]) & (idx < n_bins - 1)
+            else:
+                idx = np.clip(
+                    np.searchsorted(edges, values, side='right') - 1,
+                    0, n_bins - 1)
+            indices.append(idx)
+        if not np.all(in_range):
+            indices = [idx[in_range] for idx in indices]
+            if w is not None:
+                w = w[in_range]
+        flat_idx = np.ravel_multi_index(indices, self.shape)
+        self._hist += np.bincount(flat_idx, weights=w,
+                                  minlength=len(self._hist))
+
+    def get_histogram(self):
+        """Returns the accumulated histogram."""
+        return self._hist.reshape(self.shape)
+
+
+def get_histogram_evolution(
+        species, components, bins=100, ranges=None, time_steps=None,
+        weights='q', data_units=None, time_units=None, chunk_size=None,
+        parallel=False, n_proc=None, executor=None):
+    """
+    Compute the evolution of a weighted histogram of a particle species, such
+    as a phase space (e.g. ['z', 'pz']) or an energy spectrum (e.g.
+    ['ekin']).
+
+    The histogram of each time step is computed by a HistogramAccumulator.
+    If `chunk_size` is given, the data is streamed in chunks of particles, so
+    that the full species never needs to be in memory. The time steps can be
+    processed in parallel.
+
+    Parameters
+    ----------
+
+    species : ParticleSpecies
+        The particle species.
+
+    components : list
+        List with the names of the 1, 2 or 3 components of the histogram.
+        Derived components are also supported.
+
+    bins : int or list
+        Number of bins (or array of bin edges) of all dimensions, or a list
+        with the bins of each dimension.
+
+    ranges : list
+        (Optional) List with the (min, max) range of each dimension. The
+        dimensions whose range is not specified (or None) span the full
+        extent of the data over all time steps, which requires an
+        additional pass over the data.
+
+    time_steps : array
+        (Optional) Time steps to process. If not specified, all available
+        time steps are used.
+
+    weights : str
+        Name of the component used as weight (absolute value). If None, all
+        particles have unit weight.
+
+    data_units : list or str
+        (Optional) Units of the histogram components, as in
+        `ParticleSpecies.get_data`.
+
+    time_units : str
+        (Optional) Units of the returned time array.
+
+    chunk_size : int
+        (Optional) Maximum number of particles read at once.
+
+    parallel : bool
+        Whether to process the time steps in parallel processes.
+
+    n_proc : int
+        (Optional) Number of processes used if `parallel=True`.
+
+    executor : AnalysisExecutor
+        (Optional) A persistent executor in which to process the time steps.
+        If given, `parallel` and `n_proc` are ignored.
+
+    Returns
+    -------
+    A tuple with the histogram 'waterfall' and its metadata. The histogram
+    array has one dimension per component plus a last dimension corresponding
+    to the time step. The metadata contains the time steps, the time, the bin
+    edges and units of each component and the units of the weights.
+    """
+    n_dims = len(components)
+    if n_dims not in [1, 2, 3]:
+        raise ValueError('Histograms must have 1, 2 or 3 dimensions.')
+    if time_steps is None:
+        time_steps = species.timesteps
+    if np.ndim(bins) == 0 or (n_dims == 1 and np.ndim(bins) == 1 and
+                              np.ndim(bins[0]) == 0 and len(bins) > 1):
+        bins = [bins] * n_dims
+    if ranges is None:
+        ranges = [None] * n_dims
+    if isinstance(data_units, str) or data_units is None:
+        data_units = [data_units] * n_dims
+    read_params = {
+        'species': species, 'components': components, 'weights': weights,
+        'data_units': data_units, 'time_units': time_units,
+        'chunk_size': chunk_size}
+
+    own_executor = parallel and executor is None
+    if own_executor:
+        executor = AnalysisExecutor(n_proc)
+    try:
+        # Determine the missing ranges from the statistics index of the
+        # species or, if not available, from the data.
+        missing = [i for i in range(n_dims)
+                   if np.ndim(bins[i]) == 0 and ranges[i] is None]
+        found_ranges = {}
+        for i in missing:
+            r = _get_indexed_range(species, components[i], data_units[i],
+                                   time_steps)
+            if r is not None:
+                found_ranges[i] = r
+        to_read = [i for i in missing if i not in found_ranges]
+        if len(to_read) > 0:
+            params = dict(read_params)
+            params['components'] = [components[i] for i in to_read]
+            params['data_units'] = [data_units[i] for i in to_read]
+            part = partial(_get_data_range_timestep, **params)
+            ts_ranges = _map_time_steps(
+                part, time_steps, executor,
+                'Determining histogram range... ')
+            ts_ranges = np.array(ts_ranges).reshape(-1, len(to_read), 2)
+            for j, i in enumerate(to_read):
+                found_ranges[i] = (np.nanmin(ts_ranges[:, j, 0]),
+                                   np.nanmax(ts_ranges[:, j, 1]))
+        if len(missing) > 0:
+            ranges = list(ranges)
+            for i in missing:
+                r_min, r_max = found_ranges[i]
+                if not np.isfinite(r_min):
+                    raise ValueError(
+                        "No data found for component '{}'.".format(
+                            components[i]))
+                if r_min == r_max:
+                    r_min, r_max = r_min - 0.5, r_max + 0.5
+                ranges[i] = (r_min, r_max)
+
+        # Compute histograms.
+        accumulator = HistogramAccumulator(bins, ranges)
+        part = partial(_histogram_timestep, bins=accumulator.bin_edges,
+                       **read_params)
+        results = _map_time_steps(part, time_steps, executor,
+                                  'Computing histograms... ')
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    hist = np.stack([r[0] for r in results], axis=-1)
+    md = {}
+    md['time_steps'] = np.asarray(time_steps)
+    md['time'] = {'array': np.array([r[1] for r in results]),
+                  'units': results[0][2] if results else None}
+    md['bin_edges'] = accumulator.bin_edges
+    md['units'] = results[0][3] if results else data_units
+    md['weight_units'] = results[0][4] if results else None
+    return hist, md
+
+
+def _map_time_steps(function, time_steps, executor, desc):
+    """Apply a function to all time steps, serially or in the executor."""
+    tqdm_params = {'ascii': True, 'desc': desc}
+    if executor is not None:
+        return executor.map(function, time_steps, **tqdm_params)
+    return list(map(function, tqdm(time_steps, **tqdm_params)))
+
+
+def _get_indexed_range(species, component, data_units, time_steps):
+    """
+    Returns the (min, max) range of a component over all time steps from the
+    statistics index of the species, or None if not available. The index is
+    only used for data in its original units.
+    """
+    if data_units is not None or species.statistics_index is None:
+        return None
+    return species.statistics_index.get_global_range(
+        species, time_steps=time_steps, component=component)
+
+
+def _iterate_data(species, time_step, components, weights, data_units,
+                  time_units, chunk_size):
+    """
+    Iterate over the species data (components and weights), either at once
+    or in chunks of particles.
+    """
+    comps = list(components)
+    units = list(data_units)
+    if weights is not None:
+        comps.append(weights)
+        units.append(None)
+    if all(unit is None for unit in units):
+        units = None
+    if chunk_size is None:
+        yield species.get_data(time_step, comps, data_units=units,
+                               time_units=time_units)
+    else:
+        n_chunks = 0
+        for data in species.iterate_data_chunks(
+                time_step, comps, chunk_size, data_units=units,
+                time_units=time_units):
+            n_chunks += 1
+            yield data
+        if n_chunks == 0:
+            yield species.get_data(time_step, comps, data_units=units,
+                                   time_units=time_units,
+                                   particle_range=slice(0, 0))
+
+
+def _get_data_range_timestep(time_step, species, components, weights,
+                             data_units, time_units, chunk_size):
+    """
+    Returns the (min, max) range of each component at a time step (NaN if
+    there are no particles).
+    """
+    ranges = np.full((len(components), 2), np.nan)
+    for data in _iterate_data(species, time_step, components, None,
+                              data_units, time_units, chunk_size):
+        for i, comp in enumerate(components):
+            values = data[comp][0]
+            if len(values) > 0:
+                ranges[i, 0] = np.fmin(ranges[i, 0], np.min(values))
+                ranges[i, 1] = np.fmax(ranges[i, 1], np.max(values))
+    return ranges
+
+
+def _histogram_timestep(time_step, species, components, bins, weights,
+                        data_units, time_units, chunk_size):
+    """
+    Compute the histogram at a single time step.
+
+    Returns
+    -------
+    A tuple with the histogram, the time, the time units, the units of each
+    component and the units of the weights.
+    """
+    accumulator = HistogramAccumulator(bins)
+    for data in _iterate_data(species, time_step, components, weights,
+                              data_units, time_units, chunk_size):
+        w = None
+        if weights is not None:
+            w = np.abs(data[weights][0])
+        accumulator.add([data[comp][0] for comp in components], w)
+    time_md = data[components[0]][1]['time']
+    comp_units = [data[comp][1]['units'] for comp in components]
+    weight_units = None
+    if weights is not None:
+        weight_units = data[weights][1]['units']
+    return (accumulator.get_histogram(), time_md['value'], time_md['units'],
+            comp_units, weight_units)
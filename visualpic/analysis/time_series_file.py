@@ -0,0 +1,218 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the TimeSeriesFile class, used for storing the results of
+time-series analyses incrementally in an HDF5 file.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import io
+import os
+import json
+import warnings
+
+import numpy as np
+import h5py
+
+
+class TimeSeriesFile():
+
+    """
+    Class storing the results of a time-series analysis in an appendable HDF5
+    file.
+
+    The results of each time step are written (and flushed to disk) as soon
+    as they are appended, so that no results are lost if the analysis is
+    interrupted. The parameters of the analysis are stored as an attribute of
+    the file, which allows resuming the analysis only if the parameters
+    match.
+
+    Each scalar variable is stored as a 1D dataset, with the corresponding
+    time steps stored in the 'timestep' dataset. Array variables (such as
+    slice profiles) are stored as 2D (time step x element) datasets, whose
+    width grows as needed. Time steps (or elements) without results are
+    stored as NaN. The datasets are sorted by time step when the file is
+    closed.
+
+    Several analyses (for example, of different simulations) can be stored in
+    the same file by giving each of them its own group.
+    """
+
+    def __init__(self, file_path, analysis_params=None, resume=True,
+                 data_units=None, group=None):
+        """
+        Open or create the file.
+
+        Parameters
+        ----------
+
+        file_path : str
+            Path to the HDF5 file. If None, the results are only kept in
+            memory.
+
+        analysis_params : dict
+            (Optional) Dictionary with the parameters of the analysis. Should
+            be serializable to JSON.
+
+        resume : bool
+            If True and the file already exists, the new results are appended
+            to the existing ones, as long as the analysis parameters match. If
+            False, any existing file is overwritten.
+
+        data_units : callable
+            (Optional) Function returning the units of a variable given its
+            name. The units are stored as an attribute of each dataset.
+
+        group : str
+            (Optional) Name of the group in which to store the results. If
+            specified, the rest of the file is left untouched (also when
+            `resume=False`).
+
+        """
+        self.file_path = file_path
+        self.analysis_params = json.dumps(
+            analysis_params, sort_keys=True, default=_to_json)
+        self.data_units = data_units
+        if file_path is None:
+            self._file = h5py.File(io.BytesIO(), 'w')
+        elif group is not None or (resume and os.path.exists(file_path)):
+            self._file = h5py.File(file_path, 'a')
+        else:
+            self._file = h5py.File(file_path, 'w')
+        if group is None:
+            self._group = self._file
+        else:
+            if not resume and group in self._file:
+                del self._file[group]
+            self._group = self._file.require_group(group)
+        stored_params = self._group.attrs.get('analysis_params', None)
+        if len(self._group) > 0 and stored_params is None:
+            # Legacy files (written before the analysis parameters were
+            # stored) cannot be resumed and are overwritten.
+            warnings.warn(
+                "File '{}' does not contain the ".format(file_path) +
+                'parameters of the stored results and cannot be resumed. '
+                'Overwriting.')
+            for key in list(self._group):
+                del self._group[key]
+        elif len(self._group) > 0 and stored_params != self.analysis_params:
+            self._file.close()
+            raise ValueError(
+                "File '{}' contains the results of ".format(file_path) +
+                "an analysis with different parameters. Use " +
+                "'resume=False' to overwrite it or choose another file.")
+        self._group.attrs['analysis_params'] = self.analysis_params
+        if 'timestep' not in self._group:
+            self._group.create_dataset(
+                'timestep', shape=(0,), maxshape=(None,), dtype='f8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_stored_timesteps(self):
+        """Returns an array with the time steps already stored."""
+        return self._group['timestep'][:]
+
+    def append(self, time_step, data):
+        """
+        Append the results of a time step and write them to disk.
+
+        Parameters
+        ----------
+
+        time_step : int
+            The time step of the results.
+
+        data : dict
+            Dictionary with the value (scalar or 1D array) of each variable
+            at this time step. If None, all variables are stored as NaN.
+
+        """
+        n_stored = self._group['timestep'].shape[0]
+        if data is None:
+            data = {}
+        for var, value in data.items():
+            if var not in self._group:
+                if np.ndim(value) == 0:
+                    shape = (n_stored,)
+                    maxshape = (None,)
+                else:
+                    shape = (n_stored, len(value))
+                    maxshape = (None, None)
+                dset = self._group.create_dataset(
+                    var, shape=shape, maxshape=maxshape, dtype='f8',
+                    fillvalue=np.nan, chunks=True)
+                if self.data_units is not None:
+                    dset.attrs['units'] = self.data_units(var)
+        for name, dset in self._group.items():
+            if name == 'timestep':
+                dset.resize((n_stored + 1,))
+                dset[n_stored] = time_step
+            elif dset.ndim == 1:
+                dset.resize((n_stored + 1,))
+                dset[n_stored] = data.get(name, np.nan)
+            else:
+                value = data.get(name, [])
+                width = max(dset.shape[1], len(value))
+                dset.resize((n_stored + 1, width))
+                dset[n_stored, :len(value)] = value
+        self._file.flush()
+
+    def get_data(self, time_steps=None):
+        """
+        Get the stored results.
+
+        Parameters
+        ----------
+
+        time_steps : array
+            (Optional) Time steps for which to return the results. If not
+            specified, all stored time steps are returned.
+
+        Returns
+        -------
+        A dictionary with an array for each variable, ordered as `time_steps`
+        (or by time step, if not specified). Array variables are returned as
+        2D arrays, with the first index corresponding to the time step.
+        """
+        stored_timesteps = self.get_stored_timesteps()
+        if time_steps is None:
+            time_steps = np.unique(stored_timesteps)
+        sort_idx = np.argsort(stored_timesteps, kind='stable')
+        pos = np.searchsorted(stored_timesteps, time_steps, sorter=sort_idx)
+        if np.any(pos >= len(stored_timesteps)) or np.any(
+                stored_timesteps[sort_idx[pos]] != time_steps):
+            raise ValueError('Not all requested time steps are stored.')
+        idx = sort_idx[pos]
+        data = {}
+        for name, dset in self._group.items():
+            if name != 'timestep':
+                data[name] = dset[:][idx]
+        return data
+
+    def close(self):
+        """Sort the datasets by time step and close the file."""
+        if not self._file:
+            return
+        timesteps = self.get_stored_timesteps()
+        if np.any(np.diff(timesteps) < 0):
+            sort_idx = np.argsort(timesteps, kind='stable')
+            for dset in self._group.values():
+                dset[:] = dset[:][sort_idx]
+        self._file.close()
+
+
+def _to_json(value):
+    """Convert numpy types into JSON-serializable values."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Object of type {} is not JSON serializable.'.format(
+        type(value).__name__))
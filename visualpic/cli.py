@@ -0,0 +1,75 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the command line interface of VisualPIC.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import argparse
+
+
+def main(args=None):
+    """Entry point of the `visualpic` command."""
+    parser = argparse.ArgumentParser(
+        prog='visualpic', description='VisualPIC command line tools.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    convert_parser = subparsers.add_parser(
+        'convert',
+        help='Convert simulation data into analysis-optimized data stores.',
+        description=(
+            'Convert simulation data into analysis-optimized data stores, '
+            "which can be loaded with the 'visualpic' simulation code."))
+    convert_parser.add_argument(
+        'simulation_code', help="'osiris', 'hipace' or 'openpmd'.")
+    convert_parser.add_argument(
+        'data_folder', help='Folder containing the simulation data.')
+    convert_parser.add_argument(
+        'output_folder', help='Folder in which to write the data stores.')
+    convert_parser.add_argument(
+        '--plasma-density', type=float, default=None,
+        help="Plasma density in m^-3 (needed for 'osiris' and 'hipace').")
+    convert_parser.add_argument(
+        '--laser-wavelength', type=float, default=0.8e-6,
+        help='Laser wavelength in m.')
+    convert_parser.add_argument(
+        '--opmd-backend', default='h5py',
+        help="Backend of the openPMD-viewer ('h5py' or 'openpmd-api').")
+    convert_parser.add_argument(
+        '--fields', nargs='+', default=None,
+        help="Fields to convert (e.g. Ez 'rho [beam]'). Default: all.")
+    convert_parser.add_argument(
+        '--species', nargs='+', default=None,
+        help='Particle species to convert. Default: all.')
+    convert_parser.add_argument(
+        '--particle-chunk-size', type=int, default=2**16,
+        help='Number of particles in each chunk of the particle data.')
+    convert_parser.add_argument(
+        '--compression-level', type=int, default=4,
+        help='Level (0-9) of the gzip compression.')
+    convert_parser.add_argument(
+        '--n-proc', type=int, default=None,
+        help='Number of worker processes. Default: number of CPUs.')
+
+    args = parser.parse_args(args)
+    if args.command == 'convert':
+        from visualpic.data_handling.data_conversion import (
+            convert_simulation)
+        store_paths = convert_simulation(
+            args.simulation_code, args.data_folder, args.output_folder,
+            plasma_density=args.plasma_density,
+            laser_wavelength=args.laser_wavelength,
+            opmd_backend=args.opmd_backend, fields=args.fields,
+            species=args.species,
+            particle_chunk_size=args.particle_chunk_size,
+            compression_level=args.compression_level, n_proc=args.n_proc)
+        print('Created {} data stores in {}.'.format(
+            len(store_paths), args.output_folder))
+
+
+if __name__ == '__main__':
+    main()
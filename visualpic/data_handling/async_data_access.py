@@ -0,0 +1,206 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the AsyncDataAccessor class, which allows reading the
+simulation data from an asyncio event loop without blocking it.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import atexit
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import numpy as np
+
+
+class AsyncDataAccessor():
+
+    """
+    Class performing the blocking data reads of Fields and ParticleSpecies in
+    a thread pool, so that they can be awaited from an asyncio event loop.
+
+    Reads from the same data file are serialized by the thread-safe readers.
+    Concurrent requests for the same data (same Field or ParticleSpecies,
+    time step and read options) are coalesced into a single read, whose
+    result is shared by all the callers. The most recent results are also
+    kept in memory so that clients browsing the same data share them instead
+    of reading them again.
+
+    Since the returned data can be shared between callers, the data arrays
+    are flagged as read-only and the metadata dictionaries should not be
+    modified.
+    """
+
+    def __init__(self, max_workers=None, max_cached_results=4):
+        """
+        Initialize the accessor.
+
+        Parameters
+        ----------
+
+        max_workers : int
+            (Optional) Maximum number of threads used for reading data. If not
+            specified, the default of `ThreadPoolExecutor` is used.
+
+        max_cached_results : int
+            Number of recently read results to keep in memory. Set to 0 to
+            disable the cache and only coalesce concurrent requests.
+
+        """
+        self.max_cached_results = max_cached_results
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='visualpic_io')
+        self._lock = threading.Lock()
+        self._pending_reads = {}
+        self._cached_results = OrderedDict()
+
+    async def get_field_data(self, field, time_step, **kwargs):
+        """
+        Asynchronous version of `Field.get_data`. All keyword arguments are
+        passed to `Field.get_data`.
+
+        Returns
+        -------
+        A tuple with the field data array and the metadata dictionary.
+        """
+        def read_field():
+            fld, fld_md = field.get_data(time_step, **kwargs)
+            fld = _make_read_only(np.asarray(fld))
+            return fld, fld_md
+
+        key = (_get_data_key(field, field.get_name()), 'field', time_step,
+               _make_hashable(kwargs))
+        future = self._request(key, read_field)
+        return await asyncio.wrap_future(future)
+
+    async def get_species_data(self, species, time_step, components_list,
+                               data_units=None, time_units=None):
+        """
+        Asynchronous version of `ParticleSpecies.get_data`.
+
+        Returns
+        -------
+        A dictionary containing the particle data, in the same format as
+        `ParticleSpecies.get_data`.
+        """
+        def read_species():
+            data = species.get_data(time_step, components_list,
+                                    data_units=data_units,
+                                    time_units=time_units)
+            for comp, (comp_data, comp_md) in data.items():
+                data[comp] = (_make_read_only(np.asarray(comp_data)),
+                              comp_md)
+            return data
+
+        key = (_get_data_key(species, species.species_name), 'species',
+               time_step,
+               _make_hashable([components_list, data_units, time_units]))
+        future = self._request(key, read_species)
+        return await asyncio.wrap_future(future)
+
+    def clear_cache(self):
+        """Remove all stored results from memory."""
+        with self._lock:
+            self._cached_results.clear()
+
+    def shutdown(self, wait=True):
+        """Shut down the thread pool of the accessor."""
+        self._executor.shutdown(wait=wait)
+
+    def _request(self, key, read_function):
+        """
+        Return a future with the result of the read identified by 'key'.
+        If the same read is already stored or in progress, no new read is
+        started.
+        """
+        with self._lock:
+            if key in self._cached_results:
+                self._cached_results.move_to_end(key)
+                future = Future()
+                future.set_result(self._cached_results[key])
+                return future
+            future = self._pending_reads.get(key)
+            if future is None:
+                future = self._executor.submit(self._read, key, read_function)
+                self._pending_reads[key] = future
+            return future
+
+    def _read(self, key, read_function):
+        """Perform the read and store its result."""
+        try:
+            result = read_function()
+            with self._lock:
+                if self.max_cached_results > 0:
+                    self._cached_results[key] = result
+                    while len(self._cached_results) > self.max_cached_results:
+                        self._cached_results.popitem(last=False)
+            return result
+        finally:
+            with self._lock:
+                del self._pending_reads[key]
+
+
+_default_accessor = None
+_default_accessor_lock = threading.Lock()
+
+
+def get_default_accessor():
+    """
+    Return the AsyncDataAccessor shared by all `aget_data` calls for which no
+    specific accessor is given.
+    """
+    global _default_accessor
+    with _default_accessor_lock:
+        if _default_accessor is None:
+            _default_accessor = AsyncDataAccessor()
+            atexit.register(_shutdown_default_accessor)
+        return _default_accessor
+
+
+def _shutdown_default_accessor():
+    """Shut down the default accessor (at exit of the interpreter)."""
+    global _default_accessor
+    with _default_accessor_lock:
+        if _default_accessor is not None:
+            _default_accessor.shutdown()
+            _default_accessor = None
+        atexit.unregister(_shutdown_default_accessor)
+
+
+def _get_data_key(data, name):
+    """
+    Returns the key identifying a Field or ParticleSpecies in the accessor.
+    If the data belongs to a DataContainer, the key is given by its data
+    source and name. This is the same for all the containers loading the
+    same data and, unlike the object itself, it does not keep the data and
+    its readers alive while the results are stored.
+    """
+    if getattr(data, 'data_source', None) is None:
+        return data
+    return (data.data_source, name)
+
+
+def _make_hashable(value):
+    """Convert lists and dictionaries into tuples so they can be hashed."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _make_hashable(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_make_hashable(v) for v in value)
+    elif isinstance(value, np.ndarray):
+        return (value.shape, value.dtype.str, value.tobytes())
+    return value
+
+
+def _make_read_only(array):
+    """
+    Returns a read-only view of a numpy array so that it can be safely
+    shared. The original array is not modified.
+    """
+    array = array.view()
+    array.flags.writeable = False
+    return array
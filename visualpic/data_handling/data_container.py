@@ -8,12 +8,19 @@ License: GNU GPL-3.0.
 """
 
 
+import os
+import copy
+import threading
+
 from visualpic.data_handling.derived_field_definitions import (
     derived_field_definitions)
 from visualpic.data_handling.fields import DerivedField
 from visualpic.data_handling.particle_species import ParticleSpecies
 from visualpic.data_reading.folder_scanners import (
-    OsirisFolderScanner, OpenPMDFolderScanner, HiPACEFolderScanner)
+    OsirisFolderScanner, OpenPMDFolderScanner, HiPACEFolderScanner,
+    VisualPICFolderScanner)
+from visualpic.data_handling.statistics_index import (
+    StatisticsIndex, DEFAULT_INDEX_FILE_NAME)
 
 
 class DataContainer():
@@ -31,7 +38,8 @@ class DataContainer():
         simulation_code : str
             Name of the simulation code from which the data comes from.
             Possible values are 'osiris, 'hipace' or 'openpmd' for any
-            openPMD-compliant code.
+            openPMD-compliant code, or 'visualpic' for data converted with
+            `convert_simulation` (or `visualpic convert`).
 
         data_folder_path : str
             Path to the folder containing the simulation data.
@@ -60,6 +68,7 @@ class DataContainer():
         self.folder_fields = []
         self.particle_species = []
         self.derived_fields = []
+        self.statistics_index = None
 
     def load_data(self, force_reload=False):
         """Load the data into the data container."""
@@ -72,6 +81,9 @@ class DataContainer():
             self._add_associated_species_fields()
         if not self.derived_fields or force_reload:
             self.derived_fields = self._generate_derived_fields()
+        self._set_data_source()
+        if self.statistics_index is not None:
+            self.set_statistics_index(self.statistics_index)
 
     def get_list_of_fields(self, include_derived=True):
         """Returns a list with the names of all available fields."""
@@ -157,6 +169,104 @@ class DataContainer():
         raise ValueError("Species '{}' not found. ".format(species_name) +
                          "Available species are {}.".format(available_species))
 
+    def set_statistics_index(self, statistics_index):
+        """
+        Attach a StatisticsIndex to all fields and particle species, which
+        then use it in `get_statistics`. Set to None to detach it.
+        """
+        self.statistics_index = statistics_index
+        for data in (self.folder_fields + self.derived_fields +
+                     self.particle_species):
+            data.statistics_index = statistics_index
+
+    def compute_statistics(self, file_path=None, n_bins=64, time_steps=None,
+                           include_derived=True, overwrite=False,
+                           parallel=False, n_proc=None, background=False):
+        """
+        Compute the statistics index of all fields and particle species and
+        attach it to them (see `StatisticsIndex`). Statistics already stored
+        in the sidecar file of the index are not computed again.
+
+        Parameters
+        ----------
+
+        file_path : str
+            (Optional) Path to the sidecar file of the index. If not
+            specified, a 'visualpic_statistics.h5' file in the simulation
+            folder is used.
+
+        n_bins : int
+            Number of bins of the histograms.
+
+        time_steps : array
+            (Optional) Time steps to index. If not specified, all time steps
+            are indexed.
+
+        include_derived : bool
+            Whether to also index the derived fields.
+
+        overwrite, parallel, n_proc, background
+            Same as in `StatisticsIndex.compute`.
+
+        Returns
+        -------
+        The StatisticsIndex or, if `background=True`, a tuple with the index
+        and a Future which can be used to wait for the computation to
+        complete.
+        """
+        self.load_data()
+        if file_path is None:
+            file_path = os.path.join(self.data_folder_path,
+                                     DEFAULT_INDEX_FILE_NAME)
+        index = StatisticsIndex(file_path, n_bins=n_bins)
+        self.set_statistics_index(index)
+        quantities = list(self.folder_fields)
+        if include_derived:
+            quantities += self.derived_fields
+        quantities += [sp for sp in self.particle_species
+                       if len(sp.timesteps) > 0]
+        result = index.compute(
+            quantities, time_steps=time_steps, overwrite=overwrite,
+            parallel=parallel, n_proc=n_proc, background=background)
+        if background:
+            return index, result
+        return index
+
+    def __reduce_ex__(self, protocol):
+        """
+        Pickle the data container as a lightweight descriptor containing only
+        the arguments needed to create it. When unpickled in another process,
+        a container with the loaded data is taken from a per-process cache,
+        so that the simulation folder is scanned only once per process.
+        """
+        loaded = bool(self.folder_fields or self.particle_species)
+        return (_restore_data_container, (self._get_data_source(), loaded))
+
+    def __copy__(self):
+        return _copy_object(self)
+
+    def __deepcopy__(self, memo):
+        return _copy_object(self, memo)
+
+    def _get_data_source(self):
+        """
+        Returns a tuple with the arguments needed to recreate the data
+        container.
+        """
+        return (self.simulation_code, self.data_folder_path,
+                self.sim_params['n_p'], self.sim_params['lambda_0'],
+                self.opmd_backend)
+
+    def _set_data_source(self):
+        """
+        Stamp the data source of the container on all its fields and species,
+        allowing them to be pickled as lightweight descriptors.
+        """
+        data_source = self._get_data_source()
+        for data in (self.folder_fields + self.derived_fields +
+                     self.particle_species):
+            data.data_source = data_source
+
     def _set_folder_scanner(self):
         """Return the folder scanner corresponding to the simulation code."""
         plasma_density = self.sim_params['n_p']
@@ -167,10 +277,12 @@ class DataContainer():
             fs = HiPACEFolderScanner(plasma_density=plasma_density)
         elif sim_code == 'openpmd':
             fs = OpenPMDFolderScanner(opmd_backend=self.opmd_backend)
+        elif sim_code == 'visualpic':
+            fs = VisualPICFolderScanner()
         else:
             raise ValueError("Unsupported code '{}'.".format(sim_code) +
-                             " Possible values are 'osiris', 'hipace' or " +
-                             "'openpmd'.")
+                             " Possible values are 'osiris', 'hipace', " +
+                             "'openpmd' or 'visualpic'.")
         self.folder_scanner = fs
 
     def _generate_derived_fields(self):
@@ -213,4 +325,91 @@ class DataContainer():
                         field.species_name, [], [], [], None, None)
                     self.particle_species.append(species)
                 species.add_associated_field(field)
-                
\ No newline at end of file
+                
+
+
+_cached_data_containers = {}
+_cached_data_containers_lock = threading.Lock()
+
+
+def get_cached_data_container(data_source, reload=False):
+    """
+    Return a DataContainer with loaded data for the given data source. The
+    containers are cached, so that within each process the simulation folder
+    is scanned and the data readers are created only once.
+
+    Parameters
+    ----------
+
+    data_source : tuple
+        The arguments needed to create the DataContainer, as given by
+        `DataContainer._get_data_source`.
+
+    reload : bool
+        Whether to scan the simulation folder again even if the container is
+        already cached. Useful if new data has been produced since.
+
+    """
+    with _cached_data_containers_lock:
+        if data_source not in _cached_data_containers:
+            dc = DataContainer(*data_source)
+            dc.load_data()
+            _cached_data_containers[data_source] = dc
+        elif reload:
+            _cached_data_containers[data_source].load_data(force_reload=True)
+        return _cached_data_containers[data_source]
+
+
+def _copy_object(obj, memo=None):
+    """
+    Copy a DataContainer, field or species as any other object, i.e., using
+    its state instead of the lightweight descriptor used for pickling. A
+    deep copy is made if `memo` is given.
+    """
+    new_obj = obj.__class__.__new__(obj.__class__)
+    if memo is not None:
+        memo[id(obj)] = new_obj
+    if hasattr(obj, '__getstate__'):
+        state = obj.__getstate__()
+    else:
+        state = obj.__dict__
+    if memo is not None:
+        state = copy.deepcopy(state, memo)
+    if hasattr(new_obj, '__setstate__'):
+        new_obj.__setstate__(state)
+    else:
+        new_obj.__dict__.update(state)
+    return new_obj
+
+
+def _restore_data_container(data_source, loaded):
+    """Unpickle a DataContainer from its data source."""
+    if loaded:
+        return get_cached_data_container(data_source)
+    return DataContainer(*data_source)
+
+
+def _restore_field(data_source, field_name, species_name, n_timesteps):
+    """
+    Unpickle a field from its data source and name. The cached container is
+    reloaded if it has fewer time steps than the pickled field.
+    """
+    dc = get_cached_data_container(data_source)
+    field = dc.get_field(field_name, species_name=species_name)
+    if len(field.timesteps) < n_timesteps:
+        dc = get_cached_data_container(data_source, reload=True)
+        field = dc.get_field(field_name, species_name=species_name)
+    return field
+
+
+def _restore_species(data_source, species_name, n_timesteps):
+    """
+    Unpickle a particle species from its data source and name. The cached
+    container is reloaded if it has fewer time steps than the pickled species.
+    """
+    dc = get_cached_data_container(data_source)
+    species = dc.get_species(species_name)
+    if len(species.timesteps) < n_timesteps:
+        dc = get_cached_data_container(data_source, reload=True)
+        species = dc.get_species(species_name)
+    return species
@@ -0,0 +1,297 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the methods for converting the data of a simulation into
+data stores optimized for analysis, which can be read using the 'visualpic'
+simulation code.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import os
+import warnings
+from functools import partial
+
+import numpy as np
+from h5py import File as H5F
+from tqdm import tqdm
+
+from visualpic.data_handling.data_container import DataContainer
+from visualpic.data_handling.particle_species import ParticleSpecies
+from visualpic.data_reading.store_format import (
+    STORE_VERSION, FIELDS_FOLDER, SPECIES_FOLDER, get_iteration_path)
+from visualpic.analysis.analysis_executor import AnalysisExecutor
+
+
+# Approximate size (in bytes) of the chunks in which the field data is
+# stored. Small, roughly cubic chunks make the cost of reading a slice
+# similar along all directions.
+FIELD_CHUNK_BYTES = 256 * 1024
+
+
+def convert_simulation(
+        simulation_code, data_folder_path, output_folder_path,
+        plasma_density=None, laser_wavelength=0.8e-6, opmd_backend='h5py',
+        fields=None, species=None, particle_chunk_size=2**16,
+        compression_level=4, n_proc=None):
+    """
+    Convert the data of a simulation into data stores optimized for
+    analysis, which can then be loaded with
+    `DataContainer('visualpic', output_folder_path)`.
+
+    All time steps of each field and particle species are written to a
+    single HDF5 store (in the 'fields' and 'species' subfolders of the
+    output folder), which contains:
+
+    - The data of each time step in SI units (quantities which cannot be
+      converted to SI are kept in their original units). The data is
+      chunked and compressed with gzip (and shuffle), so that it can be read
+      in parallel with a `FieldReader`.
+    - The field data is stored in small, roughly cubic chunks, so that
+      slices and regions are read efficiently along any direction.
+    - The particles are sorted by 'z' (and 'tag'), and the minimum and
+      maximum value of each component within each chunk of particles is
+      stored. This allows finding the particles within a longitudinal range
+      without reading the data (see `ParticleSpecies.find_particle_range`).
+    - All the metadata (units, axes, time, etc.) of each time step, so that
+      it can be accessed without reading the data.
+
+    Each field and species is converted by a separate worker process.
+    Derived fields and components are not stored, since they are computed
+    from the converted data when loaded. Cylindrical and 'thetaMode' fields
+    are not supported and are skipped.
+
+    Parameters
+    ----------
+
+    simulation_code, data_folder_path, plasma_density, laser_wavelength,
+    opmd_backend
+        Simulation data to convert, as in `DataContainer`.
+
+    output_folder_path : str
+        Path to the folder in which to write the data stores.
+
+    fields : list
+        (Optional) Names of the fields to convert (e.g. ['Ez', 'rho [beam]']).
+        If not specified, all fields are converted.
+
+    species : list
+        (Optional) Names of the particle species to convert. If not
+        specified, all species are converted.
+
+    particle_chunk_size : int
+        Number of particles in each chunk of the particle data.
+
+    compression_level : int
+        Level (0-9) of the gzip compression.
+
+    n_proc : int
+        (Optional) Number of worker processes. If not specified, the number
+        of CPUs is used. If 1, the data is converted serially.
+
+    Returns
+    -------
+    A list with the paths of the created data stores.
+    """
+    dc = DataContainer(simulation_code, data_folder_path,
+                       plasma_density=plasma_density,
+                       laser_wavelength=laser_wavelength,
+                       opmd_backend=opmd_backend)
+    dc.load_data()
+    quantities = []
+    for field in dc.folder_fields:
+        if fields is not None and field.get_name() not in fields:
+            continue
+        geometry = field.get_geometry()
+        if geometry in ['cylindrical', 'thetaMode']:
+            warnings.warn(
+                "Field '{}' has '{}' geometry, which is not ".format(
+                    field.get_name(), geometry) +
+                'supported by the data stores. Skipping.')
+            continue
+        quantities.append(field)
+    for sp in dc.particle_species:
+        if species is not None and sp.species_name not in species:
+            continue
+        if len(sp.timesteps) > 0:
+            quantities.append(sp)
+
+    os.makedirs(os.path.join(output_folder_path, FIELDS_FOLDER),
+                exist_ok=True)
+    os.makedirs(os.path.join(output_folder_path, SPECIES_FOLDER),
+                exist_ok=True)
+    part = partial(_convert_quantity, output_folder_path=output_folder_path,
+                   source_code=dc.simulation_code,
+                   particle_chunk_size=particle_chunk_size,
+                   compression_level=compression_level)
+    tqdm_params = {'ascii': True, 'desc': 'Converting data... '}
+    if n_proc == 1:
+        return list(map(part, tqdm(quantities, **tqdm_params)))
+    with AnalysisExecutor(n_proc) as executor:
+        return executor.map(part, quantities, chunksize=1, **tqdm_params)
+
+
+def _convert_quantity(quantity, output_folder_path, source_code,
+                      particle_chunk_size, compression_level):
+    """
+    Convert a field or particle species into a data store. The store is
+    first written to a temporary file, which is only renamed once complete.
+    """
+    if isinstance(quantity, ParticleSpecies):
+        store_path = os.path.join(output_folder_path, SPECIES_FOLDER,
+                                  quantity.species_name + '.h5')
+    else:
+        store_path = os.path.join(output_folder_path, FIELDS_FOLDER)
+        if quantity.species_name is not None:
+            store_path = os.path.join(store_path, quantity.species_name)
+            os.makedirs(store_path, exist_ok=True)
+        store_path = os.path.join(store_path, quantity.field_name + '.h5')
+    tmp_path = store_path + '.tmp'
+    try:
+        with H5F(tmp_path, 'w') as store:
+            store.attrs['version'] = STORE_VERSION
+            store.attrs['source_code'] = source_code
+            if isinstance(quantity, ParticleSpecies):
+                _write_species_store(store, quantity, particle_chunk_size,
+                                     compression_level)
+            else:
+                _write_field_store(store, quantity, compression_level)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+def _write_field_store(store, field, compression_level):
+    """Write all time steps of a field into a store."""
+    store.attrs['name'] = field.field_name
+    store.attrs['species_name'] = (
+        field.species_name if field.species_name is not None else '')
+    time_steps = np.asarray(field.timesteps)
+    time = np.zeros(len(time_steps))
+    for i, time_step in enumerate(time_steps):
+        try:
+            fld, fld_md = field.get_data(
+                time_step, field_units='SI', axes_units='SI',
+                time_units='SI')
+        except ValueError:
+            # Fields which cannot be converted to SI keep their units.
+            fld, fld_md = field.get_data(
+                time_step, axes_units='SI', time_units='SI')
+        if i == 0:
+            store.attrs['units'] = fld_md['field']['units']
+            store.attrs['geometry'] = fld_md['field']['geometry']
+            store.attrs['axis_labels'] = fld_md['field']['axis_labels']
+            store.attrs['time_units'] = fld_md['time']['units']
+        fld = np.asarray(fld)
+        group = store.create_group(get_iteration_path(time_step))
+        group.attrs['time'] = fld_md['time']['value']
+        group.create_dataset(
+            'data', data=fld, **_get_dataset_options(
+                fld, _get_field_chunks(fld.shape, fld.dtype.itemsize),
+                compression_level))
+        axes = group.create_group('axes')
+        for label in fld_md['field']['axis_labels']:
+            axis = axes.create_dataset(
+                label, data=fld_md['axis'][label]['array'])
+            axis.attrs['units'] = fld_md['axis'][label]['units']
+        time[i] = fld_md['time']['value']
+    store.create_dataset('timesteps', data=time_steps.astype(np.int64))
+    store.create_dataset('time', data=time)
+
+
+def _write_species_store(store, species, chunk_size, compression_level):
+    """
+    Write all time steps of a particle species into a store, sorting the
+    particles by 'z' (and 'tag').
+    """
+    time_steps = np.asarray(species.timesteps)
+    components = species.get_list_of_readable_components(time_steps[0])
+    store.attrs['name'] = species.species_name
+    store.attrs['components'] = components
+    sort_keys = [comp for comp in ['z', 'tag'] if comp in components]
+    store.attrs['sorted_by'] = sort_keys
+    time = np.zeros(len(time_steps))
+    for i, time_step in enumerate(time_steps):
+        data = {}
+        for comp in components:
+            data[comp] = _read_component_in_si(species, time_step, comp)
+        md = data[components[0]][1]
+        if i == 0:
+            store.attrs['time_units'] = md['time']['units']
+        n_part = len(data[components[0]][0])
+        if len(sort_keys) > 0:
+            # `np.lexsort` sorts by the last key first.
+            order = np.lexsort(
+                [data[key][0] for key in reversed(sort_keys)])
+        else:
+            order = slice(None)
+        group = store.create_group(get_iteration_path(time_step))
+        group.attrs['time'] = md['time']['value']
+        group.attrs['n_particles'] = n_part
+        group.attrs['chunk_size'] = chunk_size
+        grid_md = md.get('grid', {})
+        if grid_md.get('resolution') is not None:
+            group.attrs['grid_resolution'] = grid_md['resolution']
+            group.attrs['grid_size'] = grid_md['size']
+            group.attrs['grid_range'] = np.array(grid_md['range'])
+            group.attrs['grid_size_units'] = grid_md['size_units']
+        chunk_starts = np.arange(0, n_part, chunk_size)
+        stats = group.create_group('chunk_stats')
+        for comp in components:
+            comp_data, comp_md = data[comp]
+            comp_data = np.asarray(comp_data)[order]
+            dataset = group.create_dataset(
+                comp, data=comp_data, **_get_dataset_options(
+                    comp_data, (min(chunk_size, n_part),),
+                    compression_level))
+            dataset.attrs['units'] = comp_md.get('units', '')
+            comp_stats = np.zeros((len(chunk_starts), 2))
+            if n_part > 0:
+                # NaNs are ignored.
+                comp_stats[:, 0] = np.fmin.reduceat(comp_data, chunk_starts)
+                comp_stats[:, 1] = np.fmax.reduceat(comp_data, chunk_starts)
+            stats.create_dataset(comp, data=comp_stats)
+        time[i] = md['time']['value']
+    store.create_dataset('timesteps', data=time_steps.astype(np.int64))
+    store.create_dataset('time', data=time)
+
+
+def _read_component_in_si(species, time_step, component):
+    """
+    Read a particle component in SI units. Components which cannot be
+    converted (or have no units, such as the tag) keep their units.
+    """
+    if component != 'tag':
+        try:
+            data = species.get_data(time_step, [component],
+                                    data_units=['SI'], time_units='SI')
+            return data[component]
+        except ValueError:
+            pass
+    data = species.get_data(time_step, [component], data_units=[None],
+                            time_units='SI')
+    return data[component]
+
+
+def _get_field_chunks(shape, itemsize):
+    """
+    Returns roughly cubic chunks of about `FIELD_CHUNK_BYTES` for a field
+    array.
+    """
+    if len(shape) == 0:
+        return None
+    side = int(round((FIELD_CHUNK_BYTES / itemsize) ** (1 / len(shape))))
+    return tuple(max(min(n, side), 1) for n in shape)
+
+
+def _get_dataset_options(data, chunks, compression_level):
+    """Returns the options for creating a chunked, compressed dataset."""
+    if data.size == 0 or chunks is None:
+        return {}
+    return {'chunks': chunks, 'compression': 'gzip',
+            'compression_opts': compression_level, 'shuffle': True}
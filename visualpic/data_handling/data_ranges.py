@@ -0,0 +1,167 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the methods for determining the range of the data of a
+field or particle component over many time steps.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+from functools import partial
+
+import numpy as np
+
+from visualpic.data_handling.statistics_index import rebin_histogram
+
+
+def compute_global_range(quantity, time_steps, component=None,
+                         percentiles=None, read_kwargs=None, use_index=True,
+                         n_bins=4096, parallel=False, n_proc=None,
+                         executor=None):
+    """
+    Compute the range of the data of a field or particle species component
+    over several time steps. The data is streamed one time step at a time.
+
+    The (min, max) range is computed in a first pass over the data. If
+    percentiles are requested, the histogram of the data within this range
+    is accumulated over all time steps in a second pass, and the percentiles
+    are determined from it. If available, the statistics index of the
+    quantity is used instead of reading the data, in which case the
+    percentiles are estimated from its coarse histograms.
+
+    Parameters
+    ----------
+
+    quantity : Field or ParticleSpecies
+        The field or particle species.
+
+    time_steps : array
+        Time steps over which to compute the range.
+
+    component : str
+        Name of the particle component. Only needed for particle species.
+
+    percentiles : tuple
+        (Optional) The (low, high) percentiles (0-100) determining the range.
+        If not specified, the full (min, max) range is computed.
+
+    read_kwargs : dict
+        (Optional) Additional parameters passed to the `get_data` method of
+        the quantity.
+
+    use_index : bool
+        Whether to use the statistics index of the quantity, if available.
+        Should be False if `read_kwargs` change the data with respect to that
+        in the index (e.g., data units).
+
+    n_bins : int
+        Number of bins of the histogram used for computing the percentiles.
+
+    parallel, n_proc, executor
+        Same as in `Field.reduce_over_time`.
+
+    Returns
+    -------
+    A tuple with the range.
+    """
+    if read_kwargs is None:
+        read_kwargs = {}
+    index = quantity.statistics_index if use_index else None
+    if index is not None:
+        g_range = index.get_global_range(quantity, time_steps, component)
+        if g_range is not None:
+            _check_range(g_range)
+            if percentiles is None:
+                return g_range
+            stats = [index.get_statistics(quantity, ts, component)
+                     for ts in time_steps]
+            bin_edges = _get_bin_edges(g_range, n_bins)
+            hist = sum(rebin_histogram(s, bin_edges) for s in stats
+                       if not np.isnan(s['min']))
+            return _get_percentile_range(hist, bin_edges, percentiles)
+
+    own_executor = parallel and executor is None
+    if own_executor:
+        from visualpic.analysis.analysis_executor import AnalysisExecutor
+        executor = AnalysisExecutor(n_proc)
+    try:
+        part = partial(_get_range_timestep, quantity=quantity,
+                       component=component, read_kwargs=read_kwargs)
+        ts_ranges = np.array(_map(part, time_steps, executor)).reshape(-1, 2)
+        g_range = (np.nanmin(ts_ranges[:, 0]), np.nanmax(ts_ranges[:, 1]))
+        _check_range(g_range)
+        if percentiles is None:
+            return g_range
+        bin_edges = _get_bin_edges(g_range, n_bins)
+        part = partial(_get_histogram_timestep, quantity=quantity,
+                       component=component, read_kwargs=read_kwargs,
+                       bin_edges=bin_edges)
+        hist = np.sum(_map(part, time_steps, executor), axis=0)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return _get_percentile_range(hist, bin_edges, percentiles)
+
+
+def _map(function, time_steps, executor):
+    """Apply a function to all time steps, serially or in the executor."""
+    if executor is not None:
+        return executor.map(function, time_steps, show_progress=False)
+    return [function(ts) for ts in time_steps]
+
+
+def _read_data(time_step, quantity, component, read_kwargs):
+    """Read the data of a field or particle component at a time step."""
+    if component is None:
+        fld, _ = quantity.get_data(time_step, **read_kwargs)
+        return np.asarray(fld)
+    data = quantity.get_data(time_step, [component], **read_kwargs)
+    return np.asarray(data[component][0])
+
+
+def _get_range_timestep(time_step, quantity, component, read_kwargs):
+    """
+    Returns the (min, max) range of the data at a time step (NaN if there is
+    no data).
+    """
+    data = _read_data(time_step, quantity, component, read_kwargs)
+    if data.size == 0 or np.all(np.isnan(data)):
+        return np.nan, np.nan
+    return np.nanmin(data), np.nanmax(data)
+
+
+def _get_histogram_timestep(time_step, quantity, component, read_kwargs,
+                            bin_edges):
+    """Returns the histogram of the data at a time step."""
+    data = _read_data(time_step, quantity, component, read_kwargs)
+    hist, _ = np.histogram(data, bins=bin_edges)
+    return hist
+
+
+def _check_range(data_range):
+    """Check that data has been found for determining a range."""
+    if not np.isfinite(data_range[0]):
+        raise ValueError('No data found in the given time steps.')
+
+
+def _get_bin_edges(data_range, n_bins):
+    """Returns the bin edges of a histogram covering the given range."""
+    r_min, r_max = data_range
+    if r_min == r_max:
+        r_min, r_max = r_min - 0.5, r_max + 0.5
+    return np.linspace(r_min, r_max, n_bins + 1)
+
+
+def _get_percentile_range(hist, bin_edges, percentiles):
+    """
+    Returns the values at the given (low, high) percentiles of the data
+    described by a histogram.
+    """
+    cumulative = np.concatenate(([0], np.cumsum(hist)))
+    targets = np.asarray(percentiles, dtype=float) / 100 * cumulative[-1]
+    # Use the first edge at which the cumulative count reaches each target.
+    idx = np.searchsorted(cumulative, targets, side='left')
+    idx = np.clip(idx, 0, len(bin_edges) - 1)
+    return bin_edges[idx[0]], bin_edges[idx[1]]
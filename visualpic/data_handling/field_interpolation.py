@@ -0,0 +1,161 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the methods used for interpolating field data at
+arbitrary points (e.g., at the particle positions).
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+from itertools import product
+
+import numpy as np
+
+
+def get_point_coordinates(points, axis_labels, geometry):
+    """
+    Get the coordinates of the points along each of the field axes.
+
+    Parameters
+    ----------
+
+    points : dict or array
+        Dictionary containing an array with the coordinate of the points
+        along each axis (e.g., {'x': x, 'y': y, 'z': z}), or an array of shape
+        (n_points, n_axes) with the coordinates ordered as `axis_labels`. In
+        cylindrical geometries, the points can also be given in Cartesian
+        coordinates, i.e., as {'x': x, 'y': y, 'z': z} or with shape
+        (n_points, 3).
+
+    axis_labels : list
+        List with the labels of the field axes.
+
+    geometry : str
+        The field geometry.
+
+    Returns
+    -------
+    A list with the coordinates of the points along each field axis.
+    """
+    cylindrical = geometry in ['cylindrical', 'thetaMode']
+    if isinstance(points, dict):
+        if cylindrical and 'r' not in points and 'x' in points:
+            points = dict(points)
+            points['r'] = np.hypot(points['x'], points['y'])
+        missing = [label for label in axis_labels if label not in points]
+        if len(missing) > 0:
+            raise ValueError(
+                'Coordinates along axes {} not provided.'.format(missing))
+        return [np.asarray(points[label], dtype=float)
+                for label in axis_labels]
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 1 and len(axis_labels) == 1:
+        points = points[:, np.newaxis]
+    if cylindrical and points.ndim == 2 and points.shape[1] == 3:
+        return [np.hypot(points[:, 0], points[:, 1]), points[:, 2]]
+    if points.ndim != 2 or points.shape[1] != len(axis_labels):
+        raise ValueError(
+            'Points should have shape (n_points, {}).'.format(
+                len(axis_labels)))
+    return [points[:, i] for i in range(len(axis_labels))]
+
+
+def get_bounding_index_region(axes, coords):
+    """
+    Get the smallest index region of the field grid containing all points.
+
+    Parameters
+    ----------
+
+    axes : list
+        List with the (uniformly spaced) axis arrays of the field.
+
+    coords : list
+        List with the coordinates of the points along each axis.
+
+    Returns
+    -------
+    A list with a (start, stop) index pair for each axis, or None if no
+    point lies within the field grid.
+    """
+    inside = np.ones(len(coords[0]), dtype=bool)
+    for axis, coord in zip(axes, coords):
+        inside &= (coord >= axis[0]) & (coord <= axis[-1])
+    if not np.any(inside):
+        return None
+    index_region = []
+    for axis, coord in zip(axes, coords):
+        n = len(axis)
+        c_min = np.min(coord[inside])
+        c_max = np.max(coord[inside])
+        start = max(np.searchsorted(axis, c_min, side='right') - 1, 0)
+        stop = min(np.searchsorted(axis, c_max, side='left') + 1, n)
+        # Keep at least two grid points for interpolating.
+        if stop - start < 2 and n >= 2:
+            start = min(start, n - 2)
+            stop = start + 2
+        index_region.append((int(start), int(stop)))
+    return index_region
+
+
+def interpolate_field(fld, axes, coords, fill_value=np.nan):
+    """
+    Interpolate field data at the given points by multilinear (i.e., linear,
+    bilinear or trilinear) interpolation.
+
+    The interpolation is fully vectorized: the cell of each point and its
+    relative position within it are computed directly from the uniform grid
+    spacing, and the values at the 2^n_dims cell corners are gathered from the
+    flattened field array.
+
+    Parameters
+    ----------
+
+    fld : array
+        The field data.
+
+    axes : list
+        List with the (uniformly spaced) axis arrays of the field.
+
+    coords : list
+        List with the coordinates of the points along each axis.
+
+    fill_value : float
+        Value given to the points outside of the field grid.
+
+    Returns
+    -------
+    An array with the interpolated field value at each point.
+    """
+    n_points = len(coords[0])
+    inside = np.ones(n_points, dtype=bool)
+    for axis, coord in zip(axes, coords):
+        inside &= (coord >= axis[0]) & (coord <= axis[-1])
+    coords = [coord[inside] for coord in coords]
+    flat_fld = np.ravel(fld)
+    strides = np.cumprod((fld.shape[1:] + (1,))[::-1])[::-1]
+    base_idx = np.zeros(len(coords[0]), dtype=np.intp)
+    fracs = []
+    corner_strides = []
+    for axis, coord, stride in zip(axes, coords, strides):
+        n = len(axis)
+        if n == 1:
+            continue
+        pos = (coord - axis[0]) * ((n - 1) / (axis[-1] - axis[0]))
+        idx = np.minimum(pos.astype(np.intp), n - 2)
+        base_idx += idx * stride
+        fracs.append(pos - idx)
+        corner_strides.append(stride)
+    values = np.zeros(len(base_idx), dtype=np.result_type(fld, float))
+    for corner in product([0, 1], repeat=len(corner_strides)):
+        weight = np.ones(len(base_idx))
+        offset = 0
+        for c, frac, stride in zip(corner, fracs, corner_strides):
+            weight *= frac if c else 1 - frac
+            offset += c * stride
+        values += weight * flat_fld[base_idx + offset]
+    result = np.full(n_points, fill_value, dtype=values.dtype)
+    result[inside] = values
+    return result
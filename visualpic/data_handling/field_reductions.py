@@ -0,0 +1,134 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the methods used for reducing field data (e.g., computing
+its maximum or extracting a lineout) over many time steps.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import numpy as np
+
+
+def reduce_field_data(fld, fld_md, op, region=None):
+    """
+    Reduce the data of a field at a single time step.
+
+    Parameters
+    ----------
+
+    fld : array
+        The field data.
+
+    fld_md : dict
+        The field metadata, as returned by `Field.get_data`.
+
+    op : str or callable
+        The reduction operation. Possible values are 'min', 'max', 'sum',
+        'mean', 'argmax' (position of the maximum), 'argmin' (position of the
+        minimum) and 'lineout' (the field data itself, which has to be 1D).
+        A callable taking the field data and metadata as arguments can also
+        be given.
+
+    region : dict
+        (Optional) Dictionary restricting the reduction to a region of the
+        field. The keys are axis names and the values a (min, max) tuple in
+        the axis units.
+
+    Returns
+    -------
+    A tuple with the result of the reduction and a dictionary with the axis
+    arrays of the (reduced) field data.
+    """
+    axis_labels = fld_md['field']['axis_labels']
+    axes = {label: fld_md['axis'][label]['array'] for label in axis_labels}
+    if region is not None:
+        fld, axes = _crop_to_region(fld, axes, axis_labels, region)
+    if callable(op):
+        result = op(fld, fld_md)
+    elif op == 'min':
+        result = np.min(fld)
+    elif op == 'max':
+        result = np.max(fld)
+    elif op == 'sum':
+        result = np.sum(fld)
+    elif op == 'mean':
+        result = np.mean(fld)
+    elif op in ['argmax', 'argmin']:
+        if op == 'argmax':
+            idx = np.unravel_index(np.argmax(fld), fld.shape)
+        else:
+            idx = np.unravel_index(np.argmin(fld), fld.shape)
+        result = np.array([axes[label][i] for label, i in
+                           zip(axis_labels, idx)])
+    elif op == 'lineout':
+        if fld.ndim != 1:
+            raise ValueError(
+                'Lineouts require 1D field data, but the data has ' +
+                '{} dimensions. Use `slice_dir_i` '.format(fld.ndim) +
+                'and `slice_dir_j` to reduce its dimensionality.')
+        result = fld
+    else:
+        raise ValueError(
+            "Unknown operation '{}'. Possible values are ".format(op) +
+            "'min', 'max', 'sum', 'mean', 'argmax', 'argmin' or 'lineout'.")
+    return result, axes
+
+
+def stack_results(results):
+    """
+    Stack the results of several time steps into a single array, whose first
+    dimension corresponds to the time step. Array results of different
+    length (e.g. lineouts in a moving window) are padded with NaN.
+    """
+    if all(np.ndim(r) == 0 for r in results):
+        return np.array(results, dtype=float)
+    length = max(len(r) for r in results)
+    stacked = np.full((len(results), length), np.nan)
+    for i, r in enumerate(results):
+        stacked[i, :len(r)] = r
+    return stacked
+
+
+def reduce_field_timestep(time_step, field, op, region, read_kwargs):
+    """
+    Read and reduce the field data at a single time step. Used as the task
+    executed (possibly in a worker process) by `Field.reduce_over_time`.
+
+    Returns
+    -------
+    A tuple with the result of the reduction, the axis arrays of the reduced
+    data, the time metadata, the field units and the units of each axis.
+    """
+    fld, fld_md = field.get_data(time_step, **read_kwargs)
+    result, axes = reduce_field_data(fld, fld_md, op, region)
+    axis_units = {label: fld_md['axis'][label]['units'] for label in axes}
+    return (result, axes, fld_md['time'], fld_md['field']['units'],
+            axis_units)
+
+
+def _crop_to_region(fld, axes, axis_labels, region):
+    """Crop the field data and axes to the specified region."""
+    slices = [slice(None)] * fld.ndim
+    cropped_axes = dict(axes)
+    for label, (r_min, r_max) in region.items():
+        if label not in axis_labels:
+            raise ValueError(
+                "Axis '{}' not found in field data. ".format(label) +
+                "Available axes are {}.".format(axis_labels))
+        dim = axis_labels.index(label)
+        axis = axes[label]
+        if len(axis) != fld.shape[dim]:
+            raise ValueError(
+                "Axis '{}' does not match the field data shape.".format(label))
+        idx = np.where((axis >= r_min) & (axis <= r_max))[0]
+        if len(idx) == 0:
+            raise ValueError(
+                "Region [{}, {}] of axis '{}' ".format(r_min, r_max, label) +
+                "contains no field data.")
+        slices[dim] = slice(idx[0], idx[-1] + 1)
+        cropped_axes[label] = axis[idx[0]:idx[-1] + 1]
+    return fld[tuple(slices)], cropped_axes
+
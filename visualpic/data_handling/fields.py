@@ -8,7 +8,24 @@ License: GNU GPL-3.0.
 """
 
 
+import threading
+from copy import deepcopy
+from functools import partial
+from collections import OrderedDict
+
+import numpy as np
+import scipy.constants as ct
+
 from visualpic.helper_functions import get_common_timesteps
+from visualpic.data_handling.async_data_access import (
+    get_default_accessor, _make_hashable)
+from visualpic.data_handling.field_reductions import (
+    reduce_field_timestep, stack_results)
+from visualpic.data_handling.field_interpolation import (
+    get_point_coordinates, get_bounding_index_region, interpolate_field)
+from visualpic.data_handling.particle_deposition import deposit_on_grid
+from visualpic.data_handling.shared_field_cache import get_shared_field_cache
+from visualpic.data_handling.data_ranges import compute_global_range
 
 
 class Field():
@@ -18,6 +35,32 @@ class Field():
         self.timesteps = field_timesteps
         self.species_name = species_name
         self.unit_converter = unit_converter
+        self.data_source = None
+        self.statistics_index = None
+        self._reduction_cache = {}
+        self._range_cache = {}
+
+    def __reduce_ex__(self, protocol):
+        """
+        If the field belongs to a DataContainer, pickle it as a lightweight
+        descriptor (data source and field name) instead of pickling its data
+        reader. When unpickled, the field is taken from a per-process cached
+        DataContainer.
+        """
+        if self.data_source is None:
+            return super().__reduce_ex__(protocol)
+        from visualpic.data_handling.data_container import _restore_field
+        return (_restore_field,
+                (self.data_source, self.field_name, self.species_name,
+                 len(self.timesteps)))
+
+    def __copy__(self):
+        from visualpic.data_handling.data_container import _copy_object
+        return _copy_object(self)
+
+    def __deepcopy__(self, memo):
+        from visualpic.data_handling.data_container import _copy_object
+        return _copy_object(self, memo)
 
     def get_name(self):
         fld_name = self.field_name
@@ -28,9 +71,266 @@ class Field():
     def get_data(self, time_step, field_units=None, axes_units=None,
                  axes_to_convert=None, time_units=None, slice_i=0.5,
                  slice_j=0.5, slice_dir_i=None, slice_dir_j=None, m='all',
-                 theta=0, max_resolution_3d=None, only_metadata=False):
+                 theta=0, max_resolution_3d=None, only_metadata=False,
+                 index_region=None):
         raise NotImplementedError
 
+    def get_statistics(self, time_step):
+        """
+        Get the statistics (min, max, mean, histogram, etc.) of the field
+        data at a time step from its statistics index, without reading the
+        data. See `StatisticsIndex.get_statistics`.
+
+        Returns None if the field has no index or the statistics of the time
+        step are not in the index.
+        """
+        if self.statistics_index is None:
+            return None
+        return self.statistics_index.get_statistics(self, time_step)
+
+    async def aget_data(self, time_step, accessor=None, **kwargs):
+        """
+        Awaitable version of `get_data`. The data is read in a thread pool
+        without blocking the event loop. Concurrent requests for the same
+        data are coalesced into a single read.
+
+        Parameters
+        ----------
+
+        time_step : int
+            Time step at which to read the data.
+
+        accessor : AsyncDataAccessor
+            (Optional) Accessor performing the read. If not specified, a
+            default accessor shared by all fields and species is used.
+
+        **kwargs
+            Any other argument accepted by `get_data`.
+
+        Returns
+        -------
+        A tuple with the field data array (read-only) and the metadata
+        dictionary.
+        """
+        if accessor is None:
+            accessor = get_default_accessor()
+        return await accessor.get_field_data(self, time_step, **kwargs)
+
+    def reduce_over_time(
+            self, op, time_steps=None, region=None, field_units=None,
+            axes_units=None, time_units=None, slice_i=0.5, slice_j=0.5,
+            slice_dir_i=None, slice_dir_j=None, m='all', theta=0,
+            parallel=False, n_proc=None, executor=None, use_cache=True):
+        """
+        Reduce the field data at each time step to a single value (e.g., its
+        maximum) or to a lineout, and return its evolution over time.
+
+        Only the needed slices of the field are read (see `slice_dir_i` and
+        `slice_dir_j`). The result of each time step is cached, so that
+        repeating the reduction (for example, after new data has been
+        produced) only processes new time steps.
+
+        Parameters
+        ----------
+
+        op : str or callable
+            The reduction operation. Possible values are 'min', 'max', 'sum',
+            'mean', 'argmax' (position of the maximum), 'argmin' (position of
+            the minimum) and 'lineout' (1D field data, e.g. on-axis). A
+            picklable function taking the field data and metadata of a single
+            time step as arguments can also be given.
+
+        time_steps : array
+            (Optional) Time steps to process. If not specified, all available
+            time steps are used.
+
+        region : dict
+            (Optional) Dictionary restricting the reduction to a region of
+            the field. The keys are axis names and the values a (min, max)
+            tuple in the axis units.
+
+        field_units, axes_units, time_units, slice_i, slice_j, slice_dir_i,
+        slice_dir_j, m, theta
+            Same as in `get_data`.
+
+        parallel : bool
+            Whether to process the time steps in parallel processes.
+
+        n_proc : int
+            (Optional) Number of processes used if `parallel=True`.
+
+        executor : AnalysisExecutor
+            (Optional) A persistent executor in which to process the time
+            steps. If given, `parallel` and `n_proc` are ignored.
+
+        use_cache : bool
+            Whether to reuse the stored results of previous reductions.
+
+        Returns
+        -------
+        A tuple with the reduced data and its metadata. The first dimension of
+        the reduced data corresponds to the time step. Scalar reductions
+        result in a 1D array, while 'argmax'/'argmin' (one position per axis)
+        and 'lineout' result in a 2D array. Lineouts of different length are
+        padded with NaN. The metadata contains the time steps, the time, the
+        units of the data and, for lineouts, the axis array of each time step.
+        """
+        if time_steps is None:
+            time_steps = self.timesteps
+        read_kwargs = {
+            'field_units': field_units, 'axes_units': axes_units,
+            'time_units': time_units, 'slice_i': slice_i, 'slice_j': slice_j,
+            'slice_dir_i': slice_dir_i, 'slice_dir_j': slice_dir_j, 'm': m,
+            'theta': theta}
+        key = (op, _make_hashable(region), _make_hashable(read_kwargs))
+        cache = self._reduction_cache.setdefault(key, {})
+        if not use_cache:
+            cache.clear()
+        pending_steps = [ts for ts in time_steps if ts not in cache]
+        if len(pending_steps) > 0:
+            part = partial(reduce_field_timestep, field=self, op=op,
+                           region=region, read_kwargs=read_kwargs)
+            if executor is not None:
+                results = executor.map(part, pending_steps,
+                                       show_progress=False)
+            elif parallel:
+                from visualpic.analysis.analysis_executor import (
+                    AnalysisExecutor)
+                with AnalysisExecutor(n_proc) as executor:
+                    results = executor.map(part, pending_steps,
+                                           show_progress=False)
+            else:
+                results = [part(ts) for ts in pending_steps]
+            cache.update(zip(pending_steps, results))
+        results = [cache[ts] for ts in time_steps]
+
+        # Gather results.
+        data = stack_results([r[0] for r in results])
+        md = {}
+        md['time_steps'] = np.asarray(time_steps)
+        md['time'] = {
+            'array': np.array([r[2]['value'] for r in results]),
+            'units': results[0][2]['units'] if results else None}
+        md['units'] = results[0][3] if results else None
+        if op == 'lineout' and results:
+            md['axis'] = {}
+            for label in results[0][1]:
+                md['axis'][label] = {
+                    'array': stack_results([r[1][label] for r in results]),
+                    'units': results[0][4][label]}
+        elif op in ['argmax', 'argmin'] and results:
+            md['axis_labels'] = list(results[0][1].keys())
+            md['units'] = [results[0][4][label]
+                           for label in md['axis_labels']]
+        return data, md
+
+    def get_global_range(self, time_steps=None, percentiles=None, theta=0,
+                         max_resolution_3d=None, parallel=False, n_proc=None,
+                         executor=None, use_cache=True):
+        """
+        Get the range of the field data over several time steps, for
+        example, to use a time-consistent colormap in an animation. The
+        statistics index of the field is used if available. Otherwise, the
+        data is streamed one time step at a time (see
+        `compute_global_range`). The result is cached.
+
+        Parameters
+        ----------
+
+        time_steps : array
+            (Optional) Time steps over which to compute the range. If not
+            specified, all available time steps are used.
+
+        percentiles : tuple
+            (Optional) The (low, high) percentiles (0-100) determining the
+            range. If not specified, the full (min, max) range is computed.
+
+        theta, max_resolution_3d
+            Same as in `get_data`.
+
+        parallel, n_proc, executor, use_cache
+            Same as in `reduce_over_time`.
+
+        Returns
+        -------
+        A tuple with the range, in the original units of the field.
+        """
+        if time_steps is None:
+            time_steps = self.timesteps
+        read_kwargs = {'theta': theta, 'max_resolution_3d': max_resolution_3d}
+        key = (_make_hashable(list(time_steps)), _make_hashable(percentiles),
+               _make_hashable(read_kwargs))
+        if use_cache and key in self._range_cache:
+            return self._range_cache[key]
+        # The index contains the data read with the default parameters.
+        use_index = ((theta == 0 and max_resolution_3d is None) or
+                     self.get_geometry() not in ['cylindrical', 'thetaMode'])
+        data_range = compute_global_range(
+            self, time_steps, percentiles=percentiles,
+            read_kwargs=read_kwargs, use_index=use_index, parallel=parallel,
+            n_proc=n_proc, executor=executor)
+        self._range_cache[key] = data_range
+        return data_range
+
+    def sample(self, time_step, points, field_units=None, axes_units=None,
+               m='all', theta=0, fill_value=np.nan):
+        """
+        Sample the field at arbitrary points by linear interpolation.
+
+        Only the smallest region of the field containing all points is read.
+        Cartesian fields are interpolated linearly along each axis (i.e.,
+        trilinear interpolation in 3D). Cylindrical and thetaMode fields are
+        interpolated in the r-z plane of angle `theta`, i.e., assuming that
+        the field is axisymmetric.
+
+        Parameters
+        ----------
+
+        time_step : int
+            Time step at which to sample the field.
+
+        points : dict or array
+            Dictionary containing an array with the coordinates of the points
+            along each field axis (e.g., {'x': x, 'y': y, 'z': z}), or an array
+            of shape (n_points, n_axes) with the coordinates ordered as the
+            field axes. For cylindrical and thetaMode fields, the points can
+            also be given as Cartesian 'x', 'y', 'z' coordinates. The
+            coordinates should be in the units specified by `axes_units`.
+
+        field_units, axes_units, m, theta
+            Same as in `get_data`.
+
+        fill_value : float
+            Value given to the points outside of the field grid.
+
+        Returns
+        -------
+        A tuple with an array containing the field value at each point and the
+        field metadata.
+        """
+        if theta is None:
+            raise ValueError(
+                "Sampling 3D reconstructions of cylindrical fields is not "
+                "supported. Specify a value of 'theta'.")
+        fld_md = self.get_only_metadata(time_step, axes_units=axes_units,
+                                        m=m, theta=theta)
+        axis_labels = fld_md['field']['axis_labels']
+        coords = get_point_coordinates(
+            points, axis_labels, fld_md['field']['geometry'])
+        axes = [fld_md['axis'][label]['array'] for label in axis_labels]
+        index_region = get_bounding_index_region(axes, coords)
+        if index_region is None:
+            # No point within the field grid.
+            fld_md = self.get_only_metadata(
+                time_step, field_units=field_units, axes_units=axes_units,
+                m=m, theta=theta)
+            return np.full(len(coords[0]), fill_value), fld_md
+        fld, fld_md = self.get_data(
+            time_step, field_units=field_units, axes_units=axes_units, m=m,
+            theta=theta, index_region=index_region)
+        axes = [fld_md['axis'][label]['array'] for label in axis_labels]
+        return interpolate_field(fld, axes, coords, fill_value), fld_md
+
     def get_only_metadata(self, time_step, field_units=None, axes_units=None,
                           axes_to_convert=None, time_units=None,
                           slice_dir_i=None, slice_dir_j=None, m='all',
@@ -65,12 +365,20 @@ class FolderField(Field):
     def get_data(self, time_step, field_units=None, axes_units=None,
                  axes_to_convert=None, time_units=None, slice_i=0.5,
                  slice_j=0.5, slice_dir_i=None, slice_dir_j=None, m='all',
-                 theta=0, max_resolution_3d=None, only_metadata=False):
+                 theta=0, max_resolution_3d=None, only_metadata=False,
+                 index_region=None):
         file_path = self._get_file_path(time_step)
-        fld, fld_md = self.field_reader.read_field(
-            file_path, time_step, self.field_path, slice_i, slice_j,
-            slice_dir_i, slice_dir_j, m, theta, max_resolution_3d,
-            only_metadata)
+        read_args = (file_path, time_step, self.field_path, slice_i, slice_j,
+                     slice_dir_i, slice_dir_j, m, theta, max_resolution_3d,
+                     only_metadata, index_region)
+        shared_cache = get_shared_field_cache()
+        if shared_cache is not None and not only_metadata:
+            fld, fld_md = shared_cache.get(
+                _make_hashable(read_args),
+                partial(self.field_reader.read_field, *read_args))
+            fld_md = deepcopy(fld_md)
+        else:
+            fld, fld_md = self.field_reader.read_field(*read_args)
         # perform unit conversion
         unit_list = [field_units, axes_units, time_units]
         if any(unit is not None for unit in unit_list):
@@ -98,7 +406,8 @@ class DerivedField(Field):
     def get_data(self, time_step, field_units=None, axes_units=None,
                  axes_to_convert=None, time_units=None, slice_i=0.5,
                  slice_j=0.5, slice_dir_i=None, slice_dir_j=None, m='all',
-                 theta=0, max_resolution_3d=None, only_metadata=False):
+                 theta=0, max_resolution_3d=None, only_metadata=False,
+                 index_region=None):
         field_data = []
         for field in self.base_fields:
             fld, fld_md = field.get_data(
@@ -106,7 +415,7 @@ class DerivedField(Field):
                 slice_i=slice_i, slice_j=slice_j, slice_dir_i=slice_dir_i,
                 slice_dir_j=slice_dir_j, m=m, theta=theta,
                 max_resolution_3d=max_resolution_3d,
-                only_metadata=only_metadata)
+                only_metadata=only_metadata, index_region=index_region)
             field_data.append(fld)
         if not only_metadata:
             fld = self.field_dict['recipe'](field_data, self.sim_geometry,
@@ -120,3 +429,234 @@ class DerivedField(Field):
                 target_axes_units=axes_units, axes_to_convert=axes_to_convert,
                 target_time_units=time_units)
         return fld, fld_md
+
+
+class DepositedField(Field):
+
+    """
+    Class for fields computed by depositing the particles of a species on a
+    uniform 3D grid, such as the charge or number density of the species.
+    The deposited data of the most recent time steps is cached.
+    """
+
+    def __init__(self, species, quantity='charge', resolution=(100, 100, 100),
+                 grid_lims=None, method='cic', chunk_size=None,
+                 max_cached_timesteps=4):
+        """
+        Initialize the field.
+
+        Parameters
+        ----------
+
+        species : ParticleSpecies
+            The particle species to deposit.
+
+        quantity : str
+            Quantity to deposit. Possible values are 'charge' (charge
+            density, in C/m^3) or 'number' (number density, in 1/m^3).
+
+        resolution : list
+            Number of grid nodes along x, y and z.
+
+        grid_lims : list
+            (Optional) List with the (min, max) limits of the grid along x, y
+            and z, in metres. If not specified (or None for any axis), the
+            grid spans the full extent of the particles at each time step.
+
+        method : str
+            Deposition scheme. Possible values are 'ngp' (nearest grid point)
+            and 'cic' (cloud in cell).
+
+        chunk_size : int
+            (Optional) Maximum number of particles deposited at once.
+
+        max_cached_timesteps : int
+            Number of time steps whose deposited data is kept in memory.
+
+        """
+        if quantity not in ['charge', 'number']:
+            raise ValueError(
+                "Unknown quantity '{}'. ".format(quantity) +
+                "Possible values are 'charge' or 'number'.")
+        if not species.contains(['x', 'y', 'z', 'q']):
+            raise ValueError(
+                "Species '{}' does not contain ".format(species.species_name) +
+                "the particle positions and charge needed for deposition.")
+        if grid_lims is None:
+            grid_lims = [None] * 3
+        self.species = species
+        self.quantity = quantity
+        self.resolution = tuple(int(n) for n in resolution)
+        self.grid_lims = grid_lims
+        self.method = method
+        self.chunk_size = chunk_size
+        self.max_cached_timesteps = max_cached_timesteps
+        self._cache_lock = threading.Lock()
+        self._cached_data = OrderedDict()
+        field_name = 'rho' if quantity == 'charge' else 'n'
+        super().__init__(field_name + '_deposited', species.timesteps,
+                         species.unit_converter, species.species_name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_cache_lock']
+        state['_cached_data'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
+    def get_data(self, time_step, field_units=None, axes_units=None,
+                 axes_to_convert=None, time_units=None, slice_i=0.5,
+                 slice_j=0.5, slice_dir_i=None, slice_dir_j=None, m='all',
+                 theta=0, max_resolution_3d=None, only_metadata=False,
+                 index_region=None):
+        if only_metadata:
+            # The metadata is available without depositing the particles.
+            fld, fld_md = np.array([]), self._get_metadata(time_step)
+        else:
+            fld, fld_md = self._get_deposited_data(time_step)
+            fld_md = deepcopy(fld_md)
+        axis_labels = fld_md['field']['axis_labels']
+        slices = [slice(None)] * 3
+        if index_region is not None:
+            for i, (start, stop) in enumerate(index_region):
+                slices[i] = slice(start, stop)
+                axis_md = fld_md['axis'][axis_labels[i]]
+                axis_md['array'] = axis_md['array'][start:stop]
+        for slice_dir, slice_pos in [(slice_dir_i, slice_i),
+                                     (slice_dir_j, slice_j)]:
+            if slice_dir is not None:
+                i = ['x', 'y', 'z'].index(slice_dir)
+                n_i = self.resolution[i]
+                slices[i] = min(int(round(n_i * slice_pos)), n_i - 1)
+                del fld_md['axis'][slice_dir]
+                axis_labels.remove(slice_dir)
+        if not only_metadata:
+            fld = fld[tuple(slices)]
+        # perform unit conversion (data is already in SI units)
+        if field_units == 'SI':
+            field_units = None
+        unit_list = [field_units, axes_units, time_units]
+        if any(unit is not None for unit in unit_list):
+            fld, fld_md = self.unit_converter.convert_field_units(
+                fld, fld_md, target_field_units=field_units,
+                target_axes_units=axes_units, axes_to_convert=axes_to_convert,
+                target_time_units=time_units)
+        return fld, fld_md
+
+    def _get_deposited_data(self, time_step):
+        """
+        Returns the (read-only) deposited data and its metadata at the given
+        time step, computing them if they are not cached.
+        """
+        with self._cache_lock:
+            if time_step in self._cached_data:
+                self._cached_data.move_to_end(time_step)
+                return self._cached_data[time_step]
+        result = self._deposit(time_step)
+        with self._cache_lock:
+            if self.max_cached_timesteps > 0:
+                self._cached_data[time_step] = result
+                while len(self._cached_data) > self.max_cached_timesteps:
+                    self._cached_data.popitem(last=False)
+        return result
+
+    def _get_metadata(self, time_step):
+        """
+        Returns the metadata of the deposited field at the given time step,
+        without depositing the particles (unless already cached).
+        """
+        with self._cache_lock:
+            if time_step in self._cached_data:
+                return deepcopy(self._cached_data[time_step][1])
+        grid_lims = self._get_grid_lims(time_step)
+        data = self.species.get_data(time_step, ['x'],
+                                     particle_range=slice(0, 0))
+        return self._build_metadata(grid_lims, data['x'][1]['time'])
+
+    def _get_grid_lims(self, time_step, chunks=None):
+        """
+        Returns the grid limits at the given time step. Those not specified
+        are determined from the extent of the particles in `chunks` or, if
+        not given, from the particle positions read from the species.
+        """
+        grid_lims = list(self.grid_lims)
+        if all(lims is not None for lims in grid_lims):
+            return grid_lims
+        if chunks is None:
+            comps = ['x', 'y', 'z']
+            if self.chunk_size is None:
+                chunks = [self.species.get_data(time_step, comps,
+                                                data_units='SI')]
+            else:
+                chunks = self.species.iterate_data_chunks(
+                    time_step, comps, self.chunk_size, data_units='SI')
+        data_lims = self._get_data_lims(chunks)
+        return [lims if lims is not None else data_lims[i]
+                for i, lims in enumerate(grid_lims)]
+
+    def _deposit(self, time_step):
+        """Deposit the particles at the given time step."""
+        comps = ['x', 'y', 'z', 'q']
+        if self.chunk_size is None:
+            chunks = [self.species.get_data(time_step, comps,
+                                            data_units='SI')]
+            grid_lims = self._get_grid_lims(time_step, chunks)
+        else:
+            # Additional pass (if needed) to determine the extent of the
+            # particles.
+            grid_lims = self._get_grid_lims(time_step)
+            chunks = self.species.iterate_data_chunks(
+                time_step, comps, self.chunk_size, data_units='SI')
+        fld = np.zeros(self.resolution)
+        time_md = None
+        for data in chunks:
+            w = data['q'][0]
+            if self.quantity == 'number':
+                w = np.abs(w) / ct.e
+            fld += deposit_on_grid(
+                [data[comp][0] for comp in comps[:3]], w, grid_lims,
+                self.resolution, self.method)
+            time_md = data['x'][1]['time']
+        if time_md is None:
+            data = self.species.get_data(time_step, ['x'],
+                                         particle_range=slice(0, 0))
+            time_md = data['x'][1]['time']
+        axes = [np.linspace(g_min, g_max, n) for (g_min, g_max), n in
+                zip(grid_lims, self.resolution)]
+        cell_vol = np.prod([(ax[-1] - ax[0]) / (len(ax) - 1) if len(ax) > 1
+                            else 1 for ax in axes])
+        fld /= cell_vol
+        fld.flags.writeable = False
+        return fld, self._build_metadata(grid_lims, time_md)
+
+    def _build_metadata(self, grid_lims, time_md):
+        """Returns the field metadata for the given grid limits."""
+        axes = [np.linspace(g_min, g_max, n) for (g_min, g_max), n in
+                zip(grid_lims, self.resolution)]
+        fld_md = {}
+        fld_md['field'] = {
+            'units': 'C/m^3' if self.quantity == 'charge' else '1/m^3',
+            'geometry': '3dcartesian', 'axis_labels': ['x', 'y', 'z']}
+        fld_md['axis'] = {label: {'array': ax, 'units': 'm'}
+                          for label, ax in zip(['x', 'y', 'z'], axes)}
+        fld_md['time'] = dict(time_md)
+        return fld_md
+
+    def _get_data_lims(self, chunks):
+        """Returns the (min, max) extent of the particles along x, y and z."""
+        data_lims = [[np.inf, -np.inf] for i in range(3)]
+        for data in chunks:
+            for i, comp in enumerate(['x', 'y', 'z']):
+                values = data[comp][0]
+                if len(values) > 0:
+                    data_lims[i][0] = min(data_lims[i][0], np.min(values))
+                    data_lims[i][1] = max(data_lims[i][1], np.max(values))
+        for lims in data_lims:
+            if not lims[0] < lims[1]:
+                # Empty or flat distribution.
+                center = lims[0] if np.isfinite(lims[0]) else 0.
+                lims[0], lims[1] = center - 0.5e-6, center + 0.5e-6
+        return data_lims
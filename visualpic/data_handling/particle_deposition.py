@@ -0,0 +1,89 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the methods used for depositing particle data on a grid
+(e.g., for computing the charge density of a particle species).
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+from itertools import product
+
+import numpy as np
+
+
+def deposit_on_grid(coords, w, grid_lims, grid_shape, method='cic'):
+    """
+    Deposit the weights of a set of particles on the nodes of a uniform grid.
+
+    The grid node (or nodes) of each particle along each dimension is
+    computed directly from the grid spacing, and the contributions to all
+    nodes are accumulated with `np.bincount` on the flattened node indices.
+    Particles outside of the grid are ignored.
+
+    Parameters
+    ----------
+
+    coords : list
+        List with an array containing the particle coordinates along each
+        dimension.
+
+    w : array
+        Weight of each particle (e.g., its charge).
+
+    grid_lims : list
+        List with the (min, max) position of the first and last node of the
+        grid along each dimension.
+
+    grid_shape : tuple
+        Number of grid nodes along each dimension.
+
+    method : str
+        Deposition scheme. Possible values are 'ngp' (nearest grid point)
+        and 'cic' (cloud in cell, i.e., linear weighting).
+
+    Returns
+    -------
+    An array of shape `grid_shape` with the deposited weights.
+    """
+    if method not in ['ngp', 'cic']:
+        raise ValueError(
+            "Unknown deposition method '{}'. ".format(method) +
+            "Possible values are 'ngp' or 'cic'.")
+    n_nodes = int(np.prod(grid_shape))
+    strides = np.cumprod((tuple(grid_shape[1:]) + (1,))[::-1])[::-1]
+    positions = []
+    for coord, (g_min, g_max), n in zip(coords, grid_lims, grid_shape):
+        if n > 1:
+            positions.append((coord - g_min) * ((n - 1) / (g_max - g_min)))
+        else:
+            positions.append(np.zeros(len(coord)))
+    if method == 'ngp':
+        flat_idx = np.zeros(len(w), dtype=np.intp)
+        valid = np.ones(len(w), dtype=bool)
+        for pos, n, stride in zip(positions, grid_shape, strides):
+            idx = np.floor(pos + 0.5).astype(np.intp)
+            valid &= (idx >= 0) & (idx < n)
+            flat_idx += np.clip(idx, 0, n - 1) * stride
+        return np.bincount(flat_idx[valid], weights=w[valid],
+                           minlength=n_nodes).reshape(grid_shape)
+    base_idx = []
+    fracs = []
+    for pos in positions:
+        idx = np.floor(pos).astype(np.intp)
+        base_idx.append(idx)
+        fracs.append(pos - idx)
+    grid = np.zeros(n_nodes)
+    for corner in product([0, 1], repeat=len(positions)):
+        flat_idx = np.zeros(len(w), dtype=np.intp)
+        corner_w = np.array(w, dtype=float)
+        for c, idx, frac, n, stride in zip(corner, base_idx, fracs,
+                                           grid_shape, strides):
+            idx = idx + c
+            corner_w *= frac if c else 1 - frac
+            corner_w[(idx < 0) | (idx >= n)] = 0
+            flat_idx += np.clip(idx, 0, n - 1) * stride
+        grid += np.bincount(flat_idx, weights=corner_w, minlength=n_nodes)
+    return grid.reshape(grid_shape)
@@ -8,8 +8,16 @@ License: GNU GPL-3.0.
 """
 
 
+import warnings
+
+import numpy as np
+
 from visualpic.data_handling.derived_particle_data_definitions import (
     derived_particle_data_definitions, get_definition)
+from visualpic.data_handling.async_data_access import (
+    get_default_accessor, _make_hashable)
+from visualpic.data_handling.data_ranges import compute_global_range
+from visualpic.data_handling.fields import DepositedField
 
 
 class ParticleSpecies():
@@ -62,9 +70,33 @@ class ParticleSpecies():
         self.data_reader = data_reader
         self.unit_converter = unit_converter
         self.associated_fields = []
+        self.data_source = None
+        self.statistics_index = None
+        self._range_cache = {}
+
+    def __reduce_ex__(self, protocol):
+        """
+        If the species belongs to a DataContainer, pickle it as a lightweight
+        descriptor (data source and species name) instead of pickling its data
+        reader. When unpickled, the species is taken from a per-process cached
+        DataContainer.
+        """
+        if self.data_source is None:
+            return super().__reduce_ex__(protocol)
+        from visualpic.data_handling.data_container import _restore_species
+        return (_restore_species, (self.data_source, self.species_name,
+                                   len(self.timesteps)))
+
+    def __copy__(self):
+        from visualpic.data_handling.data_container import _copy_object
+        return _copy_object(self)
+
+    def __deepcopy__(self, memo):
+        from visualpic.data_handling.data_container import _copy_object
+        return _copy_object(self, memo)
 
     def get_data(self, time_step, components_list, data_units=None,
-                 time_units=None):
+                 time_units=None, particle_range=None):
         """
         Get the species data of the requested components and time step and in
         the specified units.
@@ -136,15 +168,275 @@ class ParticleSpecies():
         # Read data from file
         file_path = self._get_file_path(time_step)
         folder_data = self._get_file_data(
-            file_path, time_step, comp_to_read, comp_to_read_units, time_units)
+            file_path, time_step, comp_to_read, comp_to_read_units, time_units,
+            particle_range)
         # Compute derived data
         derived_data = self._calculate_derived_data(
             file_path, time_step, derived_components, derived_components_units,
-            time_units)
+            time_units, particle_range)
         # Join in a single dictionary
         data = {**folder_data, **derived_data}
         return data
 
+    def get_number_of_particles(self, time_step):
+        """Returns the number of particles at the specified time step."""
+        file_path = self._get_file_path(time_step)
+        return self.data_reader.get_number_of_particles(
+            file_path, time_step, self.species_name)
+
+    def find_particle_range(self, time_step, component, value_range):
+        """
+        Find a range of particles containing all particles whose component
+        value lies within the given range. This can be passed as the
+        `particle_range` of `get_data` to read only a subset of the
+        particles (e.g., a longitudinal slice of the beam).
+
+        Only the data stores created by `convert_simulation` (which keep the
+        particles sorted by 'z' and store per-chunk statistics) allow for
+        narrowing down the range. For other data, the full range of
+        particles is returned.
+
+        Parameters
+        ----------
+
+        time_step : int
+            Time step of the data.
+
+        component : str
+            Name of the particle component (read from file, not derived).
+
+        value_range : list
+            The (min, max) range of values of the component, in the units of
+            the data file.
+
+        Returns
+        -------
+        A slice with the range of particles.
+        """
+        if component not in self.components_in_file:
+            raise ValueError(
+                "Component '{}' not found in file. ".format(component) +
+                "Available components are {}.".format(
+                    self.components_in_file))
+        file_path = self._get_file_path(time_step)
+        return self.data_reader.find_particle_range(
+            file_path, time_step, self.species_name, component, value_range)
+
+    def get_statistics(self, time_step, component):
+        """
+        Get the statistics (min, max, mean, histogram, etc.) of a particle
+        component at a time step from the statistics index of the species,
+        without reading the data. See `StatisticsIndex.get_statistics`.
+
+        Returns None if the species has no index or the statistics of the
+        component and time step are not in the index.
+        """
+        if self.statistics_index is None:
+            return None
+        return self.statistics_index.get_statistics(
+            self, time_step, component)
+
+    def get_global_range(self, component, time_steps=None, percentiles=None,
+                         data_units=None, parallel=False, n_proc=None,
+                         executor=None, use_cache=True):
+        """
+        Get the range of a particle component over several time steps, for
+        example, to use a time-consistent colormap in an animation. The
+        statistics index of the species is used if available. Otherwise, the
+        data is streamed one time step at a time (see
+        `compute_global_range`). The result is cached.
+
+        Parameters
+        ----------
+
+        component : str
+            Name of the particle component.
+
+        time_steps : array
+            (Optional) Time steps over which to compute the range. If not
+            specified, all available time steps are used.
+
+        percentiles : tuple
+            (Optional) The (low, high) percentiles (0-100) determining the
+            range. If not specified, the full (min, max) range is computed.
+
+        data_units : str
+            (Optional) Units of the component. If not specified, the original
+            units are used.
+
+        parallel, n_proc, executor, use_cache
+            Same as in `Field.reduce_over_time`.
+
+        Returns
+        -------
+        A tuple with the range.
+        """
+        if time_steps is None:
+            time_steps = self.timesteps
+        key = (component, _make_hashable(list(time_steps)),
+               _make_hashable(percentiles), data_units)
+        if use_cache and key in self._range_cache:
+            return self._range_cache[key]
+        read_kwargs = {}
+        if data_units is not None:
+            read_kwargs['data_units'] = [data_units]
+        data_range = compute_global_range(
+            self, time_steps, component=component, percentiles=percentiles,
+            read_kwargs=read_kwargs, use_index=data_units is None,
+            parallel=parallel, n_proc=n_proc, executor=executor)
+        self._range_cache[key] = data_range
+        return data_range
+
+    def iterate_data_chunks(self, time_step, components_list, chunk_size,
+                            data_units=None, time_units=None):
+        """
+        Iterate over the species data in chunks of particles, so that species
+        which do not fit in memory can be processed.
+
+        Parameters
+        ----------
+
+        time_step : int
+            Time step at which to read the data.
+
+        components_list : list
+            List of strings containing the names of the components to be read.
+
+        chunk_size : int
+            Maximum number of particles in each chunk.
+
+        data_units, time_units
+            Same as in `get_data`.
+
+        Returns
+        -------
+        An iterator yielding a dictionary for each chunk, in the same format
+        as `get_data`.
+        """
+        if not self.data_reader.supports_particle_range():
+            warnings.warn(
+                'The data reader of species '
+                "'{}' cannot read ranges of particles. ".format(
+                    self.species_name) +
+                'Reading all particles at once.')
+            yield self.get_data(time_step, components_list,
+                                data_units=data_units, time_units=time_units)
+            return
+        n_part = self.get_number_of_particles(time_step)
+        for start in range(0, n_part, chunk_size):
+            particle_range = slice(start, min(start + chunk_size, n_part))
+            yield self.get_data(time_step, components_list,
+                                data_units=data_units, time_units=time_units,
+                                particle_range=particle_range)
+
+    async def aget_data(self, time_step, components_list, data_units=None,
+                        time_units=None, accessor=None):
+        """
+        Awaitable version of `get_data`. The data is read in a thread pool
+        without blocking the event loop. Concurrent requests for the same
+        data are coalesced into a single read.
+
+        Parameters
+        ----------
+
+        time_step, components_list, data_units, time_units
+            Same as in `get_data`.
+
+        accessor : AsyncDataAccessor
+            (Optional) Accessor performing the read. If not specified, a
+            default accessor shared by all fields and species is used.
+
+        Returns
+        -------
+        A dictionary containing the particle data in the same format as
+        `get_data`. The data arrays are read-only.
+        """
+        if accessor is None:
+            accessor = get_default_accessor()
+        return await accessor.get_species_data(
+            self, time_step, components_list, data_units=data_units,
+            time_units=time_units)
+
+    def gather_field(self, field, time_step, field_units=None, m='all',
+                     theta=0, fill_value=np.nan, particle_range=None):
+        """
+        Get the value of a field at the position of each particle, obtained
+        by linear interpolation (see `Field.sample`).
+
+        Parameters
+        ----------
+
+        field : Field
+            The field to interpolate.
+
+        time_step : int
+            Time step at which to gather the field.
+
+        field_units : str
+            (Optional) Units in which to return the field values.
+
+        m, theta
+            Same as in `Field.get_data`.
+
+        fill_value : float
+            Value given to the particles outside of the field grid.
+
+        particle_range : slice
+            (Optional) Range of particles for which to gather the field.
+
+        Returns
+        -------
+        A tuple with an array containing the field value at each particle and
+        the field metadata.
+        """
+        fld_md = field.get_only_metadata(time_step, m=m, theta=theta)
+        if fld_md['field']['geometry'] in ['cylindrical', 'thetaMode']:
+            components = ['x', 'y', 'z']
+        else:
+            components = fld_md['field']['axis_labels']
+        data = self.get_data(time_step, components, data_units='SI',
+                             particle_range=particle_range)
+        points = {comp: data[comp][0] for comp in components}
+        return field.sample(time_step, points, field_units=field_units,
+                            axes_units='SI', m=m, theta=theta,
+                            fill_value=fill_value)
+
+    def get_density_field(self, quantity='charge', resolution=(100, 100, 100),
+                          grid_lims=None, method='cic', chunk_size=None):
+        """
+        Get a field with the density of the species, computed by depositing
+        its particles on a 3D grid. The field can be displayed as a volume,
+        even if the density was not stored by the simulation.
+
+        Parameters
+        ----------
+
+        quantity : str
+            Quantity to deposit. Possible values are 'charge' (charge
+            density) or 'number' (number density).
+
+        resolution : list
+            Number of grid nodes along x, y and z.
+
+        grid_lims : list
+            (Optional) List with the (min, max) limits of the grid along x, y
+            and z, in metres. By default, the grid spans the full extent of
+            the particles at each time step.
+
+        method : str
+            Deposition scheme. Possible values are 'ngp' (nearest grid point)
+            and 'cic' (cloud in cell).
+
+        chunk_size : int
+            (Optional) Maximum number of particles deposited at once.
+
+        Returns
+        -------
+        A DepositedField.
+        """
+        return DepositedField(self, quantity, resolution, grid_lims, method,
+                              chunk_size)
+
     def get_list_of_available_components(self, include_tags=False):
         """
         Returns a list of strings with the names of all available components.
@@ -154,6 +446,24 @@ class ParticleSpecies():
             all_components.remove('tag')
         return all_components
 
+    def get_list_of_readable_components(self, time_step):
+        """
+        Returns a list with the names of the components in file which can
+        actually be read at the given time step, skipping (with a warning)
+        any other dataset listed by the folder scanner.
+        """
+        components = []
+        for comp in self.components_in_file:
+            try:
+                self.get_data(time_step, [comp], particle_range=slice(0, 0))
+            except KeyError:
+                warnings.warn(
+                    "Component '{}' of species '{}' cannot be read. ".format(
+                        comp, self.species_name) + 'Skipping.')
+                continue
+            components.append(comp)
+        return components
+
     def add_associated_field(self, field):
         """Add a Field object associated to this species."""
         if self.species_name == field.species_name:
@@ -207,17 +517,18 @@ class ParticleSpecies():
         return self.timestep_to_files[time_step]
 
     def _get_file_data(self, file_path, iteration, components_list, data_units,
-                       time_units):
+                       time_units, particle_range=None):
         """Read the specified components from a data file."""
         data = self.data_reader.read_particle_data(
-            file_path, iteration, self.species_name, components_list)
+            file_path, iteration, self.species_name, components_list,
+            particle_range)
         data = self._convert_data_units(data, components_list, data_units,
                                         time_units)
         return data
 
     def _calculate_derived_data(
             self, file_path, iteration, data_list, target_data_units,
-            time_units):
+            time_units, particle_range=None):
         """Calculate the specified derived components."""
         derived_data_dict = {}
         for name in data_list:
@@ -228,7 +539,7 @@ class ParticleSpecies():
             required_data_units = ['SI'] * len(required_data_list)
             required_data = self._get_file_data(
                 file_path, iteration, required_data_list, required_data_units,
-                time_units)
+                time_units, particle_range)
             derived_data = data_def['recipe'](required_data)
             derived_data_md = required_data[required_data_list[0]][1]
             derived_data_md['units'] = data_units
@@ -0,0 +1,357 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the SharedFieldCache class, which allows several
+processes to share the field data they read through shared memory.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import os
+import time
+import uuid
+import inspect
+import threading
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+
+class SharedFieldCache():
+
+    """
+    Class providing a cache of field data shared by several processes.
+
+    The first process reading a field array publishes it in a block of shared
+    memory (`multiprocessing.shared_memory`). Any other process requesting the
+    same data attaches to this block and gets a read-only, zero-copy view of
+    the array, so that the data is read from disk and kept in memory only
+    once. If several processes request data that is being read, they wait for
+    it to be published instead of reading it again. If the process reading
+    the data no longer exists (e.g., if it was killed) or, optionally, if
+    reading takes longer than `load_timeout`, a waiting process reads the
+    data instead.
+
+    The published blocks are tracked in a registry held by a manager process,
+    which also counts how many processes are attached to each block. Each
+    process keeps at most `max_attached` blocks attached, detaching the least
+    recently used ones. A block is freed as soon as no process is attached to
+    it, and all remaining blocks are freed when the cache is shut down.
+
+    The cache is activated in a process by calling `set_shared_field_cache`,
+    after which all reads of `FolderField.get_data` go through it. An
+    AnalysisExecutor created with `shared_cache=True` activates it in all its
+    workers.
+    """
+
+    def __init__(self, max_attached=4, load_timeout=None):
+        """
+        Initialize the cache. This starts the manager process holding the
+        registry.
+
+        Parameters
+        ----------
+
+        max_attached : int
+            Maximum number of data blocks that each process keeps attached.
+
+        load_timeout : float
+            (Optional) Maximum time (in seconds) that a process waits for the
+            data being read by another process before reading it itself. If
+            not specified, it waits as long as the other process exists.
+
+        """
+        self.max_attached = max_attached
+        self.load_timeout = load_timeout
+        self._manager = multiprocessing.Manager()
+        self._registry = self._manager.dict()
+        self._registry_lock = self._manager.Lock()
+        self._init_local_state()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ['_manager', '_local_lock', '_attached', '_detached']:
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._manager = None
+        self._init_local_state()
+
+    def get(self, key, read_function):
+        """
+        Get the data identified by `key` from the cache, reading and
+        publishing it if needed.
+
+        Parameters
+        ----------
+
+        key : tuple
+            Hashable key uniquely identifying the data (e.g., file, field and
+            read options).
+
+        read_function : callable
+            Function returning a tuple with the data array and its metadata.
+            Called only if the data is not already published.
+
+        Returns
+        -------
+        A tuple with the (read-only) data array and its metadata.
+        """
+        with self._local_lock:
+            if key in self._attached:
+                self._attached.move_to_end(key)
+                return self._attached[key][1:]
+        while True:
+            loading_entry = None
+            with self._registry_lock:
+                entry = self._registry.get(key)
+                if entry is None or self._is_abandoned(entry):
+                    loading_entry = {'state': 'loading', 'pid': os.getpid(),
+                                     'start_time': time.time()}
+                    self._registry[key] = loading_entry
+                elif entry['state'] == 'ready':
+                    entry['refcount'] += 1
+                    self._registry[key] = entry
+            if loading_entry is not None:
+                return self._read_and_publish(key, read_function,
+                                              loading_entry)
+            elif entry['state'] == 'ready':
+                return self._attach(key, entry)
+            # Another process is reading the data.
+            time.sleep(0.005)
+
+    def release_all(self):
+        """Detach this process from all the data blocks it is attached to."""
+        with self._local_lock:
+            while self._attached:
+                self._detach(*self._attached.popitem(last=False))
+            self._close_detached()
+
+    def shutdown(self):
+        """
+        Free all the data blocks and stop the manager process. Should only be
+        called by the process that created the cache, once the other
+        processes are done with it.
+        """
+        self.release_all()
+        if self._manager is None:
+            return
+        with self._registry_lock:
+            for entry in self._registry.values():
+                if entry['state'] == 'ready':
+                    _unlink_shared_memory(entry['name'])
+            self._registry.clear()
+        self._manager.shutdown()
+        self._manager = None
+
+    def _init_local_state(self):
+        """Initialize the per-process state."""
+        self._local_lock = threading.RLock()
+        self._attached = OrderedDict()
+        self._detached = []
+
+    def _is_abandoned(self, entry):
+        """
+        Returns whether the data of a registry entry is being read by a
+        process which no longer exists or for longer than `load_timeout`.
+        """
+        if entry['state'] != 'loading':
+            return False
+        if (self.load_timeout is not None and
+                time.time() - entry['start_time'] > self.load_timeout):
+            return True
+        return not _process_exists(entry['pid'])
+
+    def _read_and_publish(self, key, read_function, loading_entry):
+        """Read the data and publish it in a new shared memory block."""
+        try:
+            data, metadata = read_function()
+            data = np.asarray(data)
+            shm = _open_shared_memory(
+                name='vp_' + uuid.uuid4().hex[:24], create=True,
+                size=max(data.nbytes, 1))
+            shared_data = _get_shared_array(shm, data.shape, data.dtype)
+            shared_data[...] = data
+        except BaseException:
+            with self._registry_lock:
+                if self._registry.get(key) == loading_entry:
+                    del self._registry[key]
+            raise
+        entry = {'state': 'ready', 'name': shm.name, 'shape': data.shape,
+                 'dtype': data.dtype.str, 'metadata': metadata,
+                 'refcount': 1}
+        with self._registry_lock:
+            current_entry = self._registry.get(key)
+            published_by_other = (current_entry is not None and
+                                  current_entry['state'] == 'ready')
+            if published_by_other:
+                # Published by another process in the meantime (after the
+                # reading of this process was considered abandoned).
+                current_entry['refcount'] += 1
+                self._registry[key] = current_entry
+            else:
+                self._registry[key] = entry
+        if published_by_other:
+            del shared_data
+            shm.close()
+            _unlink(shm)
+            return self._attach(key, current_entry)
+        return self._add_attached(key, shm, shared_data, metadata)
+
+    def _attach(self, key, entry):
+        """Attach to a published data block."""
+        shm = _open_shared_memory(name=entry['name'])
+        shared_data = _get_shared_array(shm, entry['shape'], entry['dtype'])
+        return self._add_attached(key, shm, shared_data, entry['metadata'])
+
+    def _add_attached(self, key, shm, shared_data, metadata):
+        """Store an attached block, detaching the oldest ones if needed."""
+        shared_data.flags.writeable = False
+        with self._local_lock:
+            if key in self._attached:
+                # Attached concurrently by another thread.
+                self._detach(key, (shm, shared_data, metadata))
+                return self._attached[key][1:]
+            self._attached[key] = (shm, shared_data, metadata)
+            while len(self._attached) > max(self.max_attached, 1):
+                self._detach(*self._attached.popitem(last=False))
+            self._close_detached()
+        return shared_data, metadata
+
+    def _detach(self, key, attached):
+        """
+        Detach from a data block, freeing it if no other process is attached.
+        """
+        shm = attached[0]
+        with self._registry_lock:
+            entry = self._registry.get(key)
+            if entry is not None and entry.get('name') == shm.name:
+                entry['refcount'] -= 1
+                if entry['refcount'] > 0:
+                    self._registry[key] = entry
+                else:
+                    del self._registry[key]
+                    # The memory is only released once all views are closed.
+                    _unlink(shm)
+        self._detached.append(shm)
+
+    def _close_detached(self):
+        """
+        Close the detached blocks. Blocks still referenced by any array
+        returned to the user are kept open until the array is deleted.
+        """
+        still_open = []
+        for shm in self._detached:
+            try:
+                shm.close()
+            except BufferError:
+                still_open.append(shm)
+        self._detached = still_open
+
+
+_shared_field_cache = None
+
+
+def set_shared_field_cache(cache):
+    """
+    Set the SharedFieldCache used by all fields in this process (None to
+    disable it).
+    """
+    global _shared_field_cache
+    _shared_field_cache = cache
+
+
+def get_shared_field_cache():
+    """Returns the active SharedFieldCache of this process, if any."""
+    return _shared_field_cache
+
+
+def _get_shared_array(shm, shape, dtype):
+    """
+    Returns an array using the memory of a shared memory block. The array
+    (and any view of it) keeps the buffer of the block exported, so that the
+    block cannot be closed (and its memory unmapped) while the array exists.
+    """
+    count = int(np.prod(shape))
+    return np.frombuffer(shm.buf[:], dtype=dtype, count=count).reshape(shape)
+
+
+class _SharedMemory(shared_memory.SharedMemory):
+
+    """
+    SharedMemory which does not complain if, when garbage collected, it
+    cannot be closed because arrays using its memory still exist.
+    """
+
+    def __del__(self):
+        try:
+            self.close()
+        except (OSError, BufferError):
+            pass
+
+
+# The `track` argument of SharedMemory is only available in Python >= 3.13.
+_track_supported = 'track' in inspect.signature(
+    shared_memory.SharedMemory.__init__).parameters
+
+
+def _open_shared_memory(name, create=False, size=0):
+    """
+    Open a shared memory block without registering it in the resource
+    tracker. Otherwise, the tracker would free the block when the process
+    which opened it exits, even if other processes are still using it (see
+    https://bugs.python.org/issue39959). The blocks are instead freed by the
+    SharedFieldCache.
+    """
+    if _track_supported:
+        return _SharedMemory(name=name, create=create, size=size, track=False)
+    shm = _SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _unlink(shm):
+    """Free a shared memory block opened with `_open_shared_memory`."""
+    if not _track_supported:
+        # `unlink` unregisters the block from the resource tracker, so it has
+        # to be registered again to avoid a warning from the tracker.
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def _unlink_shared_memory(name):
+    """Free a shared memory block given its name."""
+    try:
+        shm = _open_shared_memory(name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    _unlink(shm)
+
+
+def _process_exists(pid):
+    """
+    Returns whether a process exists (and has not terminated). Without a way
+    to check it (i.e., on Windows), the process is assumed to exist.
+    """
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # Terminated processes which have not been waited for by their parent
+    # (zombies) still exist, but they will never publish the data.
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
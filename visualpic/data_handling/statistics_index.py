@@ -0,0 +1,393 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the StatisticsIndex class, which stores per-time-step
+statistics of the simulation data in a sidecar file.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import os
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from h5py import File as H5F, Group as H5Group
+from tqdm import tqdm
+
+
+# Name of the sidecar file created in the simulation folder by
+# `DataContainer.compute_statistics`.
+DEFAULT_INDEX_FILE_NAME = 'visualpic_statistics.h5'
+
+
+class StatisticsIndex():
+
+    """
+    Class providing an index of statistics (minimum, maximum, mean, number of
+    elements and a coarse histogram) of the data of each field and particle
+    species component at each time step.
+
+    The statistics are computed once, in a batch (or background) pass over
+    the data, and stored in a sidecar HDF5 file. They can then be queried
+    without reading the data, for example, to determine the colormap range
+    or the 'auto' opacity of a field in the 3D visualizer. The statistics are
+    computed in the original units of the data (those returned by
+    `get_data` when no units are specified). Fields are indexed with their
+    default read parameters (e.g., the `theta=0` plane of cylindrical
+    fields).
+
+    The index is attached to the fields and species of a DataContainer with
+    `DataContainer.set_statistics_index`, or created, computed and attached
+    in a single step with `DataContainer.compute_statistics`.
+    """
+
+    def __init__(self, file_path, n_bins=64):
+        """
+        Initialize the index. If the sidecar file already exists, the stored
+        statistics are loaded.
+
+        Parameters
+        ----------
+
+        file_path : str
+            Path to the sidecar file of the index.
+
+        n_bins : int
+            Number of bins of the histograms. Ignored if the sidecar file
+            already exists, in which case the stored number of bins is used.
+
+        """
+        self.file_path = file_path
+        self.n_bins = n_bins
+        self._lock = threading.RLock()
+        self._background_executor = None
+        self._entries = {}
+        if os.path.exists(file_path):
+            self.load()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_background_executor'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def compute(self, quantities, time_steps=None, components=None,
+                overwrite=False, parallel=False, n_proc=None, executor=None,
+                background=False):
+        """
+        Compute the statistics of the given fields and particle species and
+        store them in the sidecar file. The file is updated after each
+        quantity.
+
+        Parameters
+        ----------
+
+        quantities : Field, ParticleSpecies or list
+            The fields and/or particle species to index.
+
+        time_steps : array
+            (Optional) Time steps to index. If not specified, all time steps
+            of each quantity are indexed.
+
+        components : list
+            (Optional) Components to index for the particle species. If not
+            specified, all readable components in the data files are
+            indexed.
+
+        overwrite : bool
+            Whether to recompute statistics which are already in the index.
+
+        parallel : bool
+            Whether to process the time steps in parallel processes.
+
+        n_proc : int
+            (Optional) Number of processes used if `parallel=True`.
+
+        executor : AnalysisExecutor
+            (Optional) A persistent executor in which to process the time
+            steps. If given, `parallel` and `n_proc` are ignored.
+
+        background : bool
+            Whether to compute the statistics in a background thread. The
+            statistics of each quantity become available in the index as
+            soon as they are computed.
+
+        Returns
+        -------
+        The index itself or, if `background=True`, a Future which can be
+        used to wait for the computation to complete.
+        """
+        if background:
+            with self._lock:
+                if self._background_executor is None:
+                    self._background_executor = ThreadPoolExecutor(
+                        max_workers=1)
+            return self._background_executor.submit(
+                self.compute, quantities, time_steps=time_steps,
+                components=components, overwrite=overwrite,
+                parallel=parallel, n_proc=n_proc, executor=executor)
+        if not isinstance(quantities, list):
+            quantities = [quantities]
+        own_executor = parallel and executor is None
+        if own_executor:
+            from visualpic.analysis.analysis_executor import AnalysisExecutor
+            executor = AnalysisExecutor(n_proc)
+        try:
+            for quantity in quantities:
+                self._compute_quantity(quantity, time_steps, components,
+                                       overwrite, executor)
+        finally:
+            if own_executor:
+                executor.shutdown()
+        return self
+
+    def get_statistics(self, quantity, time_step, component=None):
+        """
+        Get the statistics of a field or particle species component at a
+        time step.
+
+        Parameters
+        ----------
+
+        quantity : Field or ParticleSpecies
+            The field or particle species.
+
+        time_step : int
+            Time step of the data.
+
+        component : str
+            Name of the component. Only needed for particle species.
+
+        Returns
+        -------
+        A dictionary with the 'min', 'max', 'mean', 'count' (number of
+        elements) and 'units' of the data, as well as its histogram ('hist')
+        and the edges of the histogram bins ('bin_edges'). If the statistics
+        are not in the index, None is returned.
+        """
+        key = _get_key(quantity, component)
+        with self._lock:
+            entry = self._entries.get(key, {}).get(time_step)
+        if entry is None:
+            return None
+        stats = dict(entry)
+        stats['bin_edges'] = np.linspace(*entry['hist_range'],
+                                         len(entry['hist']) + 1)
+        del stats['hist_range']
+        return stats
+
+    def get_global_range(self, quantity, time_steps=None, component=None):
+        """
+        Get the (min, max) range of the data of a field or particle species
+        component over several time steps.
+
+        Parameters
+        ----------
+
+        quantity : Field or ParticleSpecies
+            The field or particle species.
+
+        time_steps : array
+            (Optional) Time steps over which to compute the range. If not
+            specified, all time steps of the quantity are used.
+
+        component : str
+            Name of the component. Only needed for particle species.
+
+        Returns
+        -------
+        A tuple with the range, or None if the statistics of any time step are
+        not in the index.
+        """
+        if time_steps is None:
+            time_steps = quantity.timesteps
+        key = _get_key(quantity, component)
+        r_min, r_max = np.nan, np.nan
+        with self._lock:
+            entries = self._entries.get(key, {})
+            for time_step in time_steps:
+                entry = entries.get(time_step)
+                if entry is None:
+                    return None
+                # NaNs (empty time steps) are ignored.
+                r_min = np.fmin(r_min, entry['min'])
+                r_max = np.fmax(r_max, entry['max'])
+        return r_min, r_max
+
+    def contains(self, quantity, time_step, component=None):
+        """
+        Returns whether the statistics of a field or particle species
+        component at a time step are in the index.
+        """
+        key = _get_key(quantity, component)
+        with self._lock:
+            return time_step in self._entries.get(key, {})
+
+    def load(self):
+        """Load the statistics stored in the sidecar file."""
+        entries = {}
+
+        def load_group(name, obj):
+            if not isinstance(obj, H5Group) or 'timesteps' not in obj:
+                return
+            units = obj.attrs['units']
+            keys = ['min', 'max', 'mean', 'count', 'hist', 'hist_range']
+            data = {k: obj[k][()] for k in keys}
+            entries[name] = {}
+            for i, time_step in enumerate(obj['timesteps'][()]):
+                entry = {k: data[k][i] for k in keys}
+                entry['count'] = int(entry['count'])
+                entry['units'] = units
+                entries[name][time_step] = entry
+
+        with H5F(self.file_path, 'r') as f:
+            self.n_bins = int(f.attrs['n_bins'])
+            f.visititems(load_group)
+        with self._lock:
+            self._entries = entries
+
+    def save(self):
+        """
+        Save the statistics into the sidecar file. The file is first written
+        to a temporary file, which is only renamed once complete.
+        """
+        tmp_path = self.file_path + '.tmp'
+        with self._lock:
+            try:
+                with H5F(tmp_path, 'w') as f:
+                    f.attrs['n_bins'] = self.n_bins
+                    for key, entries in self._entries.items():
+                        if len(entries) == 0:
+                            continue
+                        group = f.create_group(key)
+                        time_steps = sorted(entries)
+                        group.attrs['units'] = (
+                            entries[time_steps[0]]['units'])
+                        group.create_dataset('timesteps', data=time_steps)
+                        for k in ['min', 'max', 'mean', 'count', 'hist',
+                                  'hist_range']:
+                            group.create_dataset(
+                                k, data=np.array(
+                                    [entries[ts][k] for ts in time_steps]))
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            os.replace(tmp_path, self.file_path)
+
+    def _compute_quantity(self, quantity, time_steps, components, overwrite,
+                          executor):
+        """Compute and store the statistics of a field or species."""
+        from visualpic.data_handling.particle_species import ParticleSpecies
+        is_species = isinstance(quantity, ParticleSpecies)
+        if is_species:
+            if components is None:
+                components = quantity.get_list_of_readable_components(
+                    quantity.timesteps[0])
+            keys = components
+            name = quantity.species_name
+        else:
+            keys = [None]
+            name = quantity.get_name()
+        available_steps = quantity.timesteps
+        if time_steps is not None:
+            quantity_steps = set(available_steps)
+            available_steps = [ts for ts in time_steps
+                               if ts in quantity_steps]
+        pending_steps = [
+            ts for ts in available_steps if overwrite or not all(
+                self.contains(quantity, ts, key) for key in keys)]
+        if len(pending_steps) == 0:
+            return
+        if is_species:
+            part = partial(compute_species_statistics, species=quantity,
+                           components=components, n_bins=self.n_bins)
+        else:
+            part = partial(compute_field_statistics, field=quantity,
+                           n_bins=self.n_bins)
+        tqdm_params = {
+            'ascii': True,
+            'desc': "Computing statistics of '{}'... ".format(name)}
+        if executor is not None:
+            results = executor.map(part, pending_steps, **tqdm_params)
+        else:
+            results = [part(ts) for ts in tqdm(pending_steps, **tqdm_params)]
+        with self._lock:
+            for time_step, result in zip(pending_steps, results):
+                for key in keys:
+                    entry = result[key] if is_species else result
+                    self._entries.setdefault(
+                        _get_key(quantity, key), {})[time_step] = entry
+            self.save()
+
+
+def compute_field_statistics(time_step, field, n_bins):
+    """Compute the statistics of the data of a field at a time step."""
+    fld, fld_md = field.get_data(time_step)
+    return compute_data_statistics(fld, fld_md['field']['units'], n_bins)
+
+
+def compute_species_statistics(time_step, species, components, n_bins):
+    """
+    Compute the statistics of the components of a particle species at a time
+    step. Returns a dictionary with the statistics of each component.
+    """
+    data = species.get_data(time_step, components)
+    stats = {}
+    for comp in components:
+        comp_data, comp_md = data[comp]
+        stats[comp] = compute_data_statistics(
+            comp_data, comp_md.get('units', ''), n_bins)
+    return stats
+
+
+def compute_data_statistics(data, units, n_bins):
+    """
+    Compute the statistics of a data array. NaNs are ignored, except in the
+    number of elements.
+    """
+    data = np.asarray(data)
+    if data.size == 0 or np.all(np.isnan(data)):
+        v_min = v_max = v_mean = np.nan
+        hist_range = np.array([0., 1.])
+        hist = np.zeros(n_bins, dtype=np.int64)
+    else:
+        v_min = float(np.nanmin(data))
+        v_max = float(np.nanmax(data))
+        v_mean = float(np.nanmean(data))
+        if v_max > v_min:
+            hist_range = np.array([v_min, v_max])
+        else:
+            hist_range = np.array([v_min - 0.5, v_min + 0.5])
+        hist, _ = np.histogram(data, bins=n_bins, range=hist_range)
+    return {'min': v_min, 'max': v_max, 'mean': v_mean, 'count': data.size,
+            'hist': hist, 'hist_range': hist_range, 'units': units}
+
+
+def rebin_histogram(stats, bin_edges):
+    """
+    Estimate the histogram of the data with the given bins from the coarse
+    histogram in `stats` (as returned by `StatisticsIndex.get_statistics`),
+    assuming the data is uniformly distributed within each coarse bin. Data
+    outside the given bins is added to the first and last bins.
+    """
+    counts = np.concatenate(([0], np.cumsum(stats['hist'])))
+    cumulative = np.interp(bin_edges, stats['bin_edges'], counts)
+    cumulative[0] = 0
+    cumulative[-1] = counts[-1]
+    return np.round(np.diff(cumulative))
+
+
+def _get_key(quantity, component=None):
+    """Returns the key identifying a field or species component."""
+    if component is not None:
+        return 'species/{}/{}'.format(quantity.species_name, component)
+    return 'fields/{}'.format(quantity.get_name())
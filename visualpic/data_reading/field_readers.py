@@ -8,48 +8,142 @@ License: GNU GPL-3.0.
 """
 
 import os
+import zlib
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
 
-from h5py import File as H5F
+from h5py import File as H5F, h5d, h5z
 import numpy as np
 
+from visualpic.data_reading.reader_locks import ReaderLocks
+from visualpic.data_reading.store_format import get_iteration_path
+
 
 class FieldReader():
-    def __init__(self, *args, **kwargs):
+
+    """
+    Base class for all field readers.
+
+    The readers are thread-safe: `read_field` can be called concurrently from
+    several threads. Reads accessing the same data file are serialized using
+    the locks in `reader_locks`, while reads of different files can run
+    concurrently. Readers which rely on a shared stateful backend (such as the
+    DataReader of the openPMD-viewer) should share a single `ReaderLocks`
+    instance created with `per_file=False`. The returned field data is always
+    an in-memory array (never a lazy h5py dataset), so that it can be used
+    once the lock is released.
+
+    Readers of HDF5 files memory-map the contiguous, unfiltered datasets
+    instead of reading them (see `_read_h5_dataset`), unless `use_memmap` is
+    False. The data is mapped copy-on-write, so the returned arrays can be
+    modified without affecting the data files. Large chunked datasets are
+    instead read chunk by chunk, decompressing the chunks in `n_threads`
+    parallel threads (all available cores if None).
+    """
+
+    def __init__(self, *args, reader_locks=None, use_memmap=True,
+                 n_threads=None, **kwargs):
+        if reader_locks is None:
+            reader_locks = ReaderLocks()
+        self.reader_locks = reader_locks
+        self.use_memmap = use_memmap
+        self.n_threads = n_threads
         return super().__init__(*args, **kwargs)
 
     def read_field(
             self, file_path, iteration, field_path, slice_i=0.5, slice_j=0.5,
             slice_dir_i=None, slice_dir_j=None, m='all', theta=0,
-            max_resolution_3d=None, only_metadata=False):
+            max_resolution_3d=None, only_metadata=False, index_region=None):
+        """
+        Read the field data and metadata.
+
+        If `index_region` is given, only the data within the region is
+        returned (and read, if supported by the reader). It should be a list
+        with a (start, stop) index pair for each of the (final) field axes, in
+        the same order as 'axis_labels'. It cannot be combined with
+        `slice_dir_i` or `slice_dir_j`.
+        """
+        if index_region is not None and (slice_dir_i is not None or
+                                         slice_dir_j is not None):
+            raise ValueError(
+                "'index_region' cannot be combined with 'slice_dir_i' or "
+                "'slice_dir_j'.")
+        with self.reader_locks.get_lock(file_path):
+            return self._read_field(
+                file_path, iteration, field_path, slice_i, slice_j,
+                slice_dir_i, slice_dir_j, m, theta, max_resolution_3d,
+                only_metadata, index_region)
+
+    def _read_field(
+            self, file_path, iteration, field_path, slice_i, slice_j,
+            slice_dir_i, slice_dir_j, m, theta, max_resolution_3d,
+            only_metadata, index_region=None):
         fld_metadata = self._read_field_metadata(
             file_path, iteration, field_path)
-        if not only_metadata:
-            geom = fld_metadata['field']['geometry']
-            if geom == "1d":
-                fld = self._read_field_1d(file_path, iteration, field_path,
-                                          fld_metadata)
-            elif geom == "2dcartesian":
-                fld = self._read_field_2d_cart(
-                    file_path, iteration, field_path, fld_metadata, slice_i,
-                    slice_dir_i)
-            elif geom == "3dcartesian":
-                fld = self._read_field_3d_cart(
-                    file_path, iteration, field_path, fld_metadata, slice_i,
-                    slice_j, slice_dir_i, slice_dir_j)
-            elif geom == "cylindrical":
-                fld = self._read_field_2d_cyl(
-                    file_path, iteration, field_path, fld_metadata, theta,
-                    slice_i, slice_dir_i, max_resolution_3d)
-            elif geom == "thetaMode":
-                fld = self._read_field_theta(
-                    file_path, iteration, field_path, fld_metadata, m, theta,
-                    slice_i, slice_dir_i, max_resolution_3d)
-        else:
+        if only_metadata:
             fld = np.array([])
+        elif index_region is not None:
+            fld = self._read_field_region(
+                file_path, iteration, field_path, fld_metadata, m, theta,
+                max_resolution_3d, index_region)
+        else:
+            fld = self._read_field_data(
+                file_path, iteration, field_path, fld_metadata, slice_i,
+                slice_j, slice_dir_i, slice_dir_j, m, theta,
+                max_resolution_3d)
         self._readjust_metadata(fld_metadata, slice_dir_i, slice_dir_j, theta,
                                 max_resolution_3d)
+        if index_region is not None:
+            axis_labels = fld_metadata['field']['axis_labels']
+            for label, (start, stop) in zip(axis_labels, index_region):
+                axis_md = fld_metadata['axis'][label]
+                axis_md['array'] = axis_md['array'][start:stop]
         return fld, fld_metadata
 
+    def _read_field_data(
+            self, file_path, iteration, field_path, fld_metadata, slice_i,
+            slice_j, slice_dir_i, slice_dir_j, m, theta, max_resolution_3d):
+        """Read the field data according to its geometry."""
+        geom = fld_metadata['field']['geometry']
+        if geom == "1d":
+            fld = self._read_field_1d(file_path, iteration, field_path,
+                                      fld_metadata)
+        elif geom == "2dcartesian":
+            fld = self._read_field_2d_cart(
+                file_path, iteration, field_path, fld_metadata, slice_i,
+                slice_dir_i)
+        elif geom == "3dcartesian":
+            fld = self._read_field_3d_cart(
+                file_path, iteration, field_path, fld_metadata, slice_i,
+                slice_j, slice_dir_i, slice_dir_j)
+        elif geom == "cylindrical":
+            fld = self._read_field_2d_cyl(
+                file_path, iteration, field_path, fld_metadata, theta,
+                slice_i, slice_dir_i, max_resolution_3d)
+        elif geom == "thetaMode":
+            fld = self._read_field_theta(
+                file_path, iteration, field_path, fld_metadata, m, theta,
+                slice_i, slice_dir_i, max_resolution_3d)
+        return fld
+
+    def _read_field_region(
+            self, file_path, iteration, field_path, field_md, m, theta,
+            max_resolution_3d, index_region):
+        """
+        Read the field data within an index region. By default, the full
+        field is read and then cropped. Readers which can read a hyperslab
+        directly from file should override this method.
+        """
+        fld = self._read_field_data(
+            file_path, iteration, field_path, field_md, 0.5, 0.5, None, None,
+            m, theta, max_resolution_3d)
+        return fld[_get_region_slices(index_region)]
+
+    def _read_h5_dataset(self, dataset, selection=Ellipsis):
+        """Read the selected data of an HDF5 dataset."""
+        return _read_h5_dataset(dataset, selection, self.use_memmap,
+                                self.n_threads)
+
     def _readjust_metadata(self, field_metadata, slice_dir_i, slice_dir_j,
                            theta, max_resolution_3d):
         geom = field_metadata['field']['geometry']
@@ -124,48 +218,57 @@ class OsirisFieldReader(FieldReader):
         return super().__init__(*args, **kwargs)
 
     def _read_field_1d(self, file_path, iteration, field_path, field_md):
-        file = H5F(file_path, 'r')
-        return file[field_path]
+        with H5F(file_path, 'r') as file:
+            return self._read_h5_dataset(file[field_path])
 
     def _read_field_2d_cart(
             self, file_path, iteration, field_path, field_md, slice_i=0.5,
             slice_dir_i=None):
-        file = H5F(file_path, 'r')
-        fld = file[field_path]
-        if slice_dir_i is not None:
-            fld_shape = fld.shape
-            axis_order = ['z', 'x']
-            slice_list = [slice(None)] * fld.ndim
-            axis_idx_i = axis_order.index(slice_dir_i)
-            axis_elements_i = fld_shape[axis_idx_i]
-            slice_idx_i = int(round(axis_elements_i * slice_i))
-            slice_list[axis_idx_i] = slice_idx_i
-            fld = fld[tuple(slice_list)]
+        with H5F(file_path, 'r') as file:
+            fld = file[field_path]
+            if slice_dir_i is not None:
+                fld_shape = fld.shape
+                axis_order = ['z', 'x']
+                slice_list = [slice(None)] * fld.ndim
+                axis_idx_i = axis_order.index(slice_dir_i)
+                axis_elements_i = fld_shape[axis_idx_i]
+                slice_idx_i = int(round(axis_elements_i * slice_i))
+                slice_list[axis_idx_i] = slice_idx_i
+                fld = self._read_h5_dataset(fld, tuple(slice_list))
+            else:
+                fld = self._read_h5_dataset(fld)
         return fld
 
     def _read_field_3d_cart(
             self, file_path, iteration, field_path, field_md, slice_i=0.5,
             slice_j=0.5, slice_dir_i=None, slice_dir_j=None):
-        file = H5F(file_path, 'r')
-        fld = file[field_path]
-        if slice_dir_i is not None:
-            fld_shape = fld.shape
-            axis_order = ['x', 'y', 'z']
-            slice_list = [slice(None)] * fld.ndim
-            axis_idx_i = axis_order.index(slice_dir_i)
-            axis_elements_i = fld_shape[axis_idx_i]
-            slice_idx_i = int(round(axis_elements_i * slice_i))
-            slice_list[axis_idx_i] = slice_idx_i
-            if slice_dir_j is not None:
-                axis_idx_j = axis_order.index(slice_dir_j)
-                axis_elements_j = fld_shape[axis_idx_j]
-                slice_idx_j = int(round(axis_elements_j * slice_j))
-                slice_list[axis_idx_j] = slice_idx_j
-            fld = fld[tuple(slice_list)]
-        else:
-            fld = fld[:]
+        with H5F(file_path, 'r') as file:
+            fld = file[field_path]
+            if slice_dir_i is not None:
+                fld_shape = fld.shape
+                axis_order = ['x', 'y', 'z']
+                slice_list = [slice(None)] * fld.ndim
+                axis_idx_i = axis_order.index(slice_dir_i)
+                axis_elements_i = fld_shape[axis_idx_i]
+                slice_idx_i = int(round(axis_elements_i * slice_i))
+                slice_list[axis_idx_i] = slice_idx_i
+                if slice_dir_j is not None:
+                    axis_idx_j = axis_order.index(slice_dir_j)
+                    axis_elements_j = fld_shape[axis_idx_j]
+                    slice_idx_j = int(round(axis_elements_j * slice_j))
+                    slice_list[axis_idx_j] = slice_idx_j
+                fld = self._read_h5_dataset(fld, tuple(slice_list))
+            else:
+                fld = self._read_h5_dataset(fld)
         return fld
 
+    def _read_field_region(
+            self, file_path, iteration, field_path, field_md, m, theta,
+            max_resolution_3d, index_region):
+        with H5F(file_path, 'r') as file:
+            return self._read_h5_dataset(file[field_path],
+                                         _get_region_slices(index_region))
+
     def _read_field_metadata(self, file_path, iteration, field_path):
         file = H5F(file_path, 'r')
         md = {}
@@ -262,8 +365,8 @@ class HiPACEFieldReader(FieldReader):
     def _read_field_3d_cart(
             self, file_path, iteration, field_path, field_md, slice_i=0.5,
             slice_j=0.5, slice_dir_i=None, slice_dir_j=None):
-        file = H5F(file_path, 'r')
-        fld = file[field_path]
+        with H5F(file_path, 'r') as file:
+            fld = self._read_h5_dataset(file[field_path])
         fld = np.moveaxis(fld, 0, 2)
         if slice_dir_i is not None:
             fld_shape = fld.shape
@@ -281,6 +384,17 @@ class HiPACEFieldReader(FieldReader):
             fld = fld[tuple(slice_list)]
         return fld
 
+    def _read_field_region(
+            self, file_path, iteration, field_path, field_md, m, theta,
+            max_resolution_3d, index_region):
+        # The arrays in file are ordered as ['z', 'x', 'y'].
+        x_range, y_range, z_range = index_region
+        with H5F(file_path, 'r') as file:
+            fld = self._read_h5_dataset(
+                file[field_path],
+                _get_region_slices([z_range, x_range, y_range]))
+        return np.moveaxis(fld, 0, 2)
+
     def _read_field_metadata(self, file_path, iteration, field_path):
         file = H5F(file_path, 'r')
         md = {}
@@ -340,7 +454,7 @@ class HiPACEFieldReader(FieldReader):
 
 
 class OpenPMDFieldReader(FieldReader):
-    def __init__(self, opmd_reader,  *args, **kwargs):
+    def __init__(self, opmd_reader, *args, **kwargs):
         self._opmd_reader = opmd_reader
         return super().__init__(*args, **kwargs)
 
@@ -524,3 +638,264 @@ class OpenPMDFieldReader(FieldReader):
             return 'C/m^3'
         elif field == 'J':
             return 'A'
+
+
+class VisualPICFieldReader(FieldReader):
+
+    """
+    Field reader for the data stores created by `convert_simulation`. Each
+    store contains all time steps of a field in SI units, together with the
+    precomputed metadata, so that no other file needs to be read.
+    """
+
+    def __init__(self, *args, **kwargs):
+        return super().__init__(*args, **kwargs)
+
+    def _read_field_1d(self, file_path, iteration, field_path, field_md):
+        return self._read_sliced_field(file_path, iteration, field_md, [])
+
+    def _read_field_2d_cart(
+            self, file_path, iteration, field_path, field_md, slice_i=0.5,
+            slice_dir_i=None):
+        return self._read_sliced_field(file_path, iteration, field_md,
+                                       [(slice_dir_i, slice_i)])
+
+    def _read_field_3d_cart(
+            self, file_path, iteration, field_path, field_md, slice_i=0.5,
+            slice_j=0.5, slice_dir_i=None, slice_dir_j=None):
+        return self._read_sliced_field(
+            file_path, iteration, field_md,
+            [(slice_dir_i, slice_i), (slice_dir_j, slice_j)])
+
+    def _read_field_region(
+            self, file_path, iteration, field_path, field_md, m, theta,
+            max_resolution_3d, index_region):
+        with H5F(file_path, 'r') as file:
+            group = file[get_iteration_path(iteration)]
+            return self._read_h5_dataset(group['data'],
+                                         _get_region_slices(index_region))
+
+    def _read_sliced_field(self, file_path, iteration, field_md, slices):
+        """
+        Read the field data, slicing it along the given directions. The
+        arrays in file are ordered as the 'axis_labels' of the field.
+        """
+        axis_labels = field_md['field']['axis_labels']
+        with H5F(file_path, 'r') as file:
+            fld = file[get_iteration_path(iteration)]['data']
+            slice_list = [slice(None)] * fld.ndim
+            for slice_dir, slice_pos in slices:
+                if slice_dir is not None:
+                    axis_idx = axis_labels.index(slice_dir)
+                    axis_elements = fld.shape[axis_idx]
+                    slice_idx = int(round(axis_elements * slice_pos))
+                    slice_list[axis_idx] = min(slice_idx, axis_elements - 1)
+            return self._read_h5_dataset(fld, tuple(slice_list))
+
+    def _read_field_metadata(self, file_path, iteration, field_path):
+        with H5F(file_path, 'r') as file:
+            group = file[get_iteration_path(iteration)]
+            axis_labels = [str(label) for label in file.attrs['axis_labels']]
+            md = {}
+            md['field'] = {}
+            md['field']['units'] = file.attrs['units']
+            md['field']['geometry'] = file.attrs['geometry']
+            md['field']['axis_labels'] = axis_labels
+            md['axis'] = {}
+            for label in axis_labels:
+                axis = group['axes'][label]
+                md['axis'][label] = {}
+                md['axis'][label]['units'] = axis.attrs['units']
+                md['axis'][label]['array'] = axis[()]
+            md['time'] = {}
+            md['time']['value'] = group.attrs['time']
+            md['time']['units'] = file.attrs['time_units']
+        return md
+
+
+def _get_region_slices(index_region):
+    """Convert a list of (start, stop) index pairs into a tuple of slices."""
+    return tuple(slice(start, stop) for start, stop in index_region)
+
+
+def _read_h5_dataset(dataset, selection=Ellipsis, use_memmap=True,
+                     n_threads=None):
+    """
+    Read the selected data of an HDF5 dataset.
+
+    If the dataset is stored contiguously in the file and without filters
+    (such as compression), the data is not read but memory-mapped with
+    `np.memmap`. This avoids copying the whole dataset into memory: only the
+    pages actually accessed are loaded, and they are served by the page cache
+    of the operating system in successive accesses. The data is mapped
+    copy-on-write, so the returned array can be modified (only the modified
+    pages are copied) without changing the file. Large selections of chunked datasets are
+    read in parallel (see `_read_h5_chunks`). Otherwise, the data is read
+    normally.
+    """
+    if use_memmap:
+        offset = _get_contiguous_offset(dataset)
+        if offset is not None:
+            data = np.memmap(dataset.file.filename, dtype=dataset.dtype,
+                             mode='c', offset=offset, shape=dataset.shape)
+            return data.view(np.ndarray)[selection]
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    if n_threads > 1:
+        data = _read_h5_chunks(dataset, selection, n_threads)
+        if data is not None:
+            return data
+    return dataset[selection]
+
+
+# Minimum size (in bytes) of the selected data of a chunked dataset for it to
+# be read in parallel. Smaller reads are not worth the overhead.
+_MIN_PARALLEL_READ_SIZE = 16 * 1024**2
+
+# Filters which can be undone when reading the raw chunks of a dataset.
+_SUPPORTED_FILTERS = [h5z.FILTER_DEFLATE, h5z.FILTER_SHUFFLE]
+
+
+def _read_h5_chunks(dataset, selection, n_threads):
+    """
+    Read the selected data of a chunked HDF5 dataset in parallel.
+
+    The chunks overlapping the selection are read in raw form with
+    `read_direct_chunk`, bypassing the (serial) filter pipeline of HDF5. They
+    are then decompressed (gzip) and unshuffled in a pool of threads, which
+    write them directly into a single preallocated output array. Since
+    `zlib` and numpy release the GIL, the decompression runs concurrently
+    with the reading of the next chunks.
+
+    Returns None if the dataset, its filters or the selection (only slices
+    with unit step and integers are supported) cannot be read this way.
+    """
+    filters = _get_chunk_filters(dataset)
+    if filters is None:
+        return None
+    region = _get_selection_region(selection, dataset.shape)
+    if region is None:
+        return None
+    starts, stops, squeeze = region
+    out_shape = tuple(stop - start for start, stop in zip(starts, stops))
+    size = int(np.prod(out_shape)) * dataset.dtype.itemsize
+    if size == 0 or size < _MIN_PARALLEL_READ_SIZE:
+        return None
+    chunks = dataset.chunks
+    chunk_offsets = product(*[range(start - start % c, stop, c) for
+                              start, stop, c in zip(starts, stops, chunks)])
+    out = np.empty(out_shape, dtype=dataset.dtype)
+
+    def read_chunk(offset):
+        chunk = _read_raw_chunk(dataset, offset, filters)
+        src = []
+        dst = []
+        for o, c, start, stop in zip(offset, chunks, starts, stops):
+            c_start = max(o, start)
+            c_stop = min(o + c, stop)
+            src.append(slice(c_start - o, c_stop - o))
+            dst.append(slice(c_start - start, c_stop - start))
+        if chunk is None:
+            out[tuple(dst)] = dataset.fillvalue
+        else:
+            out[tuple(dst)] = chunk[tuple(src)]
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        # Consume the results to raise any exception.
+        for _ in pool.map(read_chunk, chunk_offsets):
+            pass
+    return out[squeeze]
+
+
+def _get_chunk_filters(dataset):
+    """
+    Returns the list of filters of a chunked dataset, or None if the dataset
+    cannot be read chunk by chunk (e.g., if it uses unsupported filters).
+    """
+    if (dataset.chunks is None or dataset.is_virtual or
+            dataset.dtype.kind not in 'biufc' or
+            not hasattr(dataset.id, 'read_direct_chunk')):
+        return None
+    dcpl = dataset.id.get_create_plist()
+    filters = [dcpl.get_filter(i)[0] for i in range(dcpl.get_nfilters())]
+    if any(f not in _SUPPORTED_FILTERS for f in filters):
+        return None
+    return filters
+
+
+def _get_selection_region(selection, shape):
+    """
+    Convert a selection into the start and stop indices of each dimension
+    and the indices needed to remove the dimensions selected by an integer.
+    Returns None if the selection is not supported.
+    """
+    if selection is Ellipsis:
+        selection = ()
+    elif not isinstance(selection, tuple):
+        selection = (selection,)
+    if len(selection) > len(shape):
+        return None
+    selection = selection + (slice(None),) * (len(shape) - len(selection))
+    starts = []
+    stops = []
+    squeeze = []
+    for sel, n in zip(selection, shape):
+        if isinstance(sel, slice):
+            start, stop, step = sel.indices(n)
+            if step != 1:
+                return None
+            stop = max(start, stop)
+            squeeze.append(slice(None))
+        elif isinstance(sel, (int, np.integer)):
+            start = sel + n if sel < 0 else int(sel)
+            if start < 0 or start >= n:
+                return None
+            stop = start + 1
+            squeeze.append(0)
+        else:
+            return None
+        starts.append(start)
+        stops.append(stop)
+    return starts, stops, tuple(squeeze)
+
+
+def _read_raw_chunk(dataset, offset, filters):
+    """
+    Read and decode the chunk of a dataset starting at `offset`. Returns None
+    if the chunk has not been written to file.
+    """
+    try:
+        filter_mask, data = dataset.id.read_direct_chunk(offset)
+    except RuntimeError:
+        # The chunk storage is not allocated.
+        return None
+    # Undo the filters in reverse order, skipping those disabled for this
+    # chunk in the filter mask.
+    for i in reversed(range(len(filters))):
+        if filter_mask & (1 << i):
+            continue
+        if filters[i] == h5z.FILTER_DEFLATE:
+            data = zlib.decompress(data)
+        elif filters[i] == h5z.FILTER_SHUFFLE:
+            itemsize = dataset.dtype.itemsize
+            data = np.frombuffer(data, dtype=np.uint8)
+            data = np.ascontiguousarray(data.reshape(itemsize, -1).T)
+    return np.frombuffer(data, dtype=dataset.dtype).reshape(dataset.chunks)
+
+
+def _get_contiguous_offset(dataset):
+    """
+    Returns the offset (in bytes) of the data of an HDF5 dataset within the
+    file if it can be memory-mapped, i.e., if it is stored contiguously,
+    without filters and in a single file. Otherwise (including compact
+    datasets and those whose storage has not been allocated), returns None.
+    """
+    if (dataset.chunks is not None or dataset.is_virtual or
+            dataset.external is not None or dataset.size == 0 or
+            dataset.dtype.hasobject or dataset.file.driver != 'sec2'):
+        return None
+    layout = dataset.id.get_create_plist().get_layout()
+    if layout != h5d.CONTIGUOUS:
+        return None
+    # The offset is undefined (None) if the storage is not allocated.
+    return dataset.id.get_offset()
@@ -17,6 +17,9 @@ from openpmd_viewer.openpmd_timeseries.data_reader import DataReader
 import visualpic.data_reading.field_readers as fr
 import visualpic.data_reading.particle_readers as pr
 import visualpic.data_handling.unit_converters as uc
+from visualpic.data_reading.reader_locks import ReaderLocks
+from visualpic.data_reading.store_format import (
+    FIELDS_FOLDER, SPECIES_FOLDER)
 from visualpic.data_handling.fields import FolderField
 from visualpic.data_handling.particle_species import ParticleSpecies
 
@@ -78,8 +81,13 @@ class OpenPMDFolderScanner(FolderScanner):
 
         """
         self.opmd_reader = DataReader(opmd_backend)
-        self.field_reader = fr.OpenPMDFieldReader(self.opmd_reader)
-        self.particle_reader = pr.OpenPMDParticleReader(self.opmd_reader)
+        # The DataReader is not thread-safe and is shared by both readers,
+        # so all access to it is serialized with a single lock.
+        self.reader_locks = ReaderLocks(per_file=False)
+        self.field_reader = fr.OpenPMDFieldReader(
+            self.opmd_reader, reader_locks=self.reader_locks)
+        self.particle_reader = pr.OpenPMDParticleReader(
+            self.opmd_reader, reader_locks=self.reader_locks)
         self.unit_converter = uc.OpenPMDUnitConverter()
 
     def get_list_of_fields(self, folder_path):
@@ -96,6 +104,28 @@ class OpenPMDFolderScanner(FolderScanner):
         -------
         A list of FolderField objects
         """
+        with self.reader_locks.get_lock():
+            return self._get_list_of_fields(folder_path)
+
+    def get_list_of_species(self, folder_path):
+        """
+        Get list of species in the specified path.
+
+        Parameters
+        ----------
+
+        folder_path : str
+            Path to the folder containing the simulation data.
+
+        Returns
+        -------
+        A list of ParticleSpecies objects
+        """
+        with self.reader_locks.get_lock():
+            return self._get_list_of_species(folder_path)
+
+    def _get_list_of_fields(self, folder_path):
+        """Scan the openPMD data and create the list of fields."""
         field_list = []
         iterations = self.opmd_reader.list_iterations(folder_path)
 
@@ -168,20 +198,8 @@ class OpenPMDFolderScanner(FolderScanner):
                     )
         return field_list
 
-    def get_list_of_species(self, folder_path):
-        """
-        Get list of species in the specified path.
-
-        Parameters
-        ----------
-
-        folder_path : str
-            Path to the folder containing the simulation data.
-
-        Returns
-        -------
-        A list of ParticleSpecies objects
-        """
+    def _get_list_of_species(self, folder_path):
+        """Scan the openPMD data and create the list of species."""
         species_list = []
         iterations = self.opmd_reader.list_iterations(folder_path)
 
@@ -720,3 +738,85 @@ class HiPACEFolderScanner(FolderScanner):
             time_step = int(file.split('_')[-1].split('.')[0])
             time_steps[i] = time_step
         return field_files, time_steps
+
+
+class VisualPICFolderScanner(FolderScanner):
+
+    "Folder scanner class for the data stores created by `convert_simulation`."
+
+    def __init__(self):
+        """
+        Initialize the folder scanner and assign corresponding data readers
+        and unit converter.
+        """
+        self.field_reader = fr.VisualPICFieldReader()
+        self.particle_reader = pr.VisualPICParticleReader()
+        # The data in the stores is already in SI units, as in openPMD.
+        self.unit_converter = uc.OpenPMDUnitConverter()
+
+    def get_list_of_fields(self, folder_path):
+        """
+        Get list of fields in the specified path.
+
+        Parameters
+        ----------
+
+        folder_path : str
+            Path to the folder containing the simulation data.
+
+        Returns
+        -------
+        A list of FolderField objects
+        """
+        field_list = []
+        fields_folder = os.path.join(folder_path, FIELDS_FOLDER)
+        for file_path in self._get_store_files(fields_folder):
+            with H5F(file_path, 'r') as file:
+                field_name = file.attrs['name']
+                species_name = file.attrs['species_name']
+                time_steps = file['timesteps'][()]
+            if species_name == '':
+                species_name = None
+            field_list.append(
+                FolderField(field_name, field_name,
+                            [file_path] * len(time_steps), time_steps,
+                            self.field_reader, self.unit_converter,
+                            species_name))
+        return field_list
+
+    def get_list_of_species(self, folder_path):
+        """
+        Get list of species in the specified path.
+
+        Parameters
+        ----------
+
+        folder_path : str
+            Path to the folder containing the simulation data.
+
+        Returns
+        -------
+        A list of ParticleSpecies objects
+        """
+        species_list = []
+        species_folder = os.path.join(folder_path, SPECIES_FOLDER)
+        for file_path in self._get_store_files(species_folder):
+            with H5F(file_path, 'r') as file:
+                species_name = file.attrs['name']
+                components = [str(comp) for comp in file.attrs['components']]
+                time_steps = file['timesteps'][()]
+            species_list.append(
+                ParticleSpecies(species_name, components, time_steps,
+                                [file_path] * len(time_steps),
+                                self.particle_reader, self.unit_converter))
+        return species_list
+
+    def _get_store_files(self, folder_path):
+        """Returns a sorted list with all stores within a folder."""
+        store_files = []
+        if os.path.isdir(folder_path):
+            for root, dirs, files in os.walk(folder_path):
+                for file in files:
+                    if file.endswith('.h5'):
+                        store_files.append(os.path.join(root, file))
+        return sorted(store_files)
@@ -7,30 +7,130 @@ Copyright 2016-2020, Angel Ferran Pousa.
 License: GNU GPL-3.0.
 """
 
-from h5py import File as H5F
+from h5py import File as H5F, Group as H5Group
 import numpy as np
+from scipy.constants import c as speed_of_light
+
+from visualpic.data_reading.reader_locks import ReaderLocks
+from visualpic.data_reading.store_format import get_iteration_path
 
 
 class ParticleReader():
-    def __init__(self, *args, **kwargs):
+
+    """
+    Base class for all particle readers.
+
+    The readers are thread-safe: `read_particle_data` can be called
+    concurrently from several threads. Reads accessing the same data file are
+    serialized using the locks in `reader_locks`, while reads of different
+    files can run concurrently. Readers which rely on a shared stateful
+    backend (such as the DataReader of the openPMD-viewer) should share a
+    single `ReaderLocks` instance created with `per_file=False`.
+    """
+
+    def __init__(self, *args, reader_locks=None, **kwargs):
+        if reader_locks is None:
+            reader_locks = ReaderLocks()
+        self.reader_locks = reader_locks
         return super().__init__(*args, **kwargs)
 
     def read_particle_data(
-            self, file_path, iteration, species_name, component_list=[]):
+            self, file_path, iteration, species_name, component_list=[],
+            particle_range=None):
+        """
+        Read the data of the specified particle components.
+
+        Parameters
+        ----------
+
+        file_path : str
+            Path to the data file.
+
+        iteration : int
+            Iteration (time step) to read.
+
+        species_name : str
+            Name of the particle species.
+
+        component_list : list
+            List of strings with the names of the components to read.
+
+        particle_range : slice
+            (Optional) Range of particles to read. If not specified, all
+            particles are read.
+
+        Returns
+        -------
+        A dictionary with a (data, metadata) tuple for each component.
+        """
+        if particle_range is None:
+            particle_range = slice(None)
         data_dict = {}
-        for component in component_list:
-            metadata = self._read_component_metadata(
-                file_path, iteration, species_name, component)
-            data = self._read_component_data(
-                file_path, iteration, species_name, component)
-            data_dict[component] = (data, metadata)
+        with self.reader_locks.get_lock(file_path):
+            for component in component_list:
+                metadata = self._read_component_metadata(
+                    file_path, iteration, species_name, component)
+                data = self._read_component_data(
+                    file_path, iteration, species_name, component,
+                    particle_range)
+                data_dict[component] = (data, metadata)
         return data_dict
 
+    def get_number_of_particles(self, file_path, iteration, species_name):
+        """Returns the number of particles of the species in the file."""
+        with self.reader_locks.get_lock(file_path):
+            return self._get_number_of_particles(
+                file_path, iteration, species_name)
+
+    def supports_particle_range(self):
+        """
+        Returns whether the reader reads only the requested range of
+        particles from the data files (instead of reading all particles and
+        selecting the range afterwards).
+        """
+        return True
+
+    def find_particle_range(self, file_path, iteration, species_name,
+                            component, value_range):
+        """
+        Find a range of particles containing all particles whose component
+        value lies within `value_range`. By default, the full range is
+        returned. Readers whose data files contain statistics of the particle
+        data can override this method to return a narrower range.
+
+        Parameters
+        ----------
+
+        file_path : str
+            Path to the data file.
+
+        iteration : int
+            Iteration (time step) to read.
+
+        species_name : str
+            Name of the particle species.
+
+        component : str
+            Name of the particle component.
+
+        value_range : list
+            The (min, max) range of values of the component.
+
+        Returns
+        -------
+        A slice with the range of particles.
+        """
+        return slice(None)
+
     def _read_component_metadata(
             self, file_path, iteration, species, component):
         raise NotImplementedError()
 
-    def _read_component_data(self, file_path, iteration, species, component):
+    def _read_component_data(self, file_path, iteration, species, component,
+                             particle_range):
+        raise NotImplementedError()
+
+    def _get_number_of_particles(self, file_path, iteration, species):
         raise NotImplementedError()
 
 
@@ -47,9 +147,10 @@ class OsirisParticleReader(ParticleReader):
                                'tag': 'tag'}
         return super().__init__(*args, **kwargs)
 
-    def _read_component_data(self, file_path, iteration, species, component):
+    def _read_component_data(self, file_path, iteration, species, component,
+                             particle_range):
         with H5F(file_path, 'r') as file_handle:
-            data = file_handle[self.name_relations[component]]
+            data = file_handle[self.name_relations[component]][particle_range]
             if component == 'tag':
                 # Apply Cantor pairing function
                 print(data)
@@ -58,6 +159,10 @@ class OsirisParticleReader(ParticleReader):
                 data = 1/2*(a+b)*(a+b+1)+b
             return np.array(data)
 
+    def _get_number_of_particles(self, file_path, iteration, species):
+        with H5F(file_path, 'r') as file_handle:
+            return file_handle[self.name_relations['q']].shape[0]
+
     def _read_component_metadata(
             self, file_path, iteration, species, component):
         metadata = {}
@@ -116,13 +221,14 @@ class HiPACEParticleReader(ParticleReader):
                                'tag': 'tag'}
         return super().__init__(*args, **kwargs)
 
-    def _read_component_data(self, file_path, iteration, species, component):
+    def _read_component_data(self, file_path, iteration, species, component,
+                             particle_range):
         with H5F(file_path, 'r') as file_handle:
             if component in self.name_relations:
                 hp_name = self.name_relations[component]
             else:
                 hp_name = component
-            data = file_handle[hp_name]
+            data = file_handle[hp_name][particle_range]
             if component == 'tag':
                 # Apply Cantor pairing function
                 print(data)
@@ -131,6 +237,10 @@ class HiPACEParticleReader(ParticleReader):
                 data = 1/2*(a+b)*(a+b+1)+b
             return np.array(data)
 
+    def _get_number_of_particles(self, file_path, iteration, species):
+        with H5F(file_path, 'r') as file_handle:
+            return file_handle[self.name_relations['q']].shape[0]
+
     def _read_component_metadata(
             self, file_path, iteration, species, component):
         metadata = {}
@@ -175,18 +285,89 @@ class OpenPMDParticleReader(ParticleReader):
                                'w': 'w'}
         return super().__init__(*args, **kwargs)
 
-    def _read_component_data(self, file_path, iteration, species, component):
+    def supports_particle_range(self):
+        # Only the h5py backend is read directly. The DataReader of the
+        # openPMD-viewer always reads the full record.
+        return self._opmd_reader.backend == 'h5py'
+
+    def _read_component_data(self, file_path, iteration, species, component,
+                             particle_range):
         record_comp = self.name_relations[component]
         t, params = self._opmd_reader.read_openPMD_params(iteration)
         extensions = params['extensions']
+        if self.supports_particle_range():
+            return self._read_h5py_component_data(
+                iteration, species, record_comp, extensions, particle_range)
         data = self._opmd_reader.read_species_data(
             iteration, species, record_comp, extensions)
         if record_comp in ['charge', 'mass']:
             w = self._opmd_reader.read_species_data(
                 iteration, species, 'w', extensions)
             data = data * w
+        return data[particle_range]
+
+    def _get_number_of_particles(self, file_path, iteration, species):
+        if self.supports_particle_range():
+            with H5F(self._get_h5py_file_path(iteration), 'r') as f:
+                weighting = self._get_h5py_species_group(
+                    f, iteration, species)['weighting']
+                if isinstance(weighting, H5Group):
+                    return int(weighting.attrs['shape'][0])
+                return weighting.shape[0]
+        t, params = self._opmd_reader.read_openPMD_params(iteration)
+        extensions = params['extensions']
+        w = self._opmd_reader.read_species_data(
+            iteration, species, 'w', extensions)
+        return len(w)
+
+    def _read_h5py_component_data(self, iteration, species, record_comp,
+                                  extensions, particle_range):
+        """
+        Read a range of particles of a record component directly from an
+        openPMD HDF5 file. Equivalent to `read_species_data` of the
+        openPMD-viewer (with the h5py backend), but reading only the
+        requested range.
+        """
+        record_paths = {'x': 'position/x', 'y': 'position/y',
+                        'z': 'position/z', 'ux': 'momentum/x',
+                        'uy': 'momentum/y', 'uz': 'momentum/z',
+                        'w': 'weighting'}
+        record_path = record_paths.get(record_comp, record_comp)
+        output_type = np.uint64 if record_comp == 'id' else np.float64
+        with H5F(self._get_h5py_file_path(iteration), 'r') as f:
+            species_group = self._get_h5py_species_group(f, iteration,
+                                                         species)
+
+            def read(path, output_type=np.float64):
+                return _read_h5py_record_range(
+                    species_group[path], particle_range, output_type)
+
+            data = read(record_path, output_type)
+            if 'ED-PIC' in extensions and record_path != 'weighting':
+                record = species_group[record_path.split('/')[0]]
+                weighting_power = record.attrs['weightingPower']
+                if (record.attrs['macroWeighted'] == 1 and
+                        weighting_power != 0):
+                    data *= read('weighting') ** (-weighting_power)
+            if record_comp in ['x', 'y', 'z']:
+                data += read('positionOffset/' + record_comp)
+            elif record_comp in ['ux', 'uy', 'uz']:
+                m = read('mass')
+                # Normalize only if the particle mass is non-zero
+                if np.all(m != 0):
+                    data /= m * speed_of_light
+            if record_comp in ['charge', 'mass']:
+                data *= read('weighting')
         return data
 
+    def _get_h5py_file_path(self, iteration):
+        return self._opmd_reader.iteration_to_file[iteration]
+
+    def _get_h5py_species_group(self, file_handle, iteration, species):
+        particles_path = file_handle.attrs['particlesPath'].decode()
+        return file_handle['/data/{}/{}{}'.format(
+            iteration, particles_path, species)]
+
     def _read_component_metadata(
             self, file_path, iteration, species, component):
         t, params = self._opmd_reader.read_openPMD_params(iteration)
@@ -244,3 +425,84 @@ class OpenPMDParticleReader(ParticleReader):
             metadata['grid']['size'] = None
             metadata['grid']['size_units'] = None
         return metadata
+
+
+class VisualPICParticleReader(ParticleReader):
+
+    """
+    Particle reader for the data stores created by `convert_simulation`.
+
+    The particles in the stores are sorted by their longitudinal position
+    (and tag), and the minimum and maximum value of each component within
+    each chunk of particles are stored. This allows `find_particle_range` to
+    locate the particles within a given range without reading the data.
+    """
+
+    def __init__(self, *args, **kwargs):
+        return super().__init__(*args, **kwargs)
+
+    def find_particle_range(self, file_path, iteration, species_name,
+                            component, value_range):
+        with self.reader_locks.get_lock(file_path):
+            with H5F(file_path, 'r') as file_handle:
+                group = file_handle[get_iteration_path(iteration)]
+                n_part = group.attrs['n_particles']
+                chunk_size = group.attrs['chunk_size']
+                chunk_stats = group['chunk_stats'][component][()]
+        v_min, v_max = value_range
+        overlaps = (chunk_stats[:, 1] >= v_min) & (chunk_stats[:, 0] <= v_max)
+        chunk_idx = np.nonzero(overlaps)[0]
+        if len(chunk_idx) == 0:
+            return slice(0, 0)
+        return slice(int(chunk_idx[0] * chunk_size),
+                     int(min((chunk_idx[-1] + 1) * chunk_size, n_part)))
+
+    def _read_component_data(self, file_path, iteration, species, component,
+                             particle_range):
+        with H5F(file_path, 'r') as file_handle:
+            group = file_handle[get_iteration_path(iteration)]
+            return group[component][particle_range]
+
+    def _get_number_of_particles(self, file_path, iteration, species):
+        with H5F(file_path, 'r') as file_handle:
+            group = file_handle[get_iteration_path(iteration)]
+            return int(group.attrs['n_particles'])
+
+    def _read_component_metadata(
+            self, file_path, iteration, species, component):
+        metadata = {}
+        with H5F(file_path, 'r') as file_handle:
+            group = file_handle[get_iteration_path(iteration)]
+            metadata['units'] = group[component].attrs['units']
+            metadata['time'] = {}
+            metadata['time']['value'] = group.attrs['time']
+            metadata['time']['units'] = file_handle.attrs['time_units']
+            metadata['grid'] = {}
+            if 'grid_resolution' in group.attrs:
+                metadata['grid']['resolution'] = group.attrs['grid_resolution']
+                metadata['grid']['size'] = group.attrs['grid_size']
+                metadata['grid']['range'] = [
+                    list(r) for r in group.attrs['grid_range']]
+                metadata['grid']['size_units'] = group.attrs['grid_size_units']
+            else:
+                metadata['grid']['resolution'] = None
+                metadata['grid']['size'] = None
+                metadata['grid']['size_units'] = None
+        return metadata
+
+
+def _read_h5py_record_range(record, particle_range, output_type):
+    """
+    Read a range of particles of an openPMD record component (a dataset, or
+    a group if constant) in SI units.
+    """
+    if isinstance(record, H5Group):
+        n_part = int(record.attrs['shape'][0])
+        n_range = len(range(n_part)[particle_range])
+        data = np.full(n_range, record.attrs['value'], dtype=output_type)
+    else:
+        data = record[particle_range].astype(output_type, copy=False)
+    unit_si = record.attrs['unitSI']
+    if np.issubdtype(data.dtype, np.floating) and unit_si != 1.:
+        data *= unit_si
+    return data
@@ -0,0 +1,66 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the ReaderLocks class used to make the data readers
+thread-safe.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+import threading
+
+
+class ReaderLocks():
+
+    """
+    Registry of the locks used by the field and particle readers to serialize
+    the access to the data.
+
+    Depending on `per_file`, a separate lock is created for each data file or
+    a single lock is shared by all of them. The latter is needed when the
+    readers rely on a stateful object which is shared between files, such as
+    the DataReader of the openPMD-viewer.
+    """
+
+    def __init__(self, per_file=True):
+        """
+        Initialize the lock registry.
+
+        Parameters
+        ----------
+
+        per_file : bool
+            Whether to use a separate lock for each file (True) or a single
+            lock for all of them (False).
+
+        """
+        self.per_file = per_file
+        self._registry_lock = threading.Lock()
+        self._locks = {}
+
+    def __getstate__(self):
+        # Locks cannot be pickled or copied. New ones are created instead.
+        return {'per_file': self.per_file}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_lock(self, file_path=None):
+        """
+        Return the (re-entrant) lock corresponding to the given file.
+
+        Parameters
+        ----------
+
+        file_path : str
+            Path to the data file. Not needed if `per_file=False`.
+
+        """
+        if not self.per_file:
+            file_path = None
+        with self._registry_lock:
+            if file_path not in self._locks:
+                self._locks[file_path] = threading.RLock()
+            return self._locks[file_path]
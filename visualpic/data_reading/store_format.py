@@ -0,0 +1,22 @@
+"""
+This file is part of VisualPIC.
+
+The module contains the definitions of the layout of the data stores created
+by `convert_simulation`, which are read using the 'visualpic' simulation code.
+
+Copyright 2016-2020, Angel Ferran Pousa.
+License: GNU GPL-3.0.
+"""
+
+
+# Version of the layout of the data stores.
+STORE_VERSION = 1
+
+# Subfolders containing the field and particle species stores.
+FIELDS_FOLDER = 'fields'
+SPECIES_FOLDER = 'species'
+
+
+def get_iteration_path(iteration):
+    """Returns the path of the group containing the data of an iteration."""
+    return '/iterations/{}'.format(int(iteration))
@@ -10,6 +10,7 @@ License: GNU GPL-3.0.
 
 import os
 import sys
+from functools import partial
 from pkg_resources import resource_filename
 import warnings
 
@@ -17,14 +18,10 @@ import numpy as np
 from scipy.ndimage import zoom
 try:
     import vtk
+    from vtk.util import numpy_support
     vtk_installed = True
 except:
     vtk_installed = False
-try:
-    import pyvista as pv
-    pyvista_installed = True
-except:
-    pyvista_installed = False
 try:
     from PyQt5 import QtWidgets
     qt_installed = True
@@ -32,12 +29,18 @@ except:
     qt_installed = False
 
 from visualpic.helper_functions import get_common_timesteps
+from visualpic.data_handling.statistics_index import rebin_histogram
 from visualpic.visualization.volume_appearance import (VolumeStyleHandler,
                                                        Colormap, Opacity)
 if qt_installed:
     from visualpic.ui.basic_render_window import BasicRenderWindow
 
 
+# Approximate number of elements of the field processed at once when
+# quantizing it into integer volume data or computing its histograms.
+SLAB_SIZE = 2**22
+
+
 class VTKVisualizer():
 
     """Main class controlling the 3D visualization"""
@@ -124,13 +127,20 @@ class VTKVisualizer():
         self._colorbar_visibility = []
         self.current_time_step = -1
         self.available_time_steps = None
+        self._single_volume_data = None
+        self._single_volume_components = None
+        self._single_volume_import = None
+        self._multi_volume_elements = None
+        self._multi_volume_arrays = None
         self._initialize_base_vtk_elements()
         self.set_background(background)
 
     def add_field(self, field, cmap='viridis', opacity='auto',
                   gradient_opacity='uniform opaque', vmax=None, vmin=None,
                   xtrim=None, ytrim=None, ztrim=None, resolution=None,
-                  max_resolution_3d=[100, 100]):
+                  max_resolution_3d=[100, 100], range_mode='timestep',
+                  range_percentiles=(1, 99), range_timesteps=None,
+                  range_parallel=False, data_type='float32'):
         """
         Add a field to the 3D visualization.
 
@@ -183,6 +193,35 @@ class VTKVisualizer():
             have. This allows for faster reconstruction of the 3d field and
             less memory usage.
 
+        range_mode : str
+            How the range of the colormap and opacity is determined when
+            `vmin` or `vmax` are not given. Possible values are 'timestep'
+            (the range of the data at each time step), 'global' (the range
+            over all time steps, which keeps the colors consistent in an
+            animation) and 'percentile' (like 'global', but using the
+            `range_percentiles` of the data over all time steps). The global
+            range is computed from the full (untrimmed) field data.
+
+        range_percentiles : tuple
+            The (low, high) percentiles (0-100) used if
+            `range_mode='percentile'`.
+
+        range_timesteps : array
+            (Optional) Time steps over which the global range is computed. If
+            not specified, all time steps are used.
+
+        range_parallel : bool
+            Whether to read the data of the different time steps in parallel
+            (in several processes) when computing the global range. Not
+            needed if the range is available from the statistics index.
+
+        data_type : str
+            Type of the volume data passed to VTK. Possible values are
+            'float32', 'uint8' and 'uint16'. The integer types store the
+            field quantized within the range of the data, which reduces the
+            memory usage (4x for 'uint8', 2x for 'uint16') and speeds up the
+            transfer of the data to the GPU at the cost of precision.
+
         """
         if field.get_geometry() in ['cylindrical', 'thetaMode', '3dcartesian']:
             # check if this field has already been added to a volume
@@ -195,7 +234,10 @@ class VTKVisualizer():
             # add to volume list
             volume_field = VolumetricField(
                 field, cmap, opacity, gradient_opacity, vmax, vmin, xtrim,
-                ytrim, ztrim, resolution, max_resolution_3d, name_suffix)
+                ytrim, ztrim, resolution, max_resolution_3d, name_suffix,
+                range_mode=range_mode, range_percentiles=range_percentiles,
+                range_timesteps=range_timesteps,
+                range_parallel=range_parallel, data_type=data_type)
             self.volume_field_list.append(volume_field)
             self.colorbar_list.append(volume_field.get_colorbar(5))
             self.available_time_steps = self.get_possible_timesteps()
@@ -206,7 +248,9 @@ class VTKVisualizer():
 
     def add_species(self, species, color='w', cmap='viridis', vmax=None,
                     vmin=None, xtrim=None, ytrim=None, ztrim=None, size=1,
-                    color_according_to=None, scale_with_charge=False):
+                    color_according_to=None, scale_with_charge=False,
+                    range_mode='timestep', range_percentiles=(1, 99),
+                    range_timesteps=None, range_parallel=False):
         """
         Add a particle species to the 3D visualization.
 
@@ -254,6 +298,28 @@ class VTKVisualizer():
             charge, where those with the maximum charge will have the size
             specified by the size parameter.
 
+        range_mode : str
+            How the range of the colormap is determined when `vmin` or
+            `vmax` are not given. Possible values are 'timestep' (the range
+            of the data at each time step), 'global' (the range over all time
+            steps, which keeps the colors consistent in an animation) and
+            'percentile' (like 'global', but using the `range_percentiles` of
+            the data over all time steps). The global range is computed from
+            the full (untrimmed) particle data.
+
+        range_percentiles : tuple
+            The (low, high) percentiles (0-100) used if
+            `range_mode='percentile'`.
+
+        range_timesteps : array
+            (Optional) Time steps over which the global range is computed. If
+            not specified, all time steps are used.
+
+        range_parallel : bool
+            Whether to read the data of the different time steps in parallel
+            (in several processes) when computing the global range. Not
+            needed if the range is available from the statistics index.
+
         """
         sp_comps = species.get_list_of_available_components()
         if ('x' in sp_comps) and ('y' in sp_comps) and ('z' in sp_comps):
@@ -267,7 +333,10 @@ class VTKVisualizer():
             scatter_species = ScatterSpecies(
                 species, color, cmap, vmax, vmin, xtrim, ytrim, ztrim, size,
                 color_according_to, scale_with_charge, self._unit_norm_factors,
-                self.forced_norm_factor, name_suffix)
+                self.forced_norm_factor, name_suffix, range_mode=range_mode,
+                range_percentiles=range_percentiles,
+                range_timesteps=range_timesteps,
+                range_parallel=range_parallel)
             self.scatter_species_list.append(scatter_species)
             self.renderer.AddActor(scatter_species.get_actor())
             self.available_time_steps = self.get_possible_timesteps()
@@ -718,7 +787,7 @@ class VTKVisualizer():
         vtk_volume_prop.IndependentComponentsOn()
         vtk_volume_prop.SetInterpolationTypeToLinear()
         for i, vol_field in enumerate(self.volume_field_list):
-            vtk_volume_prop.SetColor(i, vol_field.get_vtk_colormap())
+            vtk_volume_prop.SetColor(i, vol_field.get_vtk_colormap(timestep))
             vtk_volume_prop.SetScalarOpacity(
                 i, vol_field.get_vtk_opacity(timestep))
             vtk_volume_prop.SetGradientOpacity(
@@ -727,12 +796,16 @@ class VTKVisualizer():
         return vtk_volume_prop
 
     def _import_single_volume_data(self, timestep):
-        # Get data
-        volume_data_list = list()
-        for vol_field in self.volume_field_list:
-            volume_data_list.append(vol_field.get_data(timestep))
-        self._data_all_volumes = np.concatenate(
-            [aux[..., np.newaxis] for aux in volume_data_list], axis=3)
+        # Get data. Each field stores its data directly into its component of
+        # a persistent multi-component array.
+        num_comps = len(self.volume_field_list)
+        dtype = np.result_type(
+            *[vol_field.data_type for vol_field in self.volume_field_list])
+        for i, vol_field in enumerate(self.volume_field_list):
+            vol_field.get_data(
+                timestep, allocator=partial(
+                    self._get_single_volume_component, component=i,
+                    num_comps=num_comps, dtype=dtype))
         ax_data = self.volume_field_list[0].get_axes_data(timestep)
         ax_origin = ax_data[0]
         ax_spacing = ax_data[1]
@@ -742,11 +815,34 @@ class VTKVisualizer():
         ax_spacing, ax_origin = self._normalize_volume_spacing(
                 ax_spacing, ax_origin, ax_units)
 
-        # Put data in VTK format
-        vtk_data_import = self._create_vtk_image_import(
-            self._data_all_volumes, ax_origin, ax_spacing,
-            num_comps=len(self.volume_field_list))
-        return vtk_data_import
+        # Put data in VTK format. The same image import is reused for all
+        # time steps.
+        if self._single_volume_import is None:
+            self._single_volume_import = vtk.vtkImageImport()
+        self._update_vtk_image_import(
+            self._single_volume_import, self._single_volume_data, ax_origin,
+            ax_spacing, num_comps=num_comps)
+        return self._single_volume_import
+
+    def _get_single_volume_component(self, shape, component, num_comps,
+                                     dtype):
+        """
+        Returns the array in which a field stores its data in single-volume
+        mode, i.e., a component of the multi-component array of all volumes.
+        This array is only reallocated when its shape or type changes.
+        """
+        data_shape = tuple(shape) + (num_comps,)
+        data = self._single_volume_data
+        if (data is None or data.shape != data_shape or
+                data.dtype != dtype):
+            if component > 0:
+                raise ValueError(
+                    'All volumetric fields must have the same shape.')
+            data = np.empty(data_shape, dtype=dtype)
+            self._single_volume_data = data
+            self._single_volume_components = [
+                data[..., i] for i in range(num_comps)]
+        return self._single_volume_components[component]
 
     def _load_data_into_multi_volume(self, timestep):
         # Workaround to fix wrong volume boundaries when a 'vtkMultiVolume' has
@@ -766,54 +862,99 @@ class VTKVisualizer():
             self.vtk_volume = vtk.vtkMultiVolume()
             self.renderer.AddVolume(self.vtk_volume)
             self.vtk_volume.SetMapper(self.vtk_volume_mapper)
+            self._multi_volume_elements = None
         # End of workaround
 
-        # Workaround for avoiding segmentation fault using vtkMultiVolume.
-        # A new mapper has to be created instead of updated when switching
-        # time steps.
-        cw = self.get_color_window()
-        cl = self.get_color_level()
-        self.vtk_volume_mapper = vtk.vtkGPUVolumeRayCastMapper()
-        self.vtk_volume_mapper.UseJitteringOn()
-        self.vtk_volume.SetMapper(self.vtk_volume_mapper)
-        self.set_color_window(cw)
-        self.set_color_level(cl)
-        # End of workaround.
-
-        vtk_vols, imports = self._create_volumes(timestep)
-        for i, (vol, imp) in enumerate(zip(vtk_vols, imports)):
-            self.vtk_volume_mapper.SetInputConnection(i, imp.GetOutputPort())
-            self.vtk_volume.SetVolume(vol, i)
+        # The volumes, image imports and mapper are only created when the
+        # displayed fields change. For the other time steps, only the data
+        # and transfer functions are updated in place, so that the inputs of
+        # the mapper are never replaced.
+        if (self._multi_volume_elements is None or
+                [el[0] for el in self._multi_volume_elements] !=
+                self.volume_field_list):
+            # Workaround for avoiding segmentation fault using
+            # vtkMultiVolume. A new mapper has to be created instead of
+            # updated when the inputs change.
+            cw = self.get_color_window()
+            cl = self.get_color_level()
+            self.vtk_volume_mapper = vtk.vtkGPUVolumeRayCastMapper()
+            self.vtk_volume_mapper.UseJitteringOn()
+            self.vtk_volume.SetMapper(self.vtk_volume_mapper)
+            self.set_color_window(cw)
+            self.set_color_level(cl)
+            # End of workaround.
+            self._multi_volume_arrays = [None] * len(self.volume_field_list)
+            self._multi_volume_elements = self._create_volumes(timestep)
+            for i, (_, vol, imp) in enumerate(self._multi_volume_elements):
+                self.vtk_volume_mapper.SetInputConnection(
+                    i, imp.GetOutputPort())
+                self.vtk_volume.SetVolume(vol, i)
+        else:
+            for i, (vol_field, _, imp) in enumerate(
+                    self._multi_volume_elements):
+                # Update the transfer functions (only modified if they
+                # change) and the data.
+                vol_field.get_vtk_colormap(timestep)
+                vol_field.get_vtk_opacity(timestep)
+                vol_field.get_vtk_gradient_opacity(timestep)
+                self._import_volume_data(i, timestep, imp)
 
     def _create_volumes(self, timestep):
-        vol_list = list()
-        imports_list = list()
-        for vol_field in self.volume_field_list:
+        """
+        Create the volume and image import of each field. Returns a list of
+        (field, volume, import) tuples.
+        """
+        elements = list()
+        for i, vol_field in enumerate(self.volume_field_list):
             vtk_vol = vtk.vtkVolume()
             vtk_volume_prop = vtk.vtkVolumeProperty()
             vtk_volume_prop.SetInterpolationTypeToLinear()
-            vtk_volume_prop.SetColor(vol_field.get_vtk_colormap())
+            vtk_volume_prop.SetColor(vol_field.get_vtk_colormap(timestep))
             vtk_volume_prop.SetScalarOpacity(
                 vol_field.get_vtk_opacity(timestep))
             vtk_volume_prop.SetGradientOpacity(
                 vol_field.get_vtk_gradient_opacity(timestep))
             vtk_volume_prop.ShadeOff()
             vtk_vol.SetProperty(vtk_volume_prop)
-            vol_data = vol_field.get_data(timestep)
-            vol_list.append(vtk_vol)
-
-            # Normalize volume spacing
-            ax_data = vol_field.get_axes_data(timestep)
-            ax_origin = ax_data[0]
-            ax_spacing = ax_data[1]
-            ax_units = ax_data[3]
-            ax_spacing, ax_origin = self._normalize_volume_spacing(
-                ax_spacing, ax_origin, ax_units)
+            vtk_data_import = vtk.vtkImageImport()
+            self._import_volume_data(i, timestep, vtk_data_import)
+            elements.append((vol_field, vtk_vol, vtk_data_import))
+        return elements
+
+    def _import_volume_data(self, index, timestep, vtk_data_import):
+        """
+        Update an image import with the data of a field. The data is stored
+        in a persistent array, so that the imported array does not change
+        between time steps.
+        """
+        vol_field = self.volume_field_list[index]
+        vol_data = vol_field.get_data(
+            timestep, allocator=partial(
+                self._get_multi_volume_array, index=index,
+                dtype=vol_field.data_type))
+
+        # Normalize volume spacing
+        ax_data = vol_field.get_axes_data(timestep)
+        ax_origin = ax_data[0]
+        ax_spacing = ax_data[1]
+        ax_units = ax_data[3]
+        ax_spacing, ax_origin = self._normalize_volume_spacing(
+            ax_spacing, ax_origin, ax_units)
 
-            # Put data in VTK format
-            imports_list.append(
-                self._create_vtk_image_import(vol_data, ax_origin, ax_spacing))
-        return vol_list, imports_list
+        # Put data in VTK format
+        self._update_vtk_image_import(vtk_data_import, vol_data, ax_origin,
+                                      ax_spacing)
+
+    def _get_multi_volume_array(self, shape, index, dtype):
+        """
+        Returns the array in which a field stores its data in multi-volume
+        mode. This array is only reallocated when its shape changes.
+        """
+        data = self._multi_volume_arrays[index]
+        if data is None or data.shape != tuple(shape):
+            data = np.empty(shape, dtype=dtype)
+            self._multi_volume_arrays[index] = data
+        return data
 
     def _normalize_volume_spacing(self, ax_spacing, ax_origin, ax_units):
         if self.forced_norm_factor is not None:
@@ -824,11 +965,15 @@ class VTKVisualizer():
         ax_spacing *= norm_factor
         return ax_spacing, ax_origin
 
-    def _create_vtk_image_import(self, volume_data, ax_origin, ax_spacing,
-                                 num_comps=1):
-        vtk_data_import = vtk.vtkImageImport()
+    def _update_vtk_image_import(self, vtk_data_import, volume_data,
+                                 ax_origin, ax_spacing, num_comps=1):
         vtk_data_import.SetImportVoidPointer(volume_data)
-        vtk_data_import.SetDataScalarTypeToFloat()
+        if volume_data.dtype == np.uint8:
+            vtk_data_import.SetDataScalarTypeToUnsignedChar()
+        elif volume_data.dtype == np.uint16:
+            vtk_data_import.SetDataScalarTypeToUnsignedShort()
+        else:
+            vtk_data_import.SetDataScalarTypeToFloat()
         vtk_data_import.SetNumberOfScalarComponents(num_comps)
         vtk_data_import.SetDataExtent(0, volume_data.shape[2]-1,
                                       0, volume_data.shape[1]-1,
@@ -841,8 +986,9 @@ class VTKVisualizer():
                                        ax_spacing[1])
         # data origin is also changed by the normalization
         vtk_data_import.SetDataOrigin(ax_origin[0], ax_origin[2], ax_origin[1])
+        # The data might have changed even if the array (pointer) is the same.
+        vtk_data_import.Modified()
         vtk_data_import.Update()
-        return vtk_data_import
 
     def _render_species(self, timestep):
         for species in self.scatter_species_list:
@@ -999,8 +1145,6 @@ class VTKVisualizer():
         missing_dependencies = []
         if not vtk_installed:
             missing_dependencies.append('vtk')
-        if not pyvista_installed:
-            missing_dependencies.append('pyvista')
         if len(missing_dependencies) > 0:
             dep_str = ', '.join(missing_dependencies)
             raise ImportError(
@@ -1022,7 +1166,15 @@ class VolumetricField():
     def __init__(self, field, cmap='viridis', opacity='auto',
                  gradient_opacity='uniform opaque', vmax=None, vmin=None,
                  xtrim=None, ytrim=None, ztrim=None, resolution=None,
-                 max_resolution_3d=None, name_suffix=None):
+                 max_resolution_3d=None, name_suffix=None,
+                 range_mode='timestep', range_percentiles=(1, 99),
+                 range_timesteps=None, range_parallel=False,
+                 data_type='float32'):
+        _check_range_mode(range_mode)
+        if data_type not in ['float32', 'uint8', 'uint16']:
+            raise ValueError(
+                "Unsupported data type '{}'. ".format(data_type) +
+                "Possible values are 'float32', 'uint8' or 'uint16'.")
         self.field = field
         self.style_handler = VolumeStyleHandler()
         self.cmap = cmap
@@ -1036,12 +1188,24 @@ class VolumetricField():
         self.resolution = resolution
         self.name_suffix = name_suffix
         self.max_resolution_3d = max_resolution_3d
+        self.range_mode = range_mode
+        self.range_percentiles = range_percentiles
+        self.range_timesteps = range_timesteps
+        self.range_parallel = range_parallel
+        self.data_type = data_type
         self.vtk_opacity = vtk.vtkPiecewiseFunction()
         self.vtk_gradient_opacity = vtk.vtkPiecewiseFunction()
         self.vtk_cmap = vtk.vtkColorTransferFunction()
         self.cbar = None
         self.cbar_ticks = 5
         self._loaded_timestep = None
+        self._geometry = None
+        self._current_opacity = None
+        self._current_gradient_opacity = None
+        self._current_cmap = None
+        self._histogram_cache = {}
+        self._opacity_cache = {}
+        self._vtk_tf_points = {}
 
     def get_name(self):
         fld_name = self.field.field_name
@@ -1052,8 +1216,23 @@ class VolumetricField():
             fld_name += ' ({})'.format(self.name_suffix)
         return fld_name
 
-    def get_data(self, timestep):
-        self._load_data(timestep)
+    def get_data(self, timestep, allocator=None):
+        """
+        Get the (normalized) volume data of the field at a time step.
+
+        Parameters
+        ----------
+
+        timestep : int
+            Time step of the data.
+
+        allocator : callable
+            (Optional) Function `allocator(shape)` returning the array in
+            which to store the volume data, such as a component of a
+            multi-component array. If not given, a new array is created.
+
+        """
+        self._load_data(timestep, allocator=allocator)
         return self._field_data
 
     def get_colorbar(self, n_ticks):
@@ -1103,31 +1282,32 @@ class VolumetricField():
         return vmin, vmax
 
     def get_original_data_range(self, timestep):
+        if self.range_mode != 'timestep':
+            return self._get_global_range()
+        if self._loaded_timestep != timestep:
+            # Avoid reading the data if the range is in the index.
+            stats = self._get_indexed_statistics(timestep)
+            if stats is not None:
+                return [stats['min'], stats['max']]
         self._load_data(timestep)
         return self._original_data_range
 
     def set_range(self, vmin, vmax):
-        # If data is already loaded, set range and renormalize data.
+        # The volume data is not modified. Instead, the transfer functions
+        # and the colorbar are rescaled to the new range.
+        self.vmin = vmin
+        self.vmax = vmax
         if self._loaded_timestep is not None:
-            current_vmin, current_vmax = self.get_range(self._loaded_timestep)
-            self._field_data *= (current_vmax-current_vmin) / 255
-            self._field_data += current_vmin
-            self.vmin = vmin
-            self.vmax = vmax
-            self._field_data = self._normalize_field(self._field_data)
-        # Otherwise just set the range
-        else:
-            self.vmin = vmin
-            self.vmax = vmax
+            self._update_transfer_functions()
 
     def get_vtk_opacity(self, timestep=None):
         opacity = self.get_opacity(timestep)
-        self._set_vtk_opacity(opacity)
+        self._set_vtk_opacity(opacity, timestep)
         return self.vtk_opacity
 
     def get_vtk_gradient_opacity(self, timestep=None):
         opacity = self.get_gradient_opacity(timestep)
-        self._set_vtk_gradient_opacity(opacity)
+        self._set_vtk_gradient_opacity(opacity, timestep)
         return self.vtk_gradient_opacity
 
     def get_opacity(self, timestep=None):
@@ -1145,9 +1325,9 @@ class VolumetricField():
         self.gradient_opacity = opacity
         self._set_vtk_gradient_opacity(opacity)
 
-    def get_vtk_colormap(self):
+    def get_vtk_colormap(self, timestep=None):
         cmap = self.get_colormap()
-        self._set_vtk_colormap(cmap)
+        self._set_vtk_colormap(cmap, timestep)
         return self.vtk_cmap
 
     def get_colormap(self):
@@ -1167,74 +1347,194 @@ class VolumetricField():
 
     def get_optimized_opacity(self, time_step, bins=11,
                               gradient_opacity=False):
-        if gradient_opacity:
-            hist, *_ = self.get_field_data_gradient_histogram(time_step,
-                                                              bins=bins)
-        else:
-            hist, *_ = self.get_field_data_histogram(time_step, bins=bins)
-        fld_val = np.linspace(0, 255, bins)
-        op_val = 1 - hist
-        opacity = Opacity(name='auto', fld_values=fld_val, op_values=op_val)
-        return opacity
+        key = self._get_histogram_key(time_step, bins, gradient_opacity)
+        if key not in self._opacity_cache:
+            if gradient_opacity:
+                hist, *_ = self.get_field_data_gradient_histogram(time_step,
+                                                                  bins=bins)
+            else:
+                hist, *_ = self.get_field_data_histogram(time_step, bins=bins)
+            fld_val = np.linspace(0, 255, bins)
+            op_val = 1 - hist
+            self._opacity_cache[key] = Opacity(
+                name='auto', fld_values=fld_val, op_values=op_val)
+        return self._opacity_cache[key]
 
     def get_field_data_histogram(self, time_step, bins=11):
         """
         Create a 1D histogram of the field values. The amount of values below
         or under the [vmin, vmax] range (if specified) is added to the boundary
-        bins.
+        bins. If available, the histogram is estimated from the statistics
+        index of the field instead of the data.
+
+        The histogram is cached for each time step, number of bins and
+        range.
         """
-        fld_data = self.get_data(time_step)
-        bin_edges = np.linspace(0, 255, bins+1)
-        fld_min = np.min(fld_data)
-        fld_max = np.max(fld_data)
-        if fld_min < 0:
-            bin_edges = np.insert(bin_edges, 0, fld_min)
-        if fld_max > 255:
-            bin_edges = np.append(bin_edges, fld_max)
-        hist, *_ = np.histogram(fld_data, bins=bin_edges)
-        if fld_min < 0:
-            hist[1] += hist[0]
-            hist = hist[1:]
-            bin_edges = bin_edges[1:]
-        if fld_max > 255:
-            hist[-2] += hist[-1]
-            hist = hist[:-1]
-            bin_edges = bin_edges[:-1]
-        hist = np.ma.log(hist).filled(0)
-        hist /= hist.max()
-        return hist, bin_edges
+        key = self._get_histogram_key(time_step, bins)
+        if key not in self._histogram_cache:
+            self._histogram_cache[key] = self._compute_field_data_histogram(
+                time_step, bins)
+        hist, bin_edges = self._histogram_cache[key]
+        return hist.copy(), bin_edges.copy()
 
     def get_field_data_gradient_histogram(self, time_step, bins=11):
-        fld_data = self.get_data(time_step)
-        fld_grad = np.gradient(fld_data)
-        fld_grad = np.sqrt(fld_grad[0]**2 + fld_grad[1]**2 + fld_grad[2]**2)
-        hist, hist_edges = np.histogram(fld_grad, bins=bins)
-        hist = np.ma.log(hist).filled(0)
-        hist /= hist.max()
-        return hist, hist_edges
-
-    def _load_data(self, timestep, only_metadata=False):
-        if self._loaded_timestep != timestep:
+        """
+        Create a 1D histogram of the magnitude of the gradient of the field.
+        The gradient is expressed as that of the normalized field (0-255
+        within the [vmin, vmax] range), in which the gradient opacity is
+        defined.
+
+        The histogram of the gradient of the volume data is cached for each
+        time step and number of bins, so that changing the range only
+        requires rescaling its edges.
+        """
+        key = self._get_histogram_key(time_step, bins, gradient=True)
+        if key not in self._histogram_cache:
+            self._histogram_cache[key] = (
+                self._compute_field_data_gradient_histogram(time_step, bins))
+        hist, hist_edges = self._histogram_cache[key]
+        _, slope = self._get_scalar_mapping(time_step)
+        if slope > 0:
+            hist_edges = hist_edges / slope
+        return hist.copy(), hist_edges.copy()
+
+    def _load_data(self, timestep, only_metadata=False, allocator=None):
+        if self._loaded_timestep == timestep:
+            if allocator is not None:
+                # Move the loaded data into the requested array, if needed.
+                out = allocator(self._field_data.shape)
+                if out is not self._field_data:
+                    out[...] = self._field_data
+                    self._field_data = out
+        else:
             fld_data, fld_md = self.field.get_data(
                 timestep, theta=None,
                 max_resolution_3d=self.max_resolution_3d)
             fld_data = self._trim_field(fld_data)
             fld_data = self._change_resolution(fld_data)
-            min_fld = np.min(fld_data)
-            max_fld = np.max(fld_data)
-            self._original_data_range = [min_fld, max_fld]
-            fld_data = self._normalize_field(fld_data)
-            # Make sure the array is contiguous, otherwise this can lead to 
-            # errors in vtk_data_import.SetImportVoidPointer in some cases when
-            # trimming in the y or z planes is applied, or when the array has
-            # been rearranged in the FieldReader (such as for HiPACE data).
-            self._field_data = np.ascontiguousarray(fld_data)
+            stats = self._get_indexed_statistics(timestep)
+            if self.range_mode != 'timestep':
+                self._original_data_range = self._get_global_range()
+            elif stats is not None:
+                self._original_data_range = [stats['min'], stats['max']]
+            else:
+                self._original_data_range = [np.min(fld_data),
+                                             np.max(fld_data)]
+            out = None
+            if allocator is not None:
+                out = allocator(fld_data.shape)
+            if self.data_type == 'float32':
+                fld_data = self._normalize_field(fld_data, out)
+            else:
+                fld_data = self._quantize_field(fld_data, out)
+            if out is None:
+                # Make sure the array is contiguous, otherwise this can lead
+                # to errors in vtk_data_import.SetImportVoidPointer in some
+                # cases when trimming in the y or z planes is applied, or when
+                # the array has been rearranged in the FieldReader (such as
+                # for HiPACE data).
+                fld_data = np.ascontiguousarray(fld_data)
+            self._field_data = fld_data
             self._field_metadata = fld_md
             if not only_metadata:
                 self._loaded_timestep = timestep
             if self.cbar is not None:
                 self._update_colorbar(timestep)
 
+    def _get_global_range(self):
+        """
+        Returns the range of the field over all time steps (or those in
+        `range_timesteps`). The range is cached by the field.
+        """
+        percentiles = None
+        if self.range_mode == 'percentile':
+            percentiles = self.range_percentiles
+        return list(self.field.get_global_range(
+            time_steps=self.range_timesteps, percentiles=percentiles,
+            theta=None, max_resolution_3d=self.max_resolution_3d,
+            parallel=self.range_parallel))
+
+    def _get_indexed_statistics(self, timestep):
+        """
+        Returns the statistics of the field at the given time step from its
+        statistics index, or None if not available. The index is only used if
+        it describes the displayed data, i.e., for 3D cartesian fields which
+        are not trimmed or resampled.
+        """
+        if any(el is not None for el in [self.xtrim, self.ytrim, self.ztrim,
+                                         self.resolution]):
+            return None
+        stats = self.field.get_statistics(timestep)
+        if stats is None or np.isnan(stats['min']):
+            return None
+        if self._geometry is None:
+            self._geometry = self.field.get_geometry()
+        if self._geometry != '3dcartesian':
+            return None
+        return stats
+
+    def _get_histogram_key(self, time_step, bins, gradient=False):
+        """
+        Returns the key of the cached histograms and optimized opacities of
+        the field. The histogram of the gradient is independent of the
+        [vmin, vmax] range.
+        """
+        if gradient:
+            return ('gradient', time_step, bins)
+        vmin, vmax = self.get_range(time_step)
+        return ('field', time_step, bins, float(vmin), float(vmax))
+
+    def _compute_field_data_histogram(self, time_step, bins):
+        """Compute the (normalized) histogram of the field values."""
+        bin_edges = np.linspace(0, 255, bins+1)
+        stats = self._get_indexed_statistics(time_step)
+        if stats is not None:
+            vmin, vmax = self.get_range(time_step)
+            hist = rebin_histogram(stats, np.linspace(vmin, vmax, bins+1))
+        else:
+            fld_data = self.get_data(time_step)
+            # Bin edges in the units of the volume data. The outer edges are
+            # infinite so that the boundary bins include all values outside
+            # of the range.
+            data_edges = self._get_scalar_values(bin_edges, time_step)
+            data_edges[[0, -1]] = [-np.inf, np.inf]
+            hist = np.zeros(bins)
+            n_slab = _get_slab_length(fld_data)
+            for start in range(0, fld_data.shape[0], n_slab):
+                hist += np.histogram(fld_data[start:start+n_slab],
+                                     bins=data_edges)[0]
+        hist = np.ma.log(hist).filled(0)
+        hist /= hist.max()
+        return hist, bin_edges
+
+    def _compute_field_data_gradient_histogram(self, time_step, bins):
+        """
+        Compute the (normalized) histogram of the magnitude of the gradient
+        of the volume data. The gradient is computed in single precision and
+        slab by slab, so that only one additional full-size array is created.
+        """
+        fld_data = self.get_data(time_step)
+        n_x = fld_data.shape[0]
+        fld_grad = np.empty(fld_data.shape, dtype=np.float32)
+        n_slab = _get_slab_length(fld_data)
+        for start in range(0, n_x, n_slab):
+            end = min(start + n_slab, n_x)
+            # Include the neighboring planes of the slab so that the central
+            # differences at its boundaries are the same as in the full array.
+            lo = max(start - 1, 0)
+            hi = min(end + 1, n_x)
+            slab = fld_data[lo:hi].astype(np.float32)
+            slab_grad = np.gradient(slab)
+            grad_mag = slab_grad[0]**2
+            grad_mag += slab_grad[1]**2
+            grad_mag += slab_grad[2]**2
+            np.sqrt(grad_mag, out=grad_mag)
+            fld_grad[start:end] = grad_mag[start-lo:end-lo]
+        hist, hist_edges = np.histogram(fld_grad, bins=bins)
+        hist = np.ma.log(hist).filled(0)
+        hist /= hist.max()
+        return hist, hist_edges
+
     def _update_colorbar(self, timestep):
         cbar_range = np.array(self.get_range(timestep))
         self.vtk_cmap.ResetAnnotations()
@@ -1244,7 +1544,8 @@ class VolumetricField():
         except:
             ord = 1
         cbar_range = cbar_range/10**ord
-        norm_fld_vals = np.linspace(0, 255, self.cbar_ticks)
+        norm_fld_vals = self._get_scalar_values(
+            np.linspace(0, 255, self.cbar_ticks), timestep)
         real_fld_vals = np.linspace(
             cbar_range[0], cbar_range[1], self.cbar_ticks)
         for j in np.arange(self.cbar_ticks):
@@ -1285,25 +1586,55 @@ class VolumetricField():
                     timestep, gradient_opacity=gradient_opacity)
         return opacity
 
-    def _set_vtk_opacity(self, opacity):
+    def _set_vtk_opacity(self, opacity, timestep=None):
+        self._current_opacity = opacity
         fld_vals, op_vals = opacity.get_opacity_values()
+        fld_vals = self._get_scalar_values(fld_vals, timestep)
+        if not self._transfer_function_changed('opacity', fld_vals, op_vals):
+            return
         self.vtk_opacity.RemoveAllPoints()
         for fv, ov in zip(fld_vals, op_vals):
             self.vtk_opacity.AddPoint(fv, ov)
 
-    def _set_vtk_gradient_opacity(self, opacity):
+    def _set_vtk_gradient_opacity(self, opacity, timestep=None):
+        self._current_gradient_opacity = opacity
         fld_vals, op_vals = opacity.get_opacity_values()
+        _, slope = self._get_scalar_mapping(timestep)
+        fld_vals = np.asarray(fld_vals) * slope
+        if not self._transfer_function_changed('gradient_opacity', fld_vals,
+                                               op_vals):
+            return
         self.vtk_gradient_opacity.RemoveAllPoints()
         for fv, ov in zip(fld_vals, op_vals):
             self.vtk_gradient_opacity.AddPoint(fv, ov)
 
-    def _set_vtk_colormap(self, cmap):
-        self.vtk_cmap.RemoveAllPoints()
+    def _set_vtk_colormap(self, cmap, timestep=None):
+        self._current_cmap = cmap
         fld_val, r_val, g_val, b_val = cmap.get_cmap_values()
+        fld_val = self._get_scalar_values(fld_val, timestep)
+        if not self._transfer_function_changed('cmap', fld_val, r_val, g_val,
+                                               b_val):
+            return
+        self.vtk_cmap.RemoveAllPoints()
         # points = [x0, r0, g0, b0, x1, r1, g1, b1, ..., xN, rN, gN, bN]
         points = list(np.column_stack((fld_val, r_val, g_val, b_val)).flat)
         self.vtk_cmap.FillFromDataPointer(int(len(points)/4), points)
 
+    def _transfer_function_changed(self, name, *values):
+        """
+        Returns whether the control points of a transfer function differ
+        from those currently set, and stores them. This prevents modifying
+        (and uploading again to the GPU) transfer functions which have not
+        changed.
+        """
+        points = np.column_stack(values)
+        current_points = self._vtk_tf_points.get(name)
+        if current_points is not None and np.array_equal(points,
+                                                          current_points):
+            return False
+        self._vtk_tf_points[name] = points
+        return True
+
     def _trim_field(self, fld_data):
         shape = fld_data.shape
         if self.xtrim is not None:
@@ -1338,22 +1669,113 @@ class VolumetricField():
             z = z[zmin:zmax]
         return x, y, z
 
-    def _normalize_field(self, fld_data):
+    def _get_max_scalar_value(self):
+        """
+        Returns the value to which the maximum of the field range is mapped
+        in the volume data.
+        """
+        if self.data_type == 'uint16':
+            return np.iinfo(np.uint16).max
+        return 255
+
+    def _get_data_scale(self, min_value, max_value):
+        """
+        Returns the factor by which the field values are multiplied (after
+        subtracting `min_value`) in the volume data.
+        """
+        if np.abs(max_value-min_value) > 0:
+            return self._get_max_scalar_value() / (max_value-min_value)
+        return 1.
+
+    def _get_scalar_mapping(self, timestep=None):
+        """
+        Returns the offset and slope of the linear map from the normalized
+        field values (0-255 within the [vmin, vmax] range), in which the
+        transfer functions are defined, to the values of the volume data.
+
+        The volume data always spans the original range of the field, so
+        that changing vmin or vmax only requires updating this map.
+        """
+        if timestep is None:
+            timestep = self._loaded_timestep
+        if timestep is None:
+            return 0., self._get_max_scalar_value() / 255
+        data_min, data_max = self.get_original_data_range(timestep)
+        vmin, vmax = self.get_range(timestep)
+        scale = self._get_data_scale(data_min, data_max)
+        offset = (vmin - data_min) * scale
+        slope = (vmax - vmin) / 255 * scale
+        return offset, slope
+
+    def _get_scalar_values(self, fld_values, timestep=None):
+        """
+        Convert normalized field values (e.g., those of the control points of
+        a transfer function) into values of the volume data.
+        """
+        offset, slope = self._get_scalar_mapping(timestep)
+        return offset + np.asarray(fld_values, dtype=float) * slope
+
+    def _update_transfer_functions(self):
+        """
+        Update the transfer functions and the colorbar after a change of the
+        vmin or vmax range.
+        """
+        if self._current_opacity is not None:
+            self._set_vtk_opacity(self._current_opacity)
+        if self._current_gradient_opacity is not None:
+            self._set_vtk_gradient_opacity(self._current_gradient_opacity)
+        if self._current_cmap is not None:
+            self._set_vtk_colormap(self._current_cmap)
+        if self.cbar is not None:
+            self._update_colorbar(self._loaded_timestep)
+
+    def _quantize_field(self, fld_data, out=None):
+        """
+        Quantize the field data into an unsigned integer array spanning the
+        full range of `data_type`. The data is processed in slabs, so that
+        no full-size floating point copies of the field are created. If
+        given, the data is stored in `out`.
+        """
+        min_value, max_value = self._original_data_range
+        max_int = self._get_max_scalar_value()
+        scale = self._get_data_scale(min_value, max_value)
+        quantized = out
+        if quantized is None:
+            quantized = np.empty(fld_data.shape, dtype=self.data_type)
+        n_slab = _get_slab_length(fld_data)
+        for start in range(0, fld_data.shape[0], n_slab):
+            slab = fld_data[start:start+n_slab].astype(np.float32)
+            slab -= min_value
+            slab *= scale
+            np.nan_to_num(slab, copy=False)
+            np.clip(slab, 0, max_int, out=slab)
+            np.rint(slab, out=slab)
+            quantized[start:start+n_slab] = slab
+        return quantized
+
+    def _normalize_field(self, fld_data, out=None):
         # Normalizing to a range between 0-255 is not only useful to simplify
         # setting the colormaps and opacities. It also prevents large numbers
         # in the fields which might lead to problems with vtk depending on the
         # GPU used.
-        if self.vmax is None:
-            max_value = np.max(fld_data)
-        else:
-            max_value = self.vmax
-        if self.vmin is None:
-            min_value = np.min(fld_data)
-        else:
-            min_value = self.vmin
+        # The data is normalized to its original range, independently of
+        # vmin and vmax (see `_get_scalar_mapping`).
+        min_value, max_value = self._original_data_range
+        scale = self._get_data_scale(min_value, max_value)
+        if out is not None:
+            # Normalize the data directly into `out`, slab by slab.
+            n_slab = _get_slab_length(fld_data)
+            for start in range(0, fld_data.shape[0], n_slab):
+                slab = fld_data[start:start+n_slab] - min_value
+                slab *= scale
+                out[start:start+n_slab] = slab
+            return out
+        # The data is normalized in place. Copy it if it cannot be modified
+        # (e.g. if it is shared with a cache).
+        if not fld_data.flags.writeable:
+            fld_data = fld_data.copy()
         fld_data -= min_value
-        if np.abs(max_value-min_value) > 0:
-            fld_data *= 255 / (max_value-min_value)
+        fld_data *= scale
         # Type conversion to single precission, if needed
         fld_data = fld_data.astype(np.float32, copy=False)
         return fld_data
@@ -1384,7 +1806,10 @@ class ScatterSpecies():
                  vmin=None, xtrim=None, ytrim=None, ztrim=None, size=1,
                  color_according_to=None, scale_with_charge=False,
                  unit_norm_factors=None, forced_norm_factor=None,
-                 name_suffix=None):
+                 name_suffix=None, range_mode='timestep',
+                 range_percentiles=(1, 99), range_timesteps=None,
+                 range_parallel=False):
+        _check_range_mode(range_mode)
         self.species = species
         self.color = color
         self.cmap = cmap
@@ -1399,6 +1824,10 @@ class ScatterSpecies():
         self._unit_norm_factors = unit_norm_factors
         self.forced_norm_factor = forced_norm_factor
         self.name_suffix = name_suffix
+        self.range_mode = range_mode
+        self.range_percentiles = range_percentiles
+        self.range_timesteps = range_timesteps
+        self.range_parallel = range_parallel
         self._setup_vtk_elements()
         self._current_timestep = None
         self._current_color_variable = None
@@ -1446,22 +1875,35 @@ class ScatterSpecies():
     def update_data(self, timestep):
         # Get data
         (data_arr, color_arr, scale_arr, data_units, update_data, update_color,
-         update_scale) = self._get_data(timestep)
+         update_scale) = self._get_data(
+            timestep, allocator=partial(self._get_buffer, 'points',
+                                        n_components=3))
         if update_data:
             if self.forced_norm_factor is not None:
                 norm_factor = self.forced_norm_factor
             else:
                 norm_factor = self._unit_norm_factors[data_units[0]]
+            # The particle positions are already stored in the points buffer.
             data_arr *= norm_factor
-            # Create vtkPolyData
-            self.poly_data = pv.PolyData(data_arr)
-            self.map.SetInputData(self.poly_data)
-        if update_color and self.color_according_to is not None:
-            self._normalize_color_variable(color_arr)
-            self.poly_data.point_arrays['color'] = color_arr
-        if update_scale and self.scale_with_charge:
-            self._normalize_scale(scale_arr, max_size=self.size * 0.02)
-            self.poly_data.point_arrays['scale'] = scale_arr
+            self.vtk_points.SetData(
+                numpy_support.numpy_to_vtk(data_arr, deep=False))
+            self._set_vertices(len(data_arr))
+        if update_color:
+            if self.color_according_to is not None:
+                color_buffer = self._get_buffer('color', len(color_arr))
+                color_buffer[:] = color_arr
+                self._normalize_color_variable(color_buffer)
+                self._set_point_array('color', color_buffer)
+            else:
+                self.poly_data.GetPointData().RemoveArray('color')
+        if update_scale:
+            if self.scale_with_charge:
+                scale_buffer = self._get_buffer('scale', len(scale_arr))
+                scale_buffer[:] = scale_arr
+                self._normalize_scale(scale_buffer, max_size=self.size * 0.02)
+                self._set_point_array('scale', scale_buffer)
+            else:
+                self.poly_data.GetPointData().RemoveArray('scale')
 
     def set_scale_with_charge(self, value):
         self.scale_with_charge = value
@@ -1507,7 +1949,8 @@ class ScatterSpecies():
         color_var = self.color_according_to
         if color_var is not None and color_var in self._timestep_data:
             color_arr = self._timestep_data[color_var][0]
-            color_arr_range = [np.min(color_arr), np.max(color_arr)]
+            color_arr_range = self._get_color_range(
+                self._current_timestep, color_arr)
             vmin, vmax = self._get_colorbar_range(color_arr_range)
         else:
             warnings.warn('Colormap data not yet specified or loaded.'
@@ -1541,6 +1984,14 @@ class ScatterSpecies():
         self.vtk_cmap = vtk.vtkColorTransferFunction()
         self.map = vtk.vtkOpenGLSphereMapper()
         self.map.SetLookupTable(self.vtk_cmap)
+        # The same points and poly data are updated at every time step.
+        self.vtk_points = vtk.vtkPoints()
+        self.vtk_points.SetDataTypeToFloat()
+        self.poly_data = vtk.vtkPolyData()
+        self.poly_data.SetPoints(self.vtk_points)
+        self.map.SetInputData(self.poly_data)
+        self._buffers = {}
+        self._n_vertices = None
         self.species_actor = vtk.vtkActor()
         self.species_actor.SetMapper(self.map)
         self.style_handler = VolumeStyleHandler()
@@ -1582,7 +2033,49 @@ class ScatterSpecies():
             self.map.SetScalarVisibility(False)
             self.map.SetScalarModeToDefault()
 
-    def _get_data(self, timestep):
+    def _get_buffer(self, name, n_elements, n_components=1):
+        """
+        Returns a float32 array of `n_elements` (with `n_components` each)
+        from a persistent buffer. The buffer is only reallocated when it
+        needs to grow.
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or len(buffer) < n_elements:
+            capacity = n_elements
+            if buffer is not None:
+                capacity = max(capacity, int(1.5 * len(buffer)))
+            shape = (capacity, n_components) if n_components > 1 else capacity
+            buffer = np.empty(shape, dtype=np.float32)
+            self._buffers[name] = buffer
+        return buffer[:n_elements]
+
+    def _set_point_array(self, name, data):
+        """Set (without copying) a point data array of the poly data."""
+        vtk_array = numpy_support.numpy_to_vtk(data, deep=False)
+        vtk_array.SetName(name)
+        self.poly_data.GetPointData().AddArray(vtk_array)
+
+    def _set_vertices(self, n_points):
+        """Set one vertex per point in the poly data, if needed."""
+        if n_points == self._n_vertices:
+            return
+        id_type = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+        vertices = vtk.vtkCellArray()
+        ids = np.arange(n_points + 1, dtype=id_type)
+        try:
+            # Available only in vtk >= 9.0.0
+            vertices.SetData(
+                numpy_support.numpy_to_vtkIdTypeArray(ids, deep=False),
+                numpy_support.numpy_to_vtkIdTypeArray(ids[:-1], deep=False))
+        except AttributeError:
+            cells = np.ones((n_points, 2), dtype=id_type)
+            cells[:, 1] = ids[:-1]
+            vertices.SetCells(n_points, numpy_support.numpy_to_vtkIdTypeArray(
+                cells.ravel(), deep=True))
+        self.poly_data.SetVerts(vertices)
+        self._n_vertices = n_points
+
+    def _get_data(self, timestep, allocator=None):
         # Determine components to read
         comp_to_read = []
         color_var = self.color_according_to
@@ -1618,15 +2111,23 @@ class ScatterSpecies():
                 self._timestep_data[color_var] = data[color_var]
             elif update_scale:
                 self._timestep_data[scale_var] = data[scale_var]
-        # Create particle array
+        # Create particle array. If the positions are updated, they are
+        # stored in the array given by the allocator, if any.
         x_arr = self._timestep_data['x'][0]
         y_arr = self._timestep_data['y'][0]
         z_arr = self._timestep_data['z'][0]
-        part_arr = np.vstack((z_arr, y_arr, x_arr)).T
+        if update_data and allocator is not None:
+            part_arr = allocator(len(z_arr))
+        else:
+            part_arr = np.empty((len(z_arr), 3), dtype=np.float32)
+        part_arr[:, 0] = z_arr
+        part_arr[:, 1] = y_arr
+        part_arr[:, 2] = x_arr
         # Create color array and update colorbar
         if color_var is not None:
-            # Make copy of array to prevent modifying stored data in any way
-            color_arr = np.array(self._timestep_data[color_var][0])
+            # The stored data should not be modified in any way. The array is
+            # only normalized after being copied (see `update_data`).
+            color_arr = np.asarray(self._timestep_data[color_var][0])
             color_arr = color_arr.astype(np.float32, copy=False)
             cmap_range_changed = (self._current_forced_colormap_range !=
                                   [self.vmin, self.vmax])
@@ -1635,7 +2136,8 @@ class ScatterSpecies():
             if update_color:
                 color_var_units = self._timestep_data[color_var][1]['units']
                 if len(color_arr) > 0:
-                    color_var_range = [np.min(color_arr), np.max(color_arr)]
+                    color_var_range = self._get_color_range(
+                        timestep, color_arr)
                 else:
                     color_var_range = [0, 1]
                 self._update_colorbar(color_var, color_var_units,
@@ -1680,9 +2182,10 @@ class ScatterSpecies():
                           'Range of trimming will be determined from maximum'
                           'extension of particle distribution.',
                           RuntimeWarning)
-            z_range = [np.min(z_arr), np.max(z_arr)]
-            y_range = [np.min(y_arr), np.max(y_arr)]
-            x_range = [np.min(x_arr), np.max(x_arr)]
+            timestep = self._current_timestep
+            z_range = self._get_component_range(timestep, 'z', z_arr)
+            y_range = self._get_component_range(timestep, 'y', y_arr)
+            x_range = self._get_component_range(timestep, 'x', x_arr)
         elements_to_keep = np.ones_like(x_arr)
         if self.xtrim is not None:
             x_trim_range = self._determine_trimming_range(self.xtrim, x_range)
@@ -1700,13 +2203,44 @@ class ScatterSpecies():
                                         (z_arr < z_trim_range[1]),
                                         elements_to_keep, 0)
         elements_to_keep = np.array(elements_to_keep, dtype=bool)
-        part_arr = part_arr[elements_to_keep]
+        # Keep the remaining particles at the start of the same array (which
+        # might be the buffer of the vtkPoints).
+        n_keep = np.count_nonzero(elements_to_keep)
+        part_arr[:n_keep] = part_arr[elements_to_keep]
+        part_arr = part_arr[:n_keep]
         if self.color_according_to is not None:
             color_arr = color_arr[elements_to_keep]
         if self.scale_with_charge:
             scale_arr = scale_arr[elements_to_keep]
         return part_arr, color_arr, scale_arr
 
+    def _get_component_range(self, timestep, component, data_arr):
+        """
+        Returns the (min, max) range of a particle component. If available,
+        it is taken from the statistics index of the species instead of the
+        data.
+        """
+        stats = self.species.get_statistics(timestep, component)
+        if stats is not None and not np.isnan(stats['min']):
+            return [stats['min'], stats['max']]
+        return [np.min(data_arr), np.max(data_arr)]
+
+    def _get_color_range(self, timestep, color_arr):
+        """
+        Returns the range of the variable according to which the particles
+        are colored, either at the given time step or over all time steps
+        (depending on `range_mode`).
+        """
+        color_var = self.color_according_to
+        if self.range_mode == 'timestep':
+            return self._get_component_range(timestep, color_var, color_arr)
+        percentiles = None
+        if self.range_mode == 'percentile':
+            percentiles = self.range_percentiles
+        return list(self.species.get_global_range(
+            color_var, time_steps=self.range_timesteps,
+            percentiles=percentiles, parallel=self.range_parallel))
+
     def _determine_trimming_range(self, x_trim, x_range):
         x_trim_norm = np.array(x_trim)
         x_min, x_max = x_range
@@ -1717,13 +2251,15 @@ class ScatterSpecies():
 
     def _normalize_color_variable(self, part_data):
         if len(part_data) > 0:
-            if self.vmax is None:
+            if self.range_mode == 'timestep':
+                min_value = np.min(part_data)
                 max_value = np.max(part_data)
             else:
+                min_value, max_value = self._get_color_range(
+                    self._current_timestep, part_data)
+            if self.vmax is not None:
                 max_value = self.vmax
-            if self.vmin is None:
-                min_value = np.min(part_data)
-            else:
+            if self.vmin is not None:
                 min_value = self.vmin
             part_data -= min_value
             if np.abs(max_value-min_value) > 0:
@@ -1770,3 +2306,19 @@ class ScatterSpecies():
         if self.vmax is not None:
             vmax = self.vmax
         return np.array([vmin, vmax])
+
+
+def _check_range_mode(range_mode):
+    """Check that the mode for determining the colormap range is valid."""
+    if range_mode not in ['timestep', 'global', 'percentile']:
+        raise ValueError(
+            "Unknown range mode '{}'. ".format(range_mode) +
+            "Possible values are 'timestep', 'global' or 'percentile'.")
+
+
+def _get_slab_length(fld_data):
+    """
+    Returns the number of planes (along the first axis) of the slabs in which
+    a field array is processed.
+    """
+    return max(1, SLAB_SIZE // max(1, fld_data[0].size))